@@ -1,36 +1,154 @@
 import os
-import requests
 import flask
 
-from helpers import (
-    convert_unix_to_YMD,
-)
+from collections import namedtuple
 
+import cache
+import elevation_store
 
-from light_pollution import get_light_pollution
-from nearest_csc import get_nearest_csc
+from light_pollution import (get_light_pollution, get_light_pollution_area, get_light_pollution_area_batch,
+                             get_light_pollution_batch)
+from nearest_csc import get_nearest_csc, get_nearest_cscs, get_nearest_csc_batch
+from upstream import QuotaExceededError, UpstreamError, clients
 
 DARKSKY_API_KEY = os.environ.get('DARKSKY_API_KEY', '')
 G_MAPS_API_KEY = os.environ.get('G_MAPS_API_KEY', '')
 
-SUNSET_URL = "https://api.sunrise-sunset.org/json"
-DARKSKY_URL = "https://api.darksky.net/forecast/%s/%.4f,%.4f,%d"
-GMAPS_ELEV_URL = "https://maps.googleapis.com/maps/api/elevation/json"
-GMAPS_DIST_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+# Overridable to point at stand-in servers, e.g. benchmarks/stub_upstreams.py
+DARKSKY_URL = os.environ.get('DARKSKY_URL', "https://api.darksky.net/forecast/%s/%.4f,%.4f,%d")
+DARKSKY_FORECAST_URL = os.environ.get('DARKSKY_FORECAST_URL', "https://api.darksky.net/forecast/%s/%.4f,%.4f")
+GMAPS_ELEV_URL = os.environ.get('GMAPS_ELEV_URL', "https://maps.googleapis.com/maps/api/elevation/json")
+GMAPS_DIST_URL = os.environ.get('GMAPS_DIST_URL', "https://maps.googleapis.com/maps/api/distancematrix/json")
+GMAPS_DIST_MAX_DESTINATIONS = 25  # Distance Matrix limit per request (with a single origin)
+DARKSKY_BLOCKS = ('currently', 'minutely', 'hourly', 'daily', 'alerts', 'flags')
 
+# Just the fields used from a DarkSky data point (currently, or an hour/day of the forecast)
+WeatherPoint = namedtuple('WeatherPoint', ['time', 'precip_prob', 'humidity', 'visibility', 'cloud_cover'])
+# Parsed forecast, blocks not requested are None/empty. Sizes are of the upstream call that fetched it,
+# stale if it is an expired forecast served to save the DarkSky quota
+Forecast = namedtuple('Forecast', ['currently', 'hourly', 'daily', 'bytes_in', 'bytes_out', 'stale'],
+                      defaults=(False,))
 
-def dark_sky(lat_selected, lng_selected, time):
+
+def parse_weather_point(data_point):
+    """Fields DarkSky leaves out of a data point are None, so they read as unavailable rather than 0"""
+    return WeatherPoint(
+        data_point.get('time'),
+        data_point.get('precipProbability'),
+        data_point.get('humidity'),
+        data_point.get('visibility'),
+        data_point.get('cloudCover'),
+    )
+
+
+def parse_forecast(weather_data, bytes_in=0, bytes_out=0):
+    """Keep only the fields we use from a DarkSky response, instead of the whole json dict
+
+    args: decoded DarkSky response, payload sizes of the call
+    returns: Forecast
+    """
+    currently = weather_data.get('currently')
+    return Forecast(
+        parse_weather_point(currently) if currently else None,
+        tuple(parse_weather_point(hour) for hour in weather_data.get('hourly', {}).get('data', [])),
+        tuple(parse_weather_point(day) for day in weather_data.get('daily', {}).get('data', [])),
+        bytes_in,
+        bytes_out,
+    )
+
+
+def encode_forecast(forecast):
+    """Forecast as json-serializable lists, for the shared cache"""
+    return [
+        list(forecast.currently) if forecast.currently else None,
+        [list(hour) for hour in forecast.hourly],
+        [list(day) for day in forecast.daily],
+        forecast.bytes_in,
+        forecast.bytes_out,
+    ]
+
+
+def decode_forecast(data):
+    currently, hourly, daily, bytes_in, bytes_out = data
+    return Forecast(
+        WeatherPoint(*currently) if currently else None,
+        tuple(WeatherPoint(*hour) for hour in hourly),
+        tuple(WeatherPoint(*day) for day in daily),
+        bytes_in,
+        bytes_out,
+    )
+
+
+cache.caches['darksky'].set_codec(encode_forecast, decode_forecast)
+
+
+def fetch_or_stale(name, key, fetch, mark_stale, refresh=False):
+    """Wrap an upstream fetch to serve the last value cached for the key instead, marked
+    stale, while the upstream's quota is running low or once it refuses the call
+
+    args: upstream (and cache) name, cache key, function calling the upstream, function
+          marking a value stale, whether a fresh value is required
+    returns: function for TTLCache.get_or_fetch
+    """
+    response_cache = cache.caches[name]
+
+    def fetch_quota_aware():
+        if not refresh and clients[name].quota_low():
+            stale = response_cache.get_stale(key)
+            if stale is not cache.MISSING:
+                return mark_stale(stale)
+        try:
+            return fetch()
+        except QuotaExceededError:
+            stale = response_cache.get_stale(key)
+            if stale is cache.MISSING:
+                raise
+            return mark_stale(stale)
+
+    return fetch_quota_aware
+
+
+def dark_sky(lat_selected, lng_selected, time, blocks=('currently',), refresh=False, extend_hourly=False, ttl=None):
     """Gets Weather report for location and time specified using darksky api
 
-    args: lat/lng and time for stargazing site
-    returns: weather api response in json format
+    Only the requested blocks are downloaded (the rest are excluded in the request). Reports
+    for a time are cached per cell and hour, the forecast from now per cell until it expires,
+    each separately for each set of blocks.
+
+    args: lat/lng and time for stargazing site (None for the forecast from now, with a week of
+          daily and 48 hours of hourly data), DarkSky blocks needed (currently, hourly, daily),
+          whether to replace a cached report, whether to extend hourly data to a week,
+          seconds to cache the report for (defaults to WEATHER_CACHE_TTL_S)
+    returns: Forecast, with currently None if the request failed, marked stale if an expired
+             forecast was served to save quota
+    raises: QuotaExceededError if over the DarkSky quota with no forecast to fall back on
     """
     if not DARKSKY_API_KEY:
         raise Exception("Missing API Key for DarkSky")
 
-    request = requests.get(DARKSKY_URL % (DARKSKY_API_KEY, lat_selected, lng_selected, time))
-    print(request)
-    return request.json()
+    blocks = tuple(block for block in DARKSKY_BLOCKS if block in blocks)
+    params = {'exclude': ",".join(block for block in DARKSKY_BLOCKS if block not in blocks)}
+    if extend_hourly:
+        params['extend'] = "hourly"
+
+    if time is None:
+        url = DARKSKY_FORECAST_URL % (DARKSKY_API_KEY, lat_selected, lng_selected)
+        cache_key = (cache.geohash(lat_selected, lng_selected), blocks, "forecast", extend_hourly)
+    else:
+        url = DARKSKY_URL % (DARKSKY_API_KEY, lat_selected, lng_selected, time)
+        cache_key = cache.weather_key(lat_selected, lng_selected, time) + (blocks,)
+
+    def fetch():
+        weather_data, bytes_in, bytes_out = clients['darksky'].request_json(url, params=params)
+        return parse_forecast(weather_data, bytes_in, bytes_out)
+
+    # Nearby sites in the same hour share one cached forecast
+    return cache.caches['darksky'].get_or_fetch(
+        cache_key,
+        fetch_or_stale('darksky', cache_key, fetch, lambda forecast: forecast._replace(stale=True), refresh),
+        should_cache=lambda forecast: not forecast.stale and (
+            forecast.currently is not None or bool(forecast.hourly or forecast.daily)),
+        refresh=refresh, ttl=ttl)
 
 
 def gmaps_elevation(lat_selected, lng_selected):
@@ -47,8 +165,16 @@ def gmaps_elevation(lat_selected, lng_selected):
         'key': G_MAPS_API_KEY
     }
 
-    elev_request = requests.get(GMAPS_ELEV_URL, params=elev_params)
-    return elev_request.json()
+    # Requests for the same spot share one call, keyed on the elevation store's grid so both
+    # layers agree on which point an elevation belongs to. Elevations don't change, an expired
+    # one is as good as new when the quota is low
+    cache_key = elevation_store.grid_key(lat_selected, lng_selected)
+    return cache.caches['gmaps_elevation'].get_or_fetch(
+        cache_key,
+        fetch_or_stale('gmaps_elevation', cache_key,
+                       lambda: clients['gmaps_elevation'].get_json(GMAPS_ELEV_URL, params=elev_params),
+                       lambda elev_data: dict(elev_data, stale=True)),
+        should_cache=lambda elev_data: elev_data.get('status') == "OK" and not elev_data.get('stale'))
 
 
 def gmaps_distance(lat_origin, lng_origin, lat_selected, lng_selected):
@@ -67,28 +193,41 @@ def gmaps_distance(lat_origin, lng_origin, lat_selected, lng_selected):
         'key': G_MAPS_API_KEY
     }
 
-    dist_request = requests.get(GMAPS_DIST_URL, params=dist_params)
+    return clients['gmaps_distance'].get_json(GMAPS_DIST_URL, params=dist_params)
 
-    return dist_request.json()
 
+def gmaps_distance_matrix(lat_origin, lng_origin, destinations):
+    """Gets the distance from one origin to many destinations, batching them into as few
+    Distance Matrix requests as the API's element limits allow
 
-def sunrise_sunset_time(lat_selected, lng_selected, time):
-    """Gets the times the sun will rise/set, and reach "twilight" conditions sufficent for stargazing
-
-    args: lat/lng for stargazing site selcted
-    returns: json response with driving distance (meters) and time (seconds)
+    args: lat/lng for origin, list of (lat, lng) for stargazing sites
+    returns: list of Distance Matrix elements, one per destination in the same order. Destinations
+             of a request that failed as a whole get an element with just that request's status
     """
-    params = {
-        'lat': lat_selected,
-        'lng': lng_selected,
-        'formatted': 0,
-        'date': str(convert_unix_to_YMD(time)) if time else "",
-    }
+    if not G_MAPS_API_KEY:
+        raise Exception("Missing API Key for Google Maps")
+
+    elements = []
+    for chunk_start in range(0, len(destinations), GMAPS_DIST_MAX_DESTINATIONS):
+        chunk = destinations[chunk_start:chunk_start + GMAPS_DIST_MAX_DESTINATIONS]
+        dist_params = {
+            'origins': str(lat_origin)+","+str(lng_origin),
+            'destinations': "|".join(str(lat)+","+str(lng) for lat, lng in chunk),
+            'key': G_MAPS_API_KEY
+        }
+        try:
+            dist_data = clients['gmaps_distance'].get_json(GMAPS_DIST_URL, params=dist_params)
+        except UpstreamError as e:
+            print("Error: Distance Matrix request failed: %s" % e)
+            dist_data = {'status': "UNAVAILABLE"}
 
-    # TODO: Currently only returns darkness times for today, must work for next 48 hours
-    # API accepts date paramter but in YYYY-MM-DD format, not unix time
-    request = requests.get(SUNSET_URL, params=params)
-    return request.json()
+        rows = dist_data.get('rows') or [{}]
+        chunk_elements = rows[0].get('elements', [])
+        # Pad if the request failed as a whole (e.g. status OVER_QUERY_LIMIT) so results line up
+        failed_element = {'status': dist_data.get('status', "UNAVAILABLE")}
+        elements.extend(chunk_elements + [dict(failed_element) for _ in range(len(chunk) - len(chunk_elements))])
+
+    return elements
 
 
 def light_pollution(lat_selected, lng_selected):
@@ -100,6 +239,33 @@ def light_pollution(lat_selected, lng_selected):
     return get_light_pollution(float(lat_selected), float(lng_selected))
 
 
+def light_pollution_area(lat_selected, lng_selected, radius_km, with_max=False):
+    """Determines mean (and max) Light Pollution Levels around a site. Internal API.
+
+    args: lat/lng for stargazing site selcted, radius in km, whether to find the max
+    returns: tuple of mean and max light pollution levels (additional brightness ratio)
+    """
+    return get_light_pollution_area(float(lat_selected), float(lng_selected), float(radius_km), with_max)
+
+
+def light_pollution_area_batch(lats, lngs, radius_km, with_max=False):
+    """Determines mean (and max) Light Pollution Levels around many sites. Internal API.
+
+    args: lists of lat/lng for stargazing sites, radius in km, whether to find the max
+    returns: list of tuples of mean and max light pollution levels, in the same order
+    """
+    return get_light_pollution_area_batch(lats, lngs, float(radius_km), with_max)
+
+
+def light_pollution_batch(lats, lngs):
+    """Determines Light Pollution Levels for many sites. Internal API.
+
+    args: lists of lat/lng for stargazing sites
+    returns: list of light pollution levels (additional brightness ratio), in the same order
+    """
+    return get_light_pollution_batch(lats, lngs).tolist()
+
+
 def nearest_csc(lat_selected, lng_selected):
     """Gets nearest Clear Sky Chart. Internal API.
 
@@ -107,3 +273,21 @@ def nearest_csc(lat_selected, lng_selected):
     returns: json response with the nearest CSC.
     """
     return get_nearest_csc(float(lat_selected), float(lng_selected))
+
+
+def nearest_cscs(lat_selected, lng_selected, count):
+    """Gets the nearest Clear Sky Charts within 100 km. Internal API.
+
+    args: lat/lng for stargazing site selcted, max number of sites
+    returns: list of the nearest CSCs, sorted by distance
+    """
+    return get_nearest_cscs(float(lat_selected), float(lng_selected), count)
+
+
+def nearest_csc_batch(lats, lngs):
+    """Gets nearest Clear Sky Chart for many sites. Internal API.
+
+    args: lists of lat/lng for stargazing sites
+    returns: list of json responses with the nearest CSC, in the same order
+    """
+    return get_nearest_csc_batch(lats, lngs)
@@ -0,0 +1,235 @@
+"""
+Benchmarks for the stargazing report service
+
+End to end: starts the stand-in upstreams (stub_upstreams.py), then sends report requests
+through the Flask app at a chosen concurrency and measures throughput and latency
+percentiles. Micro: times the hot local functions (light pollution, nearest CSC, ratings,
+darkness and time helpers) in a loop.
+
+    python benchmarks/run_benchmarks.py --requests 500 --concurrency 16 --latency darksky=0.3
+
+Results are printed and written as json (benchmarks/results/ by default) so runs can be
+compared over time.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time as t
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# Continental US, where CSC sites and most traffic are
+SITE_BOUNDS = {'lat': (30.0, 48.0), 'lng': (-123.0, -75.0)}
+
+sys.path.insert(0, REPO_DIR)
+
+from stub_upstreams import StubUpstreams, add_stub_arguments, parse_upstream_values
+
+
+def percentiles(samples):
+    import numpy as np
+
+    if not samples:
+        return {}
+    values = np.array(samples) * 1000
+    return {
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'max_ms': round(float(values.max()), 3),
+    }
+
+
+def random_sites(count, seed):
+    rng = random.Random(seed)
+    return [(round(rng.uniform(*SITE_BOUNDS['lat']), 5), round(rng.uniform(*SITE_BOUNDS['lng']), 5))
+            for _ in range(count)]
+
+
+def run_end_to_end(main, requests, concurrency, site_count, with_origin, timeline, seed):
+    """Send report requests through the Flask app and time them
+
+    returns: dict of throughput, latency percentiles and error counts
+    """
+    sites = random_sites(site_count, seed)
+    rng = random.Random(seed + 1)
+    plan = [rng.choice(sites) for _ in range(requests)]
+
+    def one_request(site):
+        params = {'lat_selected': site[0], 'lng_selected': site[1], 'timeline': int(timeline)}
+        if with_origin:
+            params.update({'lat_org': site[0] + 0.5, 'lng_org': site[1] + 0.5})
+        started = t.perf_counter()
+        response = main.app.test_client().get("/", query_string=params)
+        latency = t.perf_counter() - started
+        report = response.get_json(silent=True) or {}
+        return latency, response.status_code, report.get('sections', {})
+
+    started = t.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one_request, plan))
+    wall_s = t.perf_counter() - started
+
+    section_errors = {}
+    for _, _, sections in results:
+        for section, state in sections.items():
+            if state != "ok":
+                section_errors.setdefault(section, {}).setdefault(state, 0)
+                section_errors[section][state] += 1
+
+    return dict(
+        requests=requests,
+        concurrency=concurrency,
+        distinct_sites=site_count,
+        wall_s=round(wall_s, 3),
+        throughput_rps=round(requests / wall_s, 2),
+        http_errors=sum(1 for _, status, _ in results if status != 200),
+        section_errors=section_errors,
+        **percentiles([latency for latency, _, _ in results]))
+
+
+def time_calls(fn, args_list, repeat):
+    """Call fn over args_list repeat times, timing each pass
+
+    returns: dict of calls per pass and per call time (best and median pass)
+    """
+    fn(*args_list[0])  # Load anything lazily loaded outside the timings
+    passes = []
+    for _ in range(repeat):
+        started = t.perf_counter()
+        for args in args_list:
+            fn(*args)
+        passes.append((t.perf_counter() - started) / len(args_list))
+    passes.sort()
+    return {
+        'calls': len(args_list),
+        'best_us': round(passes[0] * 1e6, 3),
+        'median_us': round(passes[len(passes) // 2] * 1e6, 3),
+    }
+
+
+def run_micro(main, points, repeat, seed):
+    """Time the local hot path functions
+
+    returns: dict of timings per function
+    """
+    import numpy as np
+
+    import helpers
+    import light_pollution
+    import nearest_csc
+
+    sites = random_sites(points, seed)
+    rng = random.Random(seed)
+    lats = np.array([lat for lat, _ in sites])
+    lngs = np.array([lng for _, lng in sites])
+    weather = [(rng.random(), rng.random(), rng.random(), rng.uniform(0, 20)) for _ in range(points)]
+    now = helpers.get_current_unix_time()
+    times = [(now + rng.randrange(-86400, 86400 * 7),) for _ in range(points)]
+    darkness_times = main.get_darkness_times(sites[0][0], sites[0][1], now)
+
+    return {
+        'get_light_pollution': time_calls(light_pollution.get_light_pollution, sites, repeat),
+        'get_light_pollution_batch': time_calls(light_pollution.get_light_pollution_batch, [(lats, lngs)], repeat),
+        'get_nearest_csc': time_calls(nearest_csc.get_nearest_csc, sites, repeat),
+        'get_nearest_csc_batch': time_calls(nearest_csc.get_nearest_csc_batch, [(lats, lngs)], repeat),
+        'calculate_rating': time_calls(main.calculate_rating, weather, repeat),
+        'calculate_ratings': time_calls(main.calculate_ratings, [tuple(np.array(column) for column in zip(*weather))],
+                                        repeat),
+        'get_darkness_times': time_calls(main.get_darkness_times, [site + (now,) for site in sites[:100]], repeat),
+        'set_time_to_dark': time_calls(main.set_time_to_dark, [(darkness_times, now + offset)
+                                                               for offset in range(0, 86400, 864)], repeat),
+        'get_current_unix_time': time_calls(helpers.get_current_unix_time, [()] * points, repeat),
+        'convert_unix_to_YMD': time_calls(helpers.convert_unix_to_YMD, times, repeat),
+        'convert_YMDHMS_to_unix': time_calls(helpers.convert_YMDHMS_to_unix,
+                                             [(dt.utcfromtimestamp(unix_time).strftime("%Y-%m-%dT%H:%M:%S+00:00"),)
+                                              for unix_time, in times], repeat),
+        'light_pollution_source': "raster" if light_pollution.get_lp_raster() is not None else "png tiles",
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stargazing report service against local stub upstreams")
+    parser.add_argument('--requests', type=int, default=200, help="report requests to send (default 200)")
+    parser.add_argument('--concurrency', type=int, default=8, help="requests in flight at once (default 8)")
+    parser.add_argument('--sites', type=int, default=100, help="distinct sites requested, fewer means more cache hits")
+    parser.add_argument('--no-origin', action='store_true', help="leave out the user location (no driving distance)")
+    parser.add_argument('--timeline', action='store_true', help="request the hourly timeline too")
+    parser.add_argument('--points', type=int, default=1000, help="inputs per micro-benchmark (default 1000)")
+    parser.add_argument('--repeat', type=int, default=5, help="timed passes per micro-benchmark (default 5)")
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="json file to write results to (default benchmarks/results/<time>.json)")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    stubs = StubUpstreams(latency_s=parse_upstream_values(args.latency),
+                          failure_rate=parse_upstream_values(args.failure_rate), jitter=args.jitter).start()
+
+    # Point the app at the stubs, with a throwaway elevation store, before it is imported
+    os.environ.update(stubs.urls)
+    os.environ.setdefault('DARKSKY_API_KEY', "bench")
+    os.environ.setdefault('G_MAPS_API_KEY', "bench")
+    os.environ['ELEVATION_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix="stargazr_bench_"), "elevation.sqlite")
+    os.environ['PREWARM_ENABLED'] = "0"
+    # Measure the service, not the quotas, unless they are set explicitly
+    for name in ('DARKSKY', 'GMAPS_ELEVATION', 'GMAPS_DISTANCE'):
+        os.environ.setdefault('UPSTREAM_QUOTA_%s_PER_S' % name, "0")
+
+    import main
+    import cache
+    import upstream
+
+    main.warm_up()
+
+    results = {
+        'meta': {
+            'timestamp': dt.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+            'warm_up': main.warm_up_status,
+        },
+    }
+
+    if not args.skip_end_to_end:
+        results['end_to_end'] = run_end_to_end(main, args.requests, args.concurrency, args.sites,
+                                               not args.no_origin, args.timeline, args.seed)
+        results['end_to_end']['upstream_stubs'] = stubs.stats()
+        results['end_to_end']['upstream_clients'] = upstream.get_upstream_stats()
+        results['end_to_end']['caches'] = cache.get_cache_stats()
+    if not args.skip_micro:
+        results['micro'] = run_micro(main, args.points, args.repeat, args.seed)
+
+    stubs.stop()
+
+    out_path = args.out or os.path.join(RESULTS_DIR, "bench_%s.json" % dt.utcnow().strftime("%Y%m%dT%H%M%SZ"))
+    out_dir = os.path.dirname(out_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(json.dumps({key: value for key, value in results.items() if key != 'meta'}, indent=2))
+    print("Results written to %s" % out_path)
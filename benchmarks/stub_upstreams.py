@@ -0,0 +1,260 @@
+"""
+Local stand-ins for the upstream APIs (DarkSky, Google Elevation and Distance Matrix), with
+configurable latency and failure rate per upstream.
+
+Responses have the same shape as the real APIs, with made-up but plausible values. Run it
+on its own to point a server at it:
+
+    python benchmarks/stub_upstreams.py --port 8090 --latency darksky=0.3 --failure-rate darksky=0.05
+
+then start the server with the printed DARKSKY_URL, DARKSKY_FORECAST_URL, GMAPS_ELEV_URL and
+GMAPS_DIST_URL environment variables (and any non-empty API keys).
+"""
+import argparse
+import json
+import random
+import threading
+import time as t
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+UPSTREAMS = ('darksky', 'gmaps_elevation', 'gmaps_distance')
+DEFAULT_LATENCY_S = 0.1
+DEFAULT_JITTER = 0.2  # Latency varies uniformly by +/- this fraction
+
+DARKSKY_BLOCKS = ('currently', 'minutely', 'hourly', 'daily', 'alerts', 'flags')
+
+
+def fake_weather_point(rng, time):
+    return {
+        'time': time,
+        'summary': "Partly Cloudy",
+        'icon': "partly-cloudy-night",
+        'precipIntensity': 0,
+        'precipProbability': round(rng.random() * 0.3, 2),
+        'temperature': round(rng.uniform(30, 80), 2),
+        'apparentTemperature': round(rng.uniform(30, 80), 2),
+        'dewPoint': round(rng.uniform(20, 60), 2),
+        'humidity': round(rng.uniform(0.2, 0.9), 2),
+        'pressure': round(rng.uniform(1000, 1030), 1),
+        'windSpeed': round(rng.uniform(0, 15), 2),
+        'windGust': round(rng.uniform(0, 25), 2),
+        'windBearing': rng.randrange(360),
+        'cloudCover': round(rng.random(), 2),
+        'uvIndex': 0,
+        'visibility': 10,
+        'ozone': round(rng.uniform(250, 350), 1),
+    }
+
+
+def fake_forecast(lat, lng, time, exclude, hours=49):
+    """DarkSky forecast response, without the excluded blocks"""
+    rng = random.Random("%.2f,%.2f,%d" % (lat, lng, time // 3600))
+    hour = time // 3600 * 3600
+    forecast = {
+        'latitude': lat,
+        'longitude': lng,
+        'timezone': "America/Los_Angeles",
+        'currently': fake_weather_point(rng, time),
+        'minutely': {'summary': "Clear", 'data': [{'time': time + 60 * i, 'precipIntensity': 0, 'precipProbability': 0}
+                                                   for i in range(61)]},
+        'hourly': {'summary': "Clear", 'data': [fake_weather_point(rng, hour + 3600 * i) for i in range(hours)]},
+        'daily': {'summary': "Clear", 'data': [dict(fake_weather_point(rng, hour + 86400 * i), moonPhase=rng.random())
+                                               for i in range(8)]},
+        'alerts': [],
+        'flags': {'sources': ["stub"], 'units': "us"},
+        'offset': -8,
+    }
+    for block in exclude:
+        forecast.pop(block, None)
+    return forecast
+
+
+def parse_lat_lng(text):
+    lat, lng = text.split(",")[:2]
+    return float(lat), float(lng)
+
+
+def fake_elevation(locations):
+    results = []
+    for location in locations.split("|"):
+        lat, lng = parse_lat_lng(location)
+        results.append({
+            'elevation': round(random.Random(location).uniform(0, 3000), 3),
+            'location': {'lat': lat, 'lng': lng},
+            'resolution': 9.5,
+        })
+    return {'results': results, 'status': "OK"}
+
+
+def fake_distance_matrix(origins, destinations):
+    lat_o, lng_o = parse_lat_lng(origins)
+    elements = []
+    for destination in destinations.split("|"):
+        lat, lng = parse_lat_lng(destination)
+        meters = int(((lat - lat_o) ** 2 + (lng - lng_o) ** 2) ** 0.5 * 111000 * 1.3)
+        seconds = int(meters / 20)
+        elements.append({
+            'distance': {'text': "%.1f km" % (meters / 1000.0), 'value': meters},
+            'duration': {'text': "%d mins" % (seconds // 60), 'value': seconds},
+            'status': "OK",
+        })
+    return {
+        'destination_addresses': [""] * len(elements),
+        'origin_addresses': [""],
+        'rows': [{'elements': elements}],
+        'status': "OK",
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real upstreams
+
+    def route(self, path, params):
+        """Pick the upstream for a request path
+
+        returns: tuple of (upstream name, function building the response)
+        """
+        if path.startswith("/forecast/"):
+            location = path.rsplit("/", 1)[1].split(",")
+            lat, lng = location[:2]
+            # Forecast requests have no time, time machine requests do
+            time = int(float(location[2])) if len(location) > 2 else int(t.time())
+            exclude = params.get('exclude', "").split(",")
+            hours = 169 if params.get('extend') == "hourly" else 49
+            return 'darksky', lambda: fake_forecast(float(lat), float(lng), time, exclude, hours)
+        if path.endswith("/elevation/json"):
+            return 'gmaps_elevation', lambda: fake_elevation(params['locations'])
+        if path.endswith("/distancematrix/json"):
+            return 'gmaps_distance', lambda: fake_distance_matrix(params['origins'], params['destinations'])
+        return None, None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        name, build_response = self.route(url.path, params)
+        if name is None:
+            return self.send_json(404, {'status': "NOT_FOUND"})
+
+        config = self.server.config[name]
+        self.server.counts[name] += 1
+        latency = config['latency_s'] * random.uniform(1 - config['jitter'], 1 + config['jitter'])
+        t.sleep(max(latency, 0))
+        if random.random() < config['failure_rate']:
+            self.server.failures[name] += 1
+            return self.send_json(503, {'status': "UNAVAILABLE"})
+
+        try:
+            response = build_response()
+        except (KeyError, ValueError) as e:
+            return self.send_json(400, {'status': "INVALID_REQUEST", 'error': str(e)})
+        self.send_json(200, response)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubUpstreams(object):
+    """All three stand-in upstreams on one local port, served from a background thread"""
+
+    def __init__(self, port=0, latency_s=None, failure_rate=None, jitter=DEFAULT_JITTER):
+        latency_s = latency_s or {}
+        failure_rate = failure_rate or {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.config = {
+            name: {
+                'latency_s': latency_s.get(name, DEFAULT_LATENCY_S),
+                'failure_rate': failure_rate.get(name, 0.0),
+                'jitter': jitter,
+            }
+            for name in UPSTREAMS
+        }
+        self.server.counts = {name: 0 for name in UPSTREAMS}
+        self.server.failures = {name: 0 for name in UPSTREAMS}
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d" % self.server.server_port
+
+    @property
+    def urls(self):
+        """Upstream url settings for apis.py, as environment variable names and values"""
+        return {
+            'DARKSKY_URL': self.base_url + "/forecast/%s/%.4f,%.4f,%d",
+            'DARKSKY_FORECAST_URL': self.base_url + "/forecast/%s/%.4f,%.4f",
+            'GMAPS_ELEV_URL': self.base_url + "/maps/api/elevation/json",
+            'GMAPS_DIST_URL': self.base_url + "/maps/api/distancematrix/json",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stub_upstreams", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        return {
+            name: {
+                'requests': self.server.counts[name],
+                'failures': self.server.failures[name],
+                'latency_s': self.server.config[name]['latency_s'],
+                'failure_rate': self.server.config[name]['failure_rate'],
+            }
+            for name in UPSTREAMS
+        }
+
+
+def parse_upstream_values(values, default=None):
+    """Parse ["darksky=0.3", "0.1"] style options into a dict per upstream
+
+    A bare value applies to every upstream, name=value to just that one.
+    """
+    parsed = {}
+    for value in values or []:
+        if "=" in value:
+            name, value = value.split("=", 1)
+            if name not in UPSTREAMS:
+                raise ValueError("Unknown upstream %s, expected one of %s" % (name, ", ".join(UPSTREAMS)))
+            parsed[name] = float(value)
+        else:
+            parsed.update({name: float(value) for name in UPSTREAMS})
+    return parsed
+
+
+def add_stub_arguments(parser):
+    parser.add_argument('--latency', action='append', metavar="[UPSTREAM=]SECONDS",
+                        help="upstream response latency, for all upstreams or one (repeatable, default %s)" % DEFAULT_LATENCY_S)
+    parser.add_argument('--failure-rate', action='append', metavar="[UPSTREAM=]RATE",
+                        help="fraction of upstream requests answered with HTTP 503 (repeatable, default 0)")
+    parser.add_argument('--jitter', type=float, default=DEFAULT_JITTER,
+                        help="latency varies by +/- this fraction (default %s)" % DEFAULT_JITTER)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run stand-in upstream APIs for load testing")
+    parser.add_argument('--port', type=int, default=8090)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    stubs = StubUpstreams(args.port, parse_upstream_values(args.latency), parse_upstream_values(args.failure_rate),
+                          args.jitter)
+    for name, url in stubs.urls.items():
+        print("export %s='%s'" % (name, url))
+    try:
+        stubs.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
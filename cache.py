@@ -0,0 +1,297 @@
+"""
+In-process caches for upstream API responses
+
+Nearby points and close times get the same answer from the weather API, so responses are
+keyed on the geohash cell of the lat/lng and time snapped to the forecast hour. Twilight is
+computed locally (ephemeris.py) and needs no cache.
+
+Concurrent callers missing the cache for the same key share a single upstream call. With a
+shared cache configured (see shared_cache.py), misses are looked up there before calling
+the upstream, and fetched values are stored there for the other replicas.
+"""
+import os
+import threading
+import time as t
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import shared_cache
+
+SECONDS_IN_HOUR = 3600
+
+CACHE_GEOHASH_PRECISION = int(os.environ.get('CACHE_GEOHASH_PRECISION', 5))  # ~5 x 5 km cells at mid latitudes
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+WEATHER_CACHE_TTL_S = float(os.environ.get('WEATHER_CACHE_TTL_S', 30 * 60))
+ELEVATION_CACHE_TTL_S = float(os.environ.get('ELEVATION_CACHE_TTL_S', 30 * 24 * 60 * 60))
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+MISSING = object()
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key into one.
+
+    The first caller for a key makes the call, callers arriving while it is in flight
+    wait for its result (or exception) instead of making their own.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Call fn(), or wait for the call already in flight for key
+
+        args: hashable key, function making the call
+        returns: fn's return value
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._in_flight),
+        }
+
+
+def identity(value):
+    return value
+
+
+class TTLCache(object):
+    """LRU cache whose entries expire ttl seconds after they are set
+
+    Values stored in the shared cache go through encode (to something json can serialize)
+    and come back through decode, see set_codec.
+    """
+
+    def __init__(self, name, ttl, max_entries=CACHE_MAX_ENTRIES):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.shared_hits = 0
+        self.stale_hits = 0
+        self.encode = identity
+        self.decode = identity
+        self.flight = SingleFlight(name)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get an unexpired value from the cache
+
+        args: hashable key
+        returns: cached value, or MISSING
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < t.monotonic():
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_stale(self, key):
+        """Get the last value set for a key even if it has expired, until it is evicted
+
+        args: hashable key
+        returns: cached value, or MISSING
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            self.stale_hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (value, t.monotonic() + (self.ttl if ttl is None else ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_codec(self, encode, decode):
+        """Set how values are converted to and from json for the shared cache"""
+        self.encode = encode
+        self.decode = decode
+
+    def get_shared(self, key, shared):
+        """Get an unexpired value another replica stored, and keep it locally until it expires
+
+        returns: value, or MISSING
+        """
+        entry = shared.get(self.name, key)
+        if not isinstance(entry, dict):
+            return MISSING
+        ttl_left = entry.get('expires', 0) - t.time()
+        if ttl_left <= 0:
+            return MISSING
+        try:
+            value = self.decode(entry['value'])
+        except (KeyError, TypeError, ValueError) as e:
+            print("Error: Bad shared %s cache entry: %s" % (self.name, e))
+            return MISSING
+        self.set(key, value, ttl_left)
+        self.shared_hits += 1
+        return value
+
+    def get_or_fetch(self, key, fetch, should_cache=None, refresh=False, ttl=None):
+        """Get a value from the cache, calling fetch() to fill it on a miss
+
+        args: hashable key, function returning the value, optional predicate deciding
+              whether a fetched value (e.g. an error response) should be cached,
+              whether to fetch even if a value is cached, seconds to keep a fetched
+              value for (defaults to the cache's ttl)
+        returns: cached or fetched value
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if not refresh:
+            value = self.get(key)
+            if value is not MISSING:
+                return value
+
+        def fetch_and_set():
+            shared = shared_cache.get_shared_cache()
+            if shared is not None and not refresh:
+                value = self.get_shared(key, shared)
+                if value is not MISSING:
+                    return value
+
+            value = fetch()
+            if should_cache is None or should_cache(value):
+                self.set(key, value, ttl)
+                if shared is not None:
+                    shared.set(self.name, key, {'value': self.encode(value), 'expires': t.time() + ttl}, ttl)
+            return value
+
+        return self.flight.do(key, fetch_and_set)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Cache counters for monitoring
+
+        returns: dict of hits, misses (and those served from the shared cache or expired
+                 entries), evictions, hit rate, coalesced fetches and entries held
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared_hits': self.shared_hits,
+                'stale_hits': self.stale_hits,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'coalesced': self.flight.coalesced,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+            }
+
+
+def geohash(lat, lng, precision=CACHE_GEOHASH_PRECISION):
+    """Geohash of a lat/lng, e.g. "9q8yy" for San Francisco at precision 5
+
+    Nearby points share a prefix, so the hash at a given precision names the grid cell a
+    point falls in, the same on every replica.
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    code = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(code) < precision:
+        value, value_range = (float(lng), lng_range) if even else (float(lat), lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            code.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(code)
+
+
+def geohash_center(code):
+    """Center of a geohash cell
+
+    returns: tuple of lat, lng
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for char in code:
+        bits = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lng_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if bits >> shift & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+def quantize_time(unix_time, bucket):
+    """Snap a unix time to the start of its bucket (e.g. the hour or UTC date)"""
+    return int(unix_time // bucket * bucket)
+
+
+def weather_key(lat, lng, time):
+    return (geohash(lat, lng), quantize_time(time, SECONDS_IN_HOUR))
+
+
+caches = {
+    'darksky': TTLCache('darksky', WEATHER_CACHE_TTL_S),
+    'gmaps_elevation': TTLCache('gmaps_elevation', ELEVATION_CACHE_TTL_S),
+}
+
+
+def get_cache_stats():
+    """Hit/miss counters for each upstream response cache"""
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+def get_coalescing_stats():
+    """Calls made and callers coalesced for each upstream"""
+    return {name: cache.flight.stats() for name, cache in caches.items()}
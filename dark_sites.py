@@ -0,0 +1,305 @@
+"""
+"Darkest sites near me" search over the compiled light pollution raster
+
+An offline step builds a pyramid over the raster holding the min and mean light pollution of
+each block, from PYRAMID_LEAF_LEVEL (8x8 pixel blocks, a few km across) up to whole tiles.
+Searches walk the pyramid best first: a block's min is a lower bound for every leaf inside
+it, so once a block is brighter than the results already found it is never opened.
+
+The light pollution map is dark over the sea too, so given a DEM the pyramid marks leaves whose
+center is at or below sea level as water, and searches never return them.
+"""
+import argparse
+import heapq
+import json
+import math
+import os
+
+import numpy as np
+
+import elevation_store
+import light_pollution as lp
+from nearest_csc import calc_great_circle_distances, EARTH_RADIUS_KM
+
+PYRAMID_LEAF_LEVEL = 3  # Leaves are 2**3 = 8 pixel square blocks
+PYRAMID_TOP_LEVEL = 10  # 2**10 = TILE_SIZE, one block per tile
+LP_PYRAMID_DIR = os.environ.get('LP_PYRAMID_DIR', os.path.join(lp.CURR_DIR_PATH, 'lp_data', 'lp_pyramid'))
+MAX_SEARCH_RADIUS_KM = 300
+MIN_SEPARATION_KM = 5
+
+_lp_pyramid = None
+_lp_pyramid_loaded = False
+
+
+def get_level_paths(pyramid_dir, level):
+    return (os.path.join(pyramid_dir, "min_%d.npy" % level), os.path.join(pyramid_dir, "mean_%d.npy" % level))
+
+
+def get_water_leaves(lats, lngs):
+    """Which leaves are over water according to the loaded DEM
+
+    Leaves the DEM covers with an elevation at or below sea level (or missing, which DEMs
+    use for the sea) are water. Leaves outside the DEM are kept as land.
+
+    args: numpy arrays of leaf center lats/lngs
+    returns: bool array, None if there is no DEM
+    """
+    dem_elevations = elevation_store.get_dem_elevation_batch(lats, lngs)
+    if dem_elevations is None:
+        return None
+    elevations, covered = dem_elevations
+    with np.errstate(invalid='ignore'):
+        return covered & ~(elevations > 0)
+
+
+def get_single_class_blocks(raster, row, col, tile_size):
+    """Classes of the raster blocks in a tile, if the raster is a BlockRaster and each is a single class
+
+    returns: uint8 array with a class per block of the tile, None if any block has more than one
+    """
+    if not isinstance(raster, lp.BlockRaster) or raster.block_size % 2**PYRAMID_LEAF_LEVEL:
+        return None
+    size = raster.block_size
+    slots = np.asarray(raster.index[row // size:(row + tile_size) // size, col // size:(col + tile_size) // size])
+    if (slots >= 0).any():
+        return None
+    return (-1 - slots).astype(np.uint8)
+
+
+def compile_lp_pyramid(raster_path=lp.LP_RASTER_PATH, pyramid_dir=LP_PYRAMID_DIR, dem_path=None):
+    """Build the min/mean pyramid from a raster compiled by light_pollution.compile_lp_raster
+
+    Min is stored as the class index (ratios ascend with the index), mean as the float ratio.
+    Colors not in the key are counted as the brightest class so they are never picked.
+    With a DEM (see elevation_store.load_dem), water leaves get a min of NO_DATA_INDEX, so
+    blocks holding nothing but water are never searched.
+
+    args: path to compiled raster, directory to write the pyramid levels to, optional DEM path
+    returns: None
+    """
+    if dem_path and elevation_store.load_dem(dem_path) is None:
+        raise IOError("Could not load DEM %s" % dem_path)
+    lp_raster = lp.load_lp_raster(raster_path)
+    if lp_raster is None:
+        raise IOError("No compiled light pollution raster at %s" % raster_path)
+
+    raster = lp_raster['raster']
+    tile_size = lp_raster['tile_size']
+    os.makedirs(pyramid_dir, exist_ok=True)
+
+    ratios = np.array(lp_raster['ratios'], dtype=np.float32)
+    class_ratios = np.full(256, ratios[-1], dtype=np.float32)
+    class_ratios[:len(ratios)] = ratios
+    class_mins = np.full(256, len(ratios) - 1, dtype=np.uint8)
+    class_mins[:len(ratios)] = np.arange(len(ratios))
+
+    block = 2**PYRAMID_LEAF_LEVEL
+    leaf_shape = (raster.shape[0] // block, raster.shape[1] // block)
+    mins = np.empty(leaf_shape, dtype=np.uint8)
+    means = np.empty(leaf_shape, dtype=np.float32)
+
+    # One tile at a time to keep memory flat
+    tile_blocks = tile_size // block
+    leaf_centers = (np.arange(tile_blocks) + 0.5) * block / tile_size
+    for row in range(0, raster.shape[0], tile_size):
+        for col in range(0, raster.shape[1], tile_size):
+            out = (slice(row // block, row // block + tile_blocks), slice(col // block, col // block + tile_blocks))
+            single_classes = get_single_class_blocks(raster, row, col, tile_size)
+            if single_classes is not None:
+                # Every raster block in the tile is one class, no need to expand it to pixels
+                repeats = raster.block_size // block
+                leaf_classes = np.repeat(np.repeat(single_classes, repeats, axis=0), repeats, axis=1)
+                mins[out] = class_mins[leaf_classes]
+                means[out] = class_ratios[leaf_classes]
+            else:
+                tile = np.asarray(raster[row:row + tile_size, col:col + tile_size])
+                blocks_shape = (tile_blocks, block, tile_blocks, block)
+                mins[out] = class_mins[tile].reshape(blocks_shape).min(axis=(1, 3))
+                means[out] = class_ratios[tile].reshape(blocks_shape).mean(axis=(1, 3))
+
+            if dem_path:
+                ys, xs = np.meshgrid(lp_raster['tile_y_min'] + row // tile_size + leaf_centers,
+                                     col // tile_size + leaf_centers, indexing='ij')
+                water = get_water_leaves(*lp.get_tile_lat_lngs(xs, ys, lp.LP_ZOOM))
+                mins[out][water] = lp.NO_DATA_INDEX
+
+    for level in range(PYRAMID_LEAF_LEVEL, PYRAMID_TOP_LEVEL + 1):
+        if level > PYRAMID_LEAF_LEVEL:
+            shape = (mins.shape[0] // 2, 2, mins.shape[1] // 2, 2)
+            mins = mins.reshape(shape).min(axis=(1, 3))
+            means = means.reshape(shape).mean(axis=(1, 3))
+        min_path, mean_path = get_level_paths(pyramid_dir, level)
+        np.save(min_path, mins)
+        np.save(mean_path, means)
+
+    with open(os.path.join(pyramid_dir, "pyramid.json"), 'w') as f:
+        json.dump({
+            'leaf_level': PYRAMID_LEAF_LEVEL,
+            'top_level': PYRAMID_TOP_LEVEL,
+            'tile_size': tile_size,
+            'tile_y_min': lp_raster['tile_y_min'],
+            'ratios': lp_raster['ratios'],
+        }, f)
+
+
+def load_lp_pyramid(pyramid_dir=LP_PYRAMID_DIR):
+    """Memory-map the light pollution pyramid, if one has been compiled
+
+    args: directory written by compile_lp_pyramid
+    returns: dict of pyramid levels and layout, None if no pyramid is available
+    """
+    global _lp_pyramid, _lp_pyramid_loaded
+
+    _lp_pyramid_loaded = True
+    try:
+        with open(os.path.join(pyramid_dir, "pyramid.json"), 'r') as f:
+            layout = json.load(f)
+        levels = {}
+        for level in range(layout['leaf_level'], layout['top_level'] + 1):
+            min_path, mean_path = get_level_paths(pyramid_dir, level)
+            levels[level] = (np.load(min_path, mmap_mode='r'), np.load(mean_path, mmap_mode='r'))
+    except (IOError, ValueError):
+        _lp_pyramid = None
+        return None
+
+    layout['levels'] = levels
+    _lp_pyramid = layout
+    return _lp_pyramid
+
+
+def get_lp_pyramid():
+    """Get the mapped light pollution pyramid, mapping it on first use"""
+    if not _lp_pyramid_loaded:
+        load_lp_pyramid()
+    return _lp_pyramid
+
+
+def get_block_center(pyramid, level, row, col):
+    """lat/lng of the center of a pyramid block"""
+    size = 2**level
+    x = (col + 0.5) * size / pyramid['tile_size']
+    y = pyramid['tile_y_min'] + (row + 0.5) * size / pyramid['tile_size']
+    lat, lng = lp.get_tile_lat_lngs(x, y, lp.LP_ZOOM)
+    return float(lat), float(lng)
+
+
+def get_pixel_bounds(pyramid, lat, lng, radius_km):
+    """Rows/cols of the raster covering a radius around a point (clamped, no antimeridian wrap)
+
+    returns: tuple of ints (row_min, row_max, col_min, col_max), max exclusive
+    """
+    d_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    d_lng = d_lat / max(math.cos(math.radians(min(abs(lat) + d_lat, 89.9))), 1e-6)
+    lat_max, lat_min = min(lat + d_lat, 85), max(lat - d_lat, -85)
+    lng_min, lng_max = max(lng - d_lng, -180), min(lng + d_lng, 180)
+
+    x, y = lp.get_lat_lng_tiles(np.array([lat_max, lat_min]), np.array([lng_min, lng_max]), lp.LP_ZOOM)
+    tile_size = pyramid['tile_size']
+    rows = (y - pyramid['tile_y_min']) * tile_size
+    cols = x * tile_size
+    return (int(math.floor(rows[0])), int(math.ceil(rows[1])), int(math.floor(cols[0])), int(math.ceil(cols[1])))
+
+
+def find_darkest_sites(lat, lng, radius_km, count=10, min_separation_km=MIN_SEPARATION_KM, exclude=()):
+    """Find the darkest locations within a radius, nearest first among equally dark ones
+
+    Leaves come off the heap in order of (mean light pollution, distance), and internal blocks
+    are keyed by their min, so the first leaves found are exactly the darkest. Results closer
+    than min_separation_km to a darker result are skipped so they aren't all one dark valley.
+    Water leaves are never returned, nor leaves within min_separation_km of an excluded point
+    (e.g. an earlier result with no route to it), which don't hold back the leaves near them.
+
+    args: lat/lng of origin, radius in km, max number of sites, min km between sites,
+          list of (lat, lng) to exclude
+    returns: list of dicts with lat, lng, lightPol (block mean), lightPolMin and dist_km,
+             None if no pyramid has been compiled
+    """
+    pyramid = get_lp_pyramid()
+    if pyramid is None:
+        return None
+
+    levels = pyramid['levels']
+    ratios = pyramid['ratios']
+    top = pyramid['top_level']
+    leaf = pyramid['leaf_level']
+
+    row_min, row_max, col_min, col_max = get_pixel_bounds(pyramid, lat, lng, radius_km)
+
+    def children(level, row, col):
+        """Blocks one level down (or the top level blocks), limited to the search bounds"""
+        size = 2**level
+        if level == top + 1:
+            r_range, c_range = range(levels[top][0].shape[0]), range(levels[top][0].shape[1])
+        else:
+            r_range, c_range = range(row * 2, row * 2 + 2), range(col * 2, col * 2 + 2)
+        size //= 2
+        for r in r_range:
+            if (r + 1) * size <= row_min or r * size >= row_max:
+                continue
+            for c in c_range:
+                if (c + 1) * size <= col_min or c * size >= col_max:
+                    continue
+                yield r, c
+
+    heap = []
+
+    def push_children(level, row, col):
+        child_level = level - 1
+        mins, means = levels[child_level]
+        for r, c in children(level, row, col):
+            if mins[r, c] == lp.NO_DATA_INDEX:
+                continue
+            if child_level == leaf:
+                block_lat, block_lng = get_block_center(pyramid, leaf, r, c)
+                dist = float(calc_great_circle_distances(lat, lng, block_lat, block_lng))
+                if dist > radius_km:
+                    continue
+                # float32 means can round below the min, which would put them ahead of their siblings
+                mean = max(float(means[r, c]), ratios[int(mins[r, c])])
+                heapq.heappush(heap, (mean, 1, dist, child_level, r, c))
+            else:
+                heapq.heappush(heap, (ratios[int(mins[r, c])], 0, 0.0, child_level, r, c))
+
+    push_children(top + 1, 0, 0)
+
+    exclude_lats = np.array([point[0] for point in exclude], dtype=np.float64)
+    exclude_lngs = np.array([point[1] for point in exclude], dtype=np.float64)
+    exclude_km = max(min_separation_km, 1e-3)
+
+    sites = []
+    while heap and len(sites) < count:
+        value, is_leaf, dist, level, row, col = heapq.heappop(heap)
+        if not is_leaf:
+            push_children(level, row, col)
+            continue
+
+        block_lat, block_lng = get_block_center(pyramid, level, row, col)
+        if len(exclude_lats) and calc_great_circle_distances(block_lat, block_lng, exclude_lats, exclude_lngs).min() < exclude_km:
+            continue
+        if sites and min_separation_km > 0:
+            seps = calc_great_circle_distances(block_lat, block_lng,
+                                               np.array([site['lat'] for site in sites]),
+                                               np.array([site['lng'] for site in sites]))
+            if seps.min() < min_separation_km:
+                continue
+
+        sites.append({
+            'lat': round(block_lat, 5),
+            'lng': round(block_lng, 5),
+            'lightPol': round(value, 4),
+            'lightPolMin': ratios[int(levels[level][0][row, col])],
+            'dist_km': round(dist, 1),
+        })
+
+    return sites
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the light pollution min/mean pyramid from the compiled raster")
+    parser.add_argument('--raster', default=lp.LP_RASTER_PATH, help="path of compiled .npy raster")
+    parser.add_argument('--out', default=LP_PYRAMID_DIR, help="directory to write pyramid levels to")
+    parser.add_argument('--dem', default=elevation_store.DEM_PATH, help="DEM raster to mask out water with (see README)")
+    args = parser.parse_args()
+
+    compile_lp_pyramid(args.raster, args.out, args.dem)
+    print("Compiled light pollution pyramid to %s" % args.out)
@@ -0,0 +1,170 @@
+"""
+Persistent store of site elevations, so each location is only looked up from Google once
+
+Elevations are kept in SQLite keyed by lat/lng snapped to a grid, and survive restarts. A
+local DEM raster can also be loaded as an offline source that needs no API calls at all.
+"""
+import json
+import math
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from PIL import Image
+
+CURR_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+ELEVATION_DB_PATH = os.environ.get('ELEVATION_DB_PATH', os.path.join(CURR_DIR_PATH, 'elevation_data', 'elevation.sqlite'))
+ELEVATION_GRID_DEG = float(os.environ.get('ELEVATION_GRID_DEG', 0.001))  # ~100 m
+DEM_PATH = os.environ.get('DEM_PATH', '')
+
+_local = threading.local()
+_dem = None
+_dem_loaded = False
+
+
+def get_connection(db_path=ELEVATION_DB_PATH):
+    """SQLite connection for the current thread, creating the store if needed"""
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        connection = sqlite3.connect(db_path, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS elevation ("
+            " lat_idx INTEGER NOT NULL,"
+            " lng_idx INTEGER NOT NULL,"
+            " elevation REAL NOT NULL,"
+            " PRIMARY KEY (lat_idx, lng_idx))")
+        connection.commit()
+        _local.connection = connection
+    return connection
+
+
+def grid_key(lat, lng):
+    """Snap lat/lng to integer indices of the elevation grid"""
+    return (int(round(lat / ELEVATION_GRID_DEG)), int(round(lng / ELEVATION_GRID_DEG)))
+
+
+def load_dem(dem_path=DEM_PATH):
+    """Load a DEM raster (.npy, or any single band image PIL can read) for offline lookups.
+
+    Needs a json file next to the raster (same name, .json extension) with the lat of the top
+    edge 'north', lng of the left edge 'west', the size of a cell in degrees 'cell_deg' and
+    optionally the value used for missing data 'nodata'.
+
+    args: path to raster
+    returns: dict with raster and georeferencing, None if no DEM is available
+    """
+    global _dem, _dem_loaded
+
+    _dem_loaded = True
+    if not dem_path:
+        _dem = None
+        return None
+
+    try:
+        with open(os.path.splitext(dem_path)[0] + ".json", 'r') as f:
+            georef = json.load(f)
+        if dem_path.endswith(".npy"):
+            raster = np.load(dem_path, mmap_mode='r')
+        else:
+            raster = np.asarray(Image.open(dem_path))
+    except (IOError, ValueError) as e:
+        print("Error: Could not load DEM %s: %s" % (dem_path, e))
+        _dem = None
+        return None
+
+    _dem = {
+        'raster': raster,
+        'north': georef['north'],
+        'west': georef['west'],
+        'cell_deg': georef['cell_deg'],
+        'nodata': georef.get('nodata'),
+    }
+    return _dem
+
+
+def get_dem_elevation(lat, lng):
+    """Elevation from the local DEM
+
+    args: lat/lng
+    returns: elevation in meters, None if there is no DEM or it does not cover the point
+    """
+    if not _dem_loaded:
+        load_dem()
+    if _dem is None:
+        return None
+
+    raster = _dem['raster']
+    row = math.floor((_dem['north'] - lat) / _dem['cell_deg'])
+    col = math.floor((lng - _dem['west']) / _dem['cell_deg'])
+    if not (0 <= row < raster.shape[0] and 0 <= col < raster.shape[1]):
+        return None
+
+    elevation = float(raster[row, col])
+    if _dem['nodata'] is not None and elevation == _dem['nodata']:
+        return None
+    return elevation
+
+
+def get_dem_elevation_batch(lats, lngs):
+    """Elevations from the local DEM for many points at once
+
+    args: numpy arrays of lats/lngs
+    returns: tuple of numpy arrays (elevation in meters, NaN where missing, bool where the DEM covers
+             the point), None if there is no DEM
+    """
+    if not _dem_loaded:
+        load_dem()
+    if _dem is None:
+        return None
+
+    raster = _dem['raster']
+    rows = np.floor((_dem['north'] - np.asarray(lats)) / _dem['cell_deg']).astype(np.int64)
+    cols = np.floor((np.asarray(lngs) - _dem['west']) / _dem['cell_deg']).astype(np.int64)
+    covered = (rows >= 0) & (rows < raster.shape[0]) & (cols >= 0) & (cols < raster.shape[1])
+
+    elevations = np.full(rows.shape, np.nan)
+    elevations[covered] = raster[rows[covered], cols[covered]]
+    if _dem['nodata'] is not None:
+        elevations[elevations == _dem['nodata']] = np.nan
+    return elevations, covered
+
+
+def get_elevation(lat, lng):
+    """Look up an elevation without calling any API, from the DEM or previously stored values
+
+    args: lat/lng
+    returns: elevation in meters, None if unknown
+    """
+    elevation = get_dem_elevation(lat, lng)
+    if elevation is not None:
+        return elevation
+
+    try:
+        row = get_connection().execute(
+            "SELECT elevation FROM elevation WHERE lat_idx = ? AND lng_idx = ?", grid_key(lat, lng)).fetchone()
+    except (sqlite3.Error, OSError) as e:
+        print("Error: Elevation store unavailable: %s" % e)
+        return None
+
+    return row[0] if row else None
+
+
+def put_elevation(lat, lng, elevation):
+    """Store an elevation fetched from an API
+
+    args: lat/lng, elevation in meters
+    returns: None
+    """
+    try:
+        connection = get_connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO elevation (lat_idx, lng_idx, elevation) VALUES (?, ?, ?)",
+            grid_key(lat, lng) + (float(elevation),))
+        connection.commit()
+    except (sqlite3.Error, OSError) as e:
+        print("Error: Could not store elevation: %s" % e)
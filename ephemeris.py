@@ -0,0 +1,304 @@
+"""
+Local ephemeris for the Sun and Moon, so twilight and moon data don't need an upstream call
+
+Solar position follows the NOAA Solar Calculator equations (Meeus, Astronomical Algorithms),
+accurate to about a minute for event times between +/- 72 deg latitude. Lunar position uses
+the largest periodic terms of Meeus ch. 47, good to a few tenths of a degree, which is
+plenty for phase and rise/set times. All functions take numpy arrays so several days or
+times are computed at once.
+"""
+import numpy as np
+
+SECONDS_IN_DAY = 86400
+UNIX_EPOCH_JD = 2440587.5  # Julian Day of 1970-01-01T00:00:00 UTC
+
+NAUTICAL_TWILIGHT_ALT = -12.0  # Sun this far below horizon = start of astronomical twilight
+SUNRISE_ALT = -0.833           # Accounts for refraction and radius of solar disk
+MOONRISE_ALT = -0.833          # Topocentric, accounts for refraction and radius of lunar disk
+EARTH_RADIUS_KM = 6378.14
+
+# Status of a day for a given sun altitude
+SUN_CROSSES = 0   # Sun rises above and sets below the altitude
+SUN_ALWAYS_UP = 1  # Sun stays above the altitude all day. Midnight Sun if altitude is twilight
+SUN_ALWAYS_DOWN = 2  # Sun stays below the altitude all day. Polar Night if altitude is twilight
+
+
+def unix_to_julian_day(unix_time):
+    return np.asarray(unix_time, dtype=np.float64) / SECONDS_IN_DAY + UNIX_EPOCH_JD
+
+
+def julian_century(unix_time):
+    """Julian centuries since J2000.0
+
+    args: unix time(s)
+    returns: float or numpy array
+    """
+    return (unix_to_julian_day(unix_time) - 2451545.0) / 36525.0
+
+
+def utc_day_start(unix_time):
+    """Unix time of 00:00 UTC on the same UTC date
+
+    args: unix time(s)
+    returns: float or numpy array
+    """
+    return np.floor(np.asarray(unix_time, dtype=np.float64) / SECONDS_IN_DAY) * SECONDS_IN_DAY
+
+
+def solar_coordinates(unix_time):
+    """Apparent solar coordinates at the given time(s)
+
+    args: unix time(s)
+    returns: dict of numpy arrays, declination and apparent ecliptic longitude in degrees,
+             equation of time in minutes
+    """
+    T = julian_century(unix_time)
+
+    geom_mean_long = np.mod(280.46646 + T * (36000.76983 + T * 0.0003032), 360)
+    geom_mean_anom = 357.52911 + T * (35999.05029 - 0.0001537 * T)
+    eccent = 0.016708634 - T * (0.000042037 + 0.0000001267 * T)
+
+    M = np.radians(geom_mean_anom)
+    center = (np.sin(M) * (1.914602 - T * (0.004817 + 0.000014 * T))
+              + np.sin(2 * M) * (0.019993 - 0.000101 * T)
+              + np.sin(3 * M) * 0.000289)
+
+    true_long = geom_mean_long + center
+    omega = np.radians(125.04 - 1934.136 * T)
+    app_long = true_long - 0.00569 - 0.00478 * np.sin(omega)
+
+    mean_obliq = 23 + (26 + (21.448 - T * (46.815 + T * (0.00059 - T * 0.001813))) / 60) / 60
+    obliq = np.radians(mean_obliq + 0.00256 * np.cos(omega))
+
+    declination = np.degrees(np.arcsin(np.sin(obliq) * np.sin(np.radians(app_long))))
+
+    L0 = np.radians(geom_mean_long)
+    y = np.tan(obliq / 2) ** 2
+    eq_time = 4 * np.degrees(
+        y * np.sin(2 * L0)
+        - 2 * eccent * np.sin(M)
+        + 4 * eccent * y * np.sin(M) * np.cos(2 * L0)
+        - 0.5 * y * y * np.sin(4 * L0)
+        - 1.25 * eccent * eccent * np.sin(2 * M))
+
+    return {
+        'declination': declination,
+        'ecliptic_longitude': np.mod(app_long, 360),
+        'obliquity': np.degrees(obliq),
+        'eq_time': eq_time,
+    }
+
+
+def solar_altitude(lat, lng, unix_time):
+    """Altitude of the Sun above the horizon, ignoring refraction
+
+    args: lat/lng in degrees, unix time(s)
+    returns: numpy array of altitudes in degrees
+    """
+    unix_time = np.asarray(unix_time, dtype=np.float64)
+    coords = solar_coordinates(unix_time)
+
+    minutes_of_day = np.mod(unix_time, SECONDS_IN_DAY) / 60
+    true_solar_minutes = minutes_of_day + coords['eq_time'] + 4 * lng
+    hour_angle = np.radians(true_solar_minutes / 4 - 180)
+
+    phi = np.radians(lat)
+    decl = np.radians(coords['declination'])
+    return np.degrees(np.arcsin(np.sin(phi) * np.sin(decl) + np.cos(phi) * np.cos(decl) * np.cos(hour_angle)))
+
+
+def _hour_angle_cos(lat, declination, altitude):
+    phi = np.radians(lat)
+    decl = np.radians(declination)
+    return (np.sin(np.radians(altitude)) - np.sin(phi) * np.sin(decl)) / (np.cos(phi) * np.cos(decl))
+
+
+def get_sun_event_times(lat, lng, day_starts, altitude=NAUTICAL_TWILIGHT_ALT, iterations=2):
+    """Times the Sun crosses an altitude in the morning and evening around each day's solar noon.
+
+    Like sunrise-sunset.org, days are UTC dates anchored on the local solar noon, so for
+    locations far from Greenwich the events may fall on the previous or next UTC date.
+    Each estimate is refined by recomputing the Sun's position at the event time.
+
+    args: lat/lng in degrees, unix time(s) of 00:00 UTC for each day, sun altitude in degrees
+    returns: dict of numpy arrays, 'morning' and 'evening' unix times (nan when the sun
+             does not cross the altitude), and 'status' (SUN_CROSSES, SUN_ALWAYS_UP, SUN_ALWAYS_DOWN)
+    """
+    day_starts = np.asarray(day_starts, dtype=np.float64)
+
+    def event_time(guess, direction):
+        coords = solar_coordinates(guess)
+        cos_ha = _hour_angle_cos(lat, coords['declination'], altitude)
+        hour_angle = np.degrees(np.arccos(np.clip(cos_ha, -1, 1)))
+        noon_minutes = 720 - 4 * lng - coords['eq_time']
+        return day_starts + (noon_minutes + direction * 4 * hour_angle) * 60, cos_ha
+
+    noon_guess = day_starts + (720 - 4 * lng) * 60
+    morning, _ = event_time(noon_guess, -1)
+    evening, _ = event_time(noon_guess, 1)
+    for _ in range(iterations):
+        morning, cos_ha_morning = event_time(morning, -1)
+        evening, cos_ha_evening = event_time(evening, 1)
+
+    # Check at solar noon whether the Sun reaches the altitude at all that day
+    noon_cos_ha = _hour_angle_cos(lat, solar_coordinates(noon_guess)['declination'], altitude)
+    status = np.where(noon_cos_ha > 1, SUN_ALWAYS_DOWN, np.where(noon_cos_ha < -1, SUN_ALWAYS_UP, SUN_CROSSES))
+
+    crosses = status == SUN_CROSSES
+    morning = np.where(crosses & (np.abs(cos_ha_morning) <= 1), morning, np.nan)
+    evening = np.where(crosses & (np.abs(cos_ha_evening) <= 1), evening, np.nan)
+
+    return {
+        'morning': morning,
+        'evening': evening,
+        'status': status,
+    }
+
+
+def get_twilight_windows(lat, lng, unix_time, days, day_offset=0):
+    """Nautical twilight times for a range of consecutive days in one computation.
+
+    args: lat/lng in degrees, unix time within the first day, number of days,
+          offset in days of the first day from the UTC date of unix_time
+    returns: dict from get_sun_event_times, 'dawn'/'dusk' are nautical twilight begin/end,
+             plus 'day_starts' for each day
+    """
+    day_starts = utc_day_start(unix_time) + (np.arange(days) + day_offset) * SECONDS_IN_DAY
+    events = get_sun_event_times(lat, lng, day_starts, NAUTICAL_TWILIGHT_ALT)
+
+    return {
+        'day_starts': day_starts,
+        'dawn': events['morning'],
+        'dusk': events['evening'],
+        'status': events['status'],
+    }
+
+
+def lunar_coordinates(unix_time):
+    """Geocentric position of the Moon at the given time(s)
+
+    args: unix time(s)
+    returns: dict of numpy arrays, ecliptic longitude/latitude, right ascension and
+             declination in degrees, distance in km
+    """
+    T = julian_century(unix_time)
+
+    mean_long = 218.3164477 + 481267.88123421 * T
+    D = np.radians(297.8501921 + 445267.1114034 * T)   # Mean elongation
+    M = np.radians(357.5291092 + 35999.0502909 * T)    # Sun's mean anomaly
+    Mm = np.radians(134.9633964 + 477198.8675055 * T)  # Moon's mean anomaly
+    F = np.radians(93.2720950 + 483202.0175233 * T)    # Argument of latitude
+
+    longitude = (mean_long
+                 + 6.288774 * np.sin(Mm)
+                 + 1.274027 * np.sin(2 * D - Mm)
+                 + 0.658314 * np.sin(2 * D)
+                 + 0.213618 * np.sin(2 * Mm)
+                 - 0.185116 * np.sin(M)
+                 - 0.114332 * np.sin(2 * F)
+                 + 0.058793 * np.sin(2 * D - 2 * Mm)
+                 + 0.057066 * np.sin(2 * D - M - Mm)
+                 + 0.053322 * np.sin(2 * D + Mm)
+                 + 0.045758 * np.sin(2 * D - M)
+                 - 0.040923 * np.sin(M - Mm)
+                 - 0.034720 * np.sin(D)
+                 - 0.030383 * np.sin(M + Mm))
+
+    latitude = (5.128122 * np.sin(F)
+                + 0.280602 * np.sin(Mm + F)
+                + 0.277693 * np.sin(Mm - F)
+                + 0.173237 * np.sin(2 * D - F)
+                + 0.055413 * np.sin(2 * D - Mm + F)
+                + 0.046271 * np.sin(2 * D - Mm - F))
+
+    distance = (385000.56
+                - 20905.355 * np.cos(Mm)
+                - 3699.111 * np.cos(2 * D - Mm)
+                - 2955.968 * np.cos(2 * D)
+                - 569.925 * np.cos(2 * Mm))
+
+    lam = np.radians(np.mod(longitude, 360))
+    beta = np.radians(latitude)
+    obliq = np.radians(solar_coordinates(unix_time)['obliquity'])
+
+    right_ascension = np.degrees(np.arctan2(np.sin(lam) * np.cos(obliq) - np.tan(beta) * np.sin(obliq), np.cos(lam)))
+    declination = np.degrees(np.arcsin(np.sin(beta) * np.cos(obliq) + np.cos(beta) * np.sin(obliq) * np.sin(lam)))
+
+    return {
+        'ecliptic_longitude': np.degrees(lam),
+        'ecliptic_latitude': latitude,
+        'right_ascension': np.mod(right_ascension, 360),
+        'declination': declination,
+        'distance': distance,
+    }
+
+
+def sidereal_time(lng, unix_time):
+    """Local mean sidereal time in degrees"""
+    days = unix_to_julian_day(unix_time) - 2451545.0
+    return np.mod(280.46061837 + 360.98564736629 * days + lng, 360)
+
+
+def lunar_altitude(lat, lng, unix_time):
+    """Topocentric altitude of the Moon above the horizon, ignoring refraction
+
+    args: lat/lng in degrees, unix time(s)
+    returns: numpy array of altitudes in degrees
+    """
+    coords = lunar_coordinates(unix_time)
+
+    hour_angle = np.radians(sidereal_time(lng, unix_time) - coords['right_ascension'])
+    phi = np.radians(lat)
+    decl = np.radians(coords['declination'])
+    altitude = np.arcsin(np.sin(phi) * np.sin(decl) + np.cos(phi) * np.cos(decl) * np.cos(hour_angle))
+
+    # Correct for parallax, the Moon is close enough to appear lower than from Earth's center
+    parallax = np.arcsin(EARTH_RADIUS_KM / coords['distance'])
+    return np.degrees(altitude - parallax * np.cos(altitude))
+
+
+def get_lunar_phase(unix_time):
+    """Phase of the Moon at the given time(s)
+
+    args: unix time(s)
+    returns: dict of numpy arrays, 'phase' as the fraction of the lunation (0 new, 0.5 full,
+             same as DarkSky's moonPhase) and 'illumination' as the illuminated fraction 0-1
+    """
+    moon = lunar_coordinates(unix_time)
+    sun_long = solar_coordinates(unix_time)['ecliptic_longitude']
+
+    d_long = np.radians(moon['ecliptic_longitude'] - sun_long)
+    elongation = np.arccos(np.cos(np.radians(moon['ecliptic_latitude'])) * np.cos(d_long))
+
+    return {
+        'phase': np.mod(np.degrees(d_long), 360) / 360,
+        'illumination': (1 - np.cos(elongation)) / 2,
+    }
+
+
+def get_moon_times(lat, lng, start_time, end_time, step=600):
+    """Moonrise and moonset times between two times
+
+    Moon altitude is sampled every step seconds in one array computation, and crossings of
+    the horizon are interpolated between samples (accurate to about a minute).
+
+    args: lat/lng in degrees, unix start/end times, sample spacing in seconds
+    returns: dict of lists of unix times (ints), 'rise' and 'set'
+    """
+    times = np.arange(start_time, end_time + step, step, dtype=np.float64)
+    times[-1] = min(times[-1], end_time)
+    altitude = lunar_altitude(lat, lng, times) - MOONRISE_ALT
+
+    above = altitude > 0
+    crossings = np.nonzero(above[1:] != above[:-1])[0]
+
+    # Linear interpolation of where altitude reaches 0 between the samples
+    alt_before = altitude[crossings]
+    alt_after = altitude[crossings + 1]
+    crossing_times = times[crossings] + (times[crossings + 1] - times[crossings]) * alt_before / (alt_before - alt_after)
+
+    rising = alt_after > 0
+    return {
+        'rise': [int(t) for t in crossing_times[rising]],
+        'set': [int(t) for t in crossing_times[~rising]],
+    }
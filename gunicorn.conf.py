@@ -0,0 +1,25 @@
+# Gunicorn settings for the production server, see wsgi.py
+import multiprocessing
+import os
+
+bind = "0.0.0.0:%s" % os.environ.get('PORT', 8080)
+
+# Load the app (and warm up shared data) once in the master, then fork workers
+preload_app = True
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_class = "gthread"
+
+# Reports have their own deadline (REPORT_DEADLINE_S), this only catches stuck workers
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 10
+keepalive = 5
+
+accesslog = "-"
+
+
+def post_fork(server, worker):
+    # Threads don't survive the fork, start them in each worker
+    from main import start_background_tasks
+    start_background_tasks()
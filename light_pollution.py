@@ -1,9 +1,18 @@
-import requests
-import os
+import argparse
+import json
 import math
+import os
+import shutil
+import threading
+
+from ast import literal_eval
+from collections import OrderedDict
 
+import numpy as np
 from PIL import Image
 
+from nearest_csc import EARTH_RADIUS_KM
+
 """
 Light Pollution Coloring Key
 Bortle  Color       RGB                LPX              Description
@@ -42,6 +51,174 @@ pixel_lightpoll_table = {
     '(255, 255, 255)': 46.77    # Bortle "46.77+"
 }
 
+# Palette index used in compiled rasters for colors not found in pixel_lightpoll_table
+NO_DATA_INDEX = 255
+
+# Lookup tables derived from pixel_lightpoll_table. A "class index" is the position of a
+# color in pixel_lightpoll_table, so ratios ascend with the index.
+color_class_table = {literal_eval(color): idx for idx, color in enumerate(pixel_lightpoll_table)}
+class_ratio_table = list(pixel_lightpoll_table.values())
+
+LP_ZOOM = 6
+TILE_SIZE = 1024
+TILE_X_COUNT = 64  # Lng Tiles: 0-63
+TILE_Y_MIN = 11    # Lat Tiles: 11-47
+TILE_Y_COUNT = 37
+
+CURR_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+TILES_DIR_PATH = os.path.join(CURR_DIR_PATH, 'lp_tiles')
+LP_RASTER_PATH = os.environ.get('LP_RASTER_PATH', os.path.join(CURR_DIR_PATH, 'lp_data', 'lp_raster.npy'))
+# Compiled rasters are stored in square blocks, blocks of a single class (open ocean, unlit land)
+# are kept as just their class. Tiles are split into (TILE_SIZE / LP_BLOCK_SIZE)^2 blocks
+LP_BLOCK_SIZE = 128
+
+# Memory ceiling for decoded PNG tiles kept between requests, each tile is ~1 MB
+LP_TILE_CACHE_BYTES = int(os.environ.get('LP_TILE_CACHE_BYTES', 64 * 1024 * 1024))
+# Memory ceiling for summed-area tables used by area averages, each tile is ~16 MB
+LP_SAT_CACHE_BYTES = int(os.environ.get('LP_SAT_CACHE_BYTES', 256 * 1024 * 1024))
+LP_MAX_AREA_RADIUS_KM = 25
+# Pixels shrink with cos(lat) towards the poles, so area windows are also capped in pixels,
+# and latitudes clamped to where Web Mercator ends
+LP_MAX_AREA_RADIUS_PX = 512
+LP_MAX_LAT = 85.0511
+
+_lp_raster = None
+_lp_raster_loaded = False
+
+
+class BlockRaster(object):
+    """Raster of class indices stored as square blocks, where blocks of a single class are
+    kept as just that class instead of block_size^2 copies of it.
+
+    Indexed like the dense array it stands for, for the reads the lookups make:
+    raster[row, col] with ints or equal shape int arrays, and raster[row_0:row_1, col_0:col_1].
+
+    args: (count, block_size, block_size) uint8 array of the blocks with more than one class,
+          int32 array with an entry per block of the raster: its position in blocks, or
+          -1 - class for a block of a single class, block size, (rows, cols) of the raster
+    """
+
+    def __init__(self, blocks, index, block_size, shape):
+        self.blocks = blocks
+        self.index = index
+        self.block_size = block_size
+        self.shape = tuple(shape)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if isinstance(rows, slice) and isinstance(cols, slice):
+            return self.window(rows, cols)
+        return self.lookup(rows, cols)
+
+    def lookup(self, rows, cols):
+        if np.isscalar(rows) and np.isscalar(cols):
+            slot = int(self.index[rows // self.block_size, cols // self.block_size])
+            if slot < 0:
+                return np.uint8(-1 - slot)
+            return self.blocks[slot, rows % self.block_size, cols % self.block_size]
+
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        slots = np.atleast_1d(self.index[rows // self.block_size, cols // self.block_size])
+        classes = np.where(slots < 0, -1 - slots, 0).astype(np.uint8)
+        stored = slots >= 0
+        if stored.any():
+            classes[stored] = self.blocks[slots[stored], np.atleast_1d(rows % self.block_size)[stored],
+                                          np.atleast_1d(cols % self.block_size)[stored]]
+        return classes.reshape(rows.shape)[()]
+
+    def window(self, rows, cols):
+        row_0, row_1, row_step = rows.indices(self.shape[0])
+        col_0, col_1, col_step = cols.indices(self.shape[1])
+        if row_step != 1 or col_step != 1:
+            raise ValueError("BlockRaster windows don't support steps")
+
+        size = self.block_size
+        out = np.empty((max(row_1 - row_0, 0), max(col_1 - col_0, 0)), dtype=np.uint8)
+        for block_row in range(row_0 // size, (row_1 - 1) // size + 1 if row_1 > row_0 else 0):
+            for block_col in range(col_0 // size, (col_1 - 1) // size + 1 if col_1 > col_0 else 0):
+                # Overlap of the block with the window, in raster coordinates
+                r_0, r_1 = max(row_0, block_row * size), min(row_1, (block_row + 1) * size)
+                c_0, c_1 = max(col_0, block_col * size), min(col_1, (block_col + 1) * size)
+                target = out[r_0 - row_0:r_1 - row_0, c_0 - col_0:c_1 - col_0]
+                slot = int(self.index[block_row, block_col])
+                if slot < 0:
+                    target[:] = -1 - slot
+                else:
+                    target[:] = self.blocks[slot, r_0 - block_row * size:r_1 - block_row * size,
+                                            c_0 - block_col * size:c_1 - block_col * size]
+        return out
+
+
+class TileCache(object):
+    """LRU cache of decoded tiles, bounded by the total bytes of the tiles it holds.
+
+    Tiles that do not exist are cached as None so missing coverage is not looked up again.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.curr_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load_tile):
+        """Get a tile from the cache, decoding it with load_tile(key) on a miss.
+
+        args: hashable key for the tile, function returning a numpy array or None
+        returns: the decoded tile, or None if it does not exist
+        """
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return self._tiles[key]
+            self.misses += 1
+
+        # Decode outside the lock so slow decodes don't block lookups of other tiles
+        tile = load_tile(key)
+        tile_bytes = tile.nbytes if tile is not None else 0
+
+        with self._lock:
+            if key not in self._tiles and tile_bytes <= self.max_bytes:
+                self._tiles[key] = tile
+                self.curr_bytes += tile_bytes
+                while self.curr_bytes > self.max_bytes:
+                    _, evicted = self._tiles.popitem(last=False)
+                    self.curr_bytes -= evicted.nbytes if evicted is not None else 0
+                    self.evictions += 1
+        return tile
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.curr_bytes = 0
+
+    def stats(self):
+        """Cache counters for monitoring
+
+        returns: dict of hits, misses, evictions, hit rate, tiles held and bytes held
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'tiles': len(self._tiles),
+                'bytes': self.curr_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+tile_cache = TileCache(LP_TILE_CACHE_BYTES)
+sat_cache = TileCache(LP_SAT_CACHE_BYTES)
+
+
 def inv_gudermannian(y):
     return math.log(math.tan((y + math.pi/2) / 2))
 
@@ -60,53 +237,473 @@ def get_lat_lng_tile(lat, lng, zoom):
     return (x, y)
 
 
-def get_light_pollution(lat, lng):
-    """Gets the Light Pollution level for the location chosen.
+def get_lat_lng_tiles(lats, lngs, zoom):
+    """Vectorized get_lat_lng_tile for numpy arrays of lat/lng
 
-    args: lat/lng for stargazing site
-    returns: Double representation of light pollution levels
+    returns: tuple of float arrays (x, y)
     """
-    curr_dir_path = os.path.dirname(os.path.realpath(__file__))
-    tiles_dir_path = os.path.join(curr_dir_path, 'lp_tiles')
+    lat_rad = np.log(np.tan((np.radians(lats) + np.pi/2) / 2))
 
+    x = 2**zoom * (lngs + 180.0) / 360.0
+    y = 2**zoom * (np.pi - lat_rad) / (2 * np.pi)
+
+    return (x, y)
+
+
+def get_tile_lat_lngs(x, y, zoom):
+    """Inverse of get_lat_lng_tiles, Mercator tile coordinates (x, y) back to lat/lng
+
+    returns: tuple of float arrays (lat, lng)
+    """
+    lats = np.degrees(np.arctan(np.sinh(np.pi - 2 * np.pi * np.asarray(y, dtype=np.float64) / 2**zoom)))
+    lngs = np.asarray(x, dtype=np.float64) * 360.0 / 2**zoom - 180.0
+
+    return (lats, lngs)
+
+
+def get_tile_pixel(lat, lng):
+    """Find which zoom 6 tile a location falls in, and which pixel of that tile.
+
+    args: lat/lng for stargazing site
+    returns: tuple of ints (tile i, tile j, pixel x, pixel y)
+    """
     # At zoom 6:
     # 37 Lat Titles, 11-47, -65 to 75 deg, covers 140 deg
     # 64 Lng Tiles: 0-63, -180 to 180 deg, covers 360 deg
     # coverage per tile deppends on latitude & Mercador distortion
 
-    i, j = get_lat_lng_tile(lat, lng, 6)
+    i, j = get_lat_lng_tile(lat, lng, LP_ZOOM)
 
     # Which tile and how far into it (%) is the pixel?
     i_pixel_percent = i % 1
     j_pixel_percent = j % 1
-    pixel_x = i_pixel_percent * 1024
-    pixel_y = j_pixel_percent * 1024
-    pixel_x = int(max(0, min(pixel_x, 1023))) #prevent out of bounds
-    pixel_y = int(max(0, min(pixel_y, 1023)))
+    pixel_x = i_pixel_percent * TILE_SIZE
+    pixel_y = j_pixel_percent * TILE_SIZE
+    pixel_x = int(max(0, min(pixel_x, TILE_SIZE - 1))) #prevent out of bounds
+    pixel_y = int(max(0, min(pixel_y, TILE_SIZE - 1)))
 
     # Floor to consider which tile to look at
-    i = int(i)
-    j = int(j)
+    return (int(i), int(j), pixel_x, pixel_y)
+
+
+def decode_tile_classes(image_path):
+    """Decode a light pollution PNG tile into an array of class indices.
+
+    Each tile has its own palette, so palette entries are mapped to a class index once
+    per tile instead of looking up every pixel by color.
+
+    args: path to tile image
+    returns: uint8 numpy array (TILE_SIZE x TILE_SIZE) of class indices, NO_DATA_INDEX for unknown colors
+    """
+    image = Image.open(image_path)
+
+    if image.mode == "P":
+        palette = image.getpalette() or []
+        palette_classes = np.full(256, NO_DATA_INDEX, dtype=np.uint8)
+        for idx in range(len(palette) // 3):
+            color = tuple(palette[idx*3:idx*3 + 3])
+            palette_classes[idx] = color_class_table.get(color, NO_DATA_INDEX)
+        return palette_classes[np.asarray(image)]
+
+    # Non-paletted tile, match packed RGB values against the known colors
+    rgb = np.asarray(image.convert("RGB"), dtype=np.uint32)
+    packed = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+    known = sorted(((r << 16) | (g << 8) | b, idx) for (r, g, b), idx in color_class_table.items())
+    known_keys = np.array([key for key, _ in known], dtype=np.uint32)
+    known_classes = np.array([idx for _, idx in known], dtype=np.uint8)
+    pos = np.minimum(np.searchsorted(known_keys, packed), len(known_keys) - 1)
+    return np.where(known_keys[pos] == packed, known_classes[pos], NO_DATA_INDEX).astype(np.uint8)
+
 
-    image_name = "tile_6_%d_%d.png" % (i, j)
+def compile_lp_raster(tiles_dir_path=TILES_DIR_PATH, raster_path=LP_RASTER_PATH, block_size=LP_BLOCK_SIZE):
+    """Compile all PNG tiles into one memory-mappable raster of class indices.
+
+    The raster covers (TILE_Y_COUNT * TILE_SIZE, TILE_X_COUNT * TILE_SIZE) pixels, with tile
+    (i, j) at rows (j - TILE_Y_MIN) * TILE_SIZE, cols i * TILE_SIZE, stored as a BlockRaster:
+    the .npy file holds the blocks with more than one class, an index .npy next to it
+    says where each block is (or its class), and a json file holds the layout and the
+    class index to ratio table. Missing tiles are filled with class 0, matching the
+    "no coverage" response.
+
+    args: directory of tile_6_x_y.png files, output path for raster, block size in pixels
+    returns: dict of the number of blocks, those stored and the bytes written
+    """
+    out_dir = os.path.dirname(raster_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    tile_blocks = TILE_SIZE // block_size
+    index = np.empty((TILE_Y_COUNT * tile_blocks, TILE_X_COUNT * tile_blocks), dtype=np.int32)
+    stored = 0
+
+    # Blocks are written as they are found, the .npy header needs their count so goes on after
+    blocks_tmp_path = raster_path + ".blocks.tmp"
+    with open(blocks_tmp_path, 'wb') as blocks_file:
+        for j in range(TILE_Y_MIN, TILE_Y_MIN + TILE_Y_COUNT):
+            for i in range(TILE_X_COUNT):
+                image_path = os.path.join(tiles_dir_path, "tile_6_%d_%d.png" % (i, j))
+                if os.path.exists(image_path):
+                    tile = decode_tile_classes(image_path)
+                else:
+                    tile = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+
+                # (block row, block col, y, x), then compare every pixel of a block to its first
+                tile_split = tile.reshape(tile_blocks, block_size, tile_blocks, block_size).swapaxes(1, 2)
+                firsts = tile_split[:, :, 0, 0]
+                uniform = (tile_split == firsts[:, :, None, None]).all(axis=(2, 3))
+
+                tile_index = np.where(uniform, -1 - firsts.astype(np.int32), 0)
+                for block_row, block_col in zip(*np.nonzero(~uniform)):
+                    tile_index[block_row, block_col] = stored
+                    blocks_file.write(np.ascontiguousarray(tile_split[block_row, block_col]).tobytes())
+                    stored += 1
+
+                row = (j - TILE_Y_MIN) * tile_blocks
+                index[row:row + tile_blocks, i * tile_blocks:(i + 1) * tile_blocks] = tile_index
+
+    tmp_path = raster_path + ".tmp.npy"
+    with open(tmp_path, 'wb') as f, open(blocks_tmp_path, 'rb') as blocks_file:
+        np.lib.format.write_array_header_1_0(f, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+            'fortran_order': False,
+            'shape': (stored, block_size, block_size),
+        })
+        shutil.copyfileobj(blocks_file, f, 16 * 1024 * 1024)
+    os.remove(blocks_tmp_path)
+    np.save(get_raster_index_path(raster_path) + ".tmp.npy", index)
+
+    table = {
+        'zoom': LP_ZOOM,
+        'tile_size': TILE_SIZE,
+        'tile_y_min': TILE_Y_MIN,
+        'block_size': block_size,
+        'shape': [TILE_Y_COUNT * TILE_SIZE, TILE_X_COUNT * TILE_SIZE],
+        'no_data_index': NO_DATA_INDEX,
+        'ratios': class_ratio_table,
+    }
+    with open(get_raster_table_path(raster_path) + ".tmp", 'w') as f:
+        json.dump(table, f)
+
+    # Swap in place so a running service never maps a half written file
+    os.replace(tmp_path, raster_path)
+    os.replace(get_raster_index_path(raster_path) + ".tmp.npy", get_raster_index_path(raster_path))
+    os.replace(get_raster_table_path(raster_path) + ".tmp", get_raster_table_path(raster_path))
+
+    return {
+        'blocks': int(index.size),
+        'stored_blocks': stored,
+        'bytes': os.path.getsize(raster_path) + os.path.getsize(get_raster_index_path(raster_path)),
+    }
+
+
+def get_raster_table_path(raster_path):
+    return os.path.splitext(raster_path)[0] + ".json"
+
+
+def get_raster_index_path(raster_path):
+    return os.path.splitext(raster_path)[0] + "_index.npy"
+
+
+def load_lp_raster(raster_path=LP_RASTER_PATH):
+    """Memory-map the compiled light pollution raster, if one has been compiled.
+
+    args: path to raster made by compile_lp_raster
+    returns: dict with the mapped raster and its ratio table, None if no raster is available
+    """
+    global _lp_raster, _lp_raster_loaded
 
+    _lp_raster_loaded = True
     try:
-        image_path = os.path.join(tiles_dir_path, image_name)
-        # print( "Trying to open image: %s" % image_path #TODO convert to logging)
-        image = Image.open(image_path)
-        # print( "Looking up pixel ({},{})".format(pixel_x, pixel_y) #TODO convert to logging)
-        rgb_img = image.convert("RGB")
-        pix = rgb_img.load()
-        pixel_value = pix[pixel_x, pixel_y]
-        light_poll_ratio = pixel_lightpoll_table[str(pixel_value)]
-        # print( image_name, pixel_value, light_poll_ratio)
-    except KeyError as e:
+        with open(get_raster_table_path(raster_path), 'r') as f:
+            table = json.load(f)
+        raster = np.load(raster_path, mmap_mode='r')
+        if 'block_size' in table:
+            index = np.load(get_raster_index_path(raster_path), mmap_mode='r')
+            raster = BlockRaster(raster, index, table['block_size'], table['shape'])
+        # else a dense raster compiled before blocks were added, mapped as is
+    except (IOError, ValueError):
+        _lp_raster = None
+        return None
+
+    _lp_raster = {
+        'raster': raster,
+        'tile_size': table['tile_size'],
+        'tile_y_min': table['tile_y_min'],
+        'ratios': table['ratios'],
+    }
+    return _lp_raster
+
+
+def get_lp_raster():
+    """Get the mapped light pollution raster, mapping it on first use.
+
+    returns: dict from load_lp_raster, or None if no raster is available
+    """
+    if not _lp_raster_loaded:
+        load_lp_raster()
+    return _lp_raster
+
+
+def lookup_lp_raster(lp_raster, i, j, pixel_x, pixel_y):
+    """Read the light pollution ratio for a tile pixel from the compiled raster
+
+    args: raster dict from load_lp_raster, tile i/j and pixel x/y from get_tile_pixel
+    returns: Double representation of light pollution levels, -1 for unknown color
+    """
+    raster = lp_raster['raster']
+    tile_size = lp_raster['tile_size']
+    row = (j - lp_raster['tile_y_min']) * tile_size + pixel_y
+    col = i * tile_size + pixel_x
+
+    if not (0 <= row < raster.shape[0] and 0 <= col < raster.shape[1]):
+        return 0  # No coverage, almost certainly in very remote area (near poles)
+
+    class_idx = int(raster[row, col])
+    if class_idx >= len(lp_raster['ratios']):
         print("Error, color does not match any known in key")
-        light_poll_ratio = -1
-    except IndexError as e:
-        print("Error: %s" % e)
-    except IOError as e:
-        light_poll_ratio = 0  # If no file exisits/no coverage, almost certainly in very remote area (near poles)
-        print("Error: There's no coverage for %s" % image_name)
-
-    return light_poll_ratio  # JsonResponse({'light_pollution': light_poll_ratio})
\ No newline at end of file
+        return -1
+    return lp_raster['ratios'][class_idx]
+
+
+def load_tile_classes(tile_key):
+    """Decode the PNG tile for tile coords (i, j), None if there is no such tile"""
+    image_path = os.path.join(TILES_DIR_PATH, "tile_6_%d_%d.png" % tile_key)
+    try:
+        return decode_tile_classes(image_path)
+    except IOError:
+        return None
+
+
+def get_tile_classes(i, j):
+    """Get the decoded class indices for a PNG tile, reusing recently decoded tiles.
+
+    args: tile i/j from get_tile_pixel
+    returns: uint8 numpy array of class indices indexed [pixel_y, pixel_x], None if no coverage
+    """
+    return tile_cache.get((i, j), load_tile_classes)
+
+
+def get_tile_cache_stats():
+    """Hit, miss and eviction counters for the decoded tile cache"""
+    return tile_cache.stats()
+
+
+def get_sat_cache_stats():
+    """Hit, miss and eviction counters for the summed-area table cache"""
+    return sat_cache.stats()
+
+
+def get_tile_class_window(i, j):
+    """Class indices of a whole tile, from the compiled raster if there is one, else the PNG tile
+
+    args: tile i/j
+    returns: tuple of (uint8 array indexed [pixel_y, pixel_x], list of class ratios), array None if no coverage
+    """
+    lp_raster = get_lp_raster()
+    if lp_raster is None:
+        return get_tile_classes(i, j), class_ratio_table
+
+    raster = lp_raster['raster']
+    tile_size = lp_raster['tile_size']
+    row = (j - lp_raster['tile_y_min']) * tile_size
+    col = i * tile_size
+    if not (0 <= row < raster.shape[0] and 0 <= col < raster.shape[1]):
+        return None, lp_raster['ratios']
+    return raster[row:row + tile_size, col:col + tile_size], lp_raster['ratios']
+
+
+def build_tile_sat(tile_key):
+    """Summed-area tables of a tile's light pollution ratios and of its known pixels.
+
+    sat[0, y, x] is the sum of ratios over pixels [0:y, 0:x] and sat[1, y, x] the number of
+    them with a known color, so any rectangle's sum and count take four lookups.
+
+    args: tile key (i, j)
+    returns: float64 array of shape (2, TILE_SIZE + 1, TILE_SIZE + 1), None if no coverage
+    """
+    classes, ratios = get_tile_class_window(*tile_key)
+    if classes is None:
+        return None
+
+    ratio_lookup = np.zeros(256, dtype=np.float64)
+    ratio_lookup[:len(ratios)] = ratios
+    known_lookup = np.zeros(256, dtype=np.float64)
+    known_lookup[:len(ratios)] = 1
+
+    classes = np.asarray(classes)
+    sat = np.zeros((2, classes.shape[0] + 1, classes.shape[1] + 1), dtype=np.float64)
+    sat[0, 1:, 1:] = ratio_lookup[classes].cumsum(axis=0).cumsum(axis=1)
+    sat[1, 1:, 1:] = known_lookup[classes].cumsum(axis=0).cumsum(axis=1)
+    return sat
+
+
+def get_tile_sat(i, j):
+    """Get the summed-area tables for a tile, reusing recently built ones"""
+    return sat_cache.get((i, j), build_tile_sat)
+
+
+def get_light_pollution_area(lat, lng, radius_km, with_max=False):
+    """Mean (and optionally max) Light Pollution level in the square of pixels within radius_km
+    of the location, so a site's rating isn't decided by the single pixel it falls in.
+
+    The mean takes four summed-area table lookups per tile the window overlaps (windows
+    crossing tile edges are split per tile), the max scans the window's class indices.
+    Pixels of unknown color are left out.
+
+    args: lat/lng for stargazing site, radius in km (up to LP_MAX_AREA_RADIUS_KM), whether to find the max
+    returns: tuple of (mean, max or None), 0 with no coverage and -1 if no pixel has a known color
+    """
+    if not (math.isfinite(lat) and math.isfinite(lng)):
+        return 0, (0 if with_max else None)
+    radius_km = min(max(radius_km, 0), LP_MAX_AREA_RADIUS_KM)
+    lat = min(max(lat, -LP_MAX_LAT), LP_MAX_LAT)
+    x, y = get_lat_lng_tile(lat, lng, LP_ZOOM)
+    center_x, center_y = x * TILE_SIZE, y * TILE_SIZE
+
+    # Mercator pixels are square, their size shrinks with cos(lat)
+    pixel_km = 2 * math.pi * EARTH_RADIUS_KM * math.cos(math.radians(lat)) / (2**LP_ZOOM * TILE_SIZE)
+    radius_px = min(radius_km / pixel_km, LP_MAX_AREA_RADIUS_PX)
+    x_min, x_max = int(math.floor(center_x - radius_px)), int(math.floor(center_x + radius_px)) + 1
+    y_min, y_max = int(math.floor(center_y - radius_px)), int(math.floor(center_y + radius_px)) + 1
+
+    total = 0.0
+    known = 0
+    covered = False
+    max_class = -1
+    # Only the tile rows there is coverage for, windows past the raster's edge (near the poles) read nothing
+    for j in range(max(y_min // TILE_SIZE, TILE_Y_MIN), min((y_max - 1) // TILE_SIZE + 1, TILE_Y_MIN + TILE_Y_COUNT)):
+        for i in range(x_min // TILE_SIZE, (x_max - 1) // TILE_SIZE + 1):
+            tile_i = i % TILE_X_COUNT  # Windows wrap around the antimeridian
+            sat = get_tile_sat(tile_i, j)
+            if sat is None:
+                continue
+            covered = True
+
+            row_0, row_1 = max(y_min - j * TILE_SIZE, 0), min(y_max - j * TILE_SIZE, TILE_SIZE)
+            col_0, col_1 = max(x_min - i * TILE_SIZE, 0), min(x_max - i * TILE_SIZE, TILE_SIZE)
+            window = sat[:, row_1, col_1] - sat[:, row_0, col_1] - sat[:, row_1, col_0] + sat[:, row_0, col_0]
+            total += window[0]
+            known += int(round(window[1]))
+
+            if with_max:
+                classes, ratios = get_tile_class_window(tile_i, j)
+                classes = np.asarray(classes[row_0:row_1, col_0:col_1])
+                classes = classes[classes < len(ratios)]
+                if classes.size:
+                    max_class = max(max_class, int(classes.max()))
+
+    if not covered:
+        return 0, (0 if with_max else None)
+    if not known:
+        return -1, (-1 if with_max else None)
+
+    ratios = get_lp_raster()['ratios'] if get_lp_raster() is not None else class_ratio_table
+    return round(total / known, 4), (ratios[max_class] if with_max else None)
+
+
+def get_light_pollution_area_batch(lats, lngs, radius_km, with_max=False):
+    """Mean (and optionally max) Light Pollution levels around many locations.
+
+    Points are taken tile by tile, so each tile's summed-area table is built (or paged back
+    into the LRU) once per batch however the points are ordered.
+
+    args: sequences of lat/lng for stargazing sites, radius in km, whether to find the max
+    returns: list of (mean, max or None) tuples as from get_light_pollution_area, in the same order
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    x, y = get_lat_lng_tiles(np.clip(lats, -LP_MAX_LAT, LP_MAX_LAT), lngs, LP_ZOOM)
+    order = np.lexsort((np.floor(x), np.floor(y)))
+
+    areas = [None] * len(lats)
+    for idx in order:
+        areas[idx] = get_light_pollution_area(float(lats[idx]), float(lngs[idx]), radius_km, with_max)
+    return areas
+
+
+def get_light_pollution(lat, lng):
+    """Gets the Light Pollution level for the location chosen.
+
+    Reads from the compiled raster when available, otherwise from the (cached) PNG tile.
+
+    args: lat/lng for stargazing site
+    returns: Double representation of light pollution levels
+    """
+    i, j, pixel_x, pixel_y = get_tile_pixel(lat, lng)
+
+    lp_raster = get_lp_raster()
+    if lp_raster is not None:
+        return lookup_lp_raster(lp_raster, i, j, pixel_x, pixel_y)
+
+    tile = get_tile_classes(i, j)
+    if tile is None:
+        # If no file exisits/no coverage, almost certainly in very remote area (near poles)
+        print("Error: There's no coverage for tile_6_%d_%d.png" % (i, j))
+        return 0
+
+    class_idx = int(tile[pixel_y, pixel_x])
+    if class_idx == NO_DATA_INDEX:
+        print("Error, color does not match any known in key")
+        return -1
+
+    return class_ratio_table[class_idx]
+
+
+def get_light_pollution_batch(lats, lngs):
+    """Gets the Light Pollution levels for many locations at once.
+
+    Points are projected together and grouped by tile, so each tile is read only once.
+
+    args: sequences of lat/lng for stargazing sites
+    returns: numpy float array of light pollution levels, -1 for unknown colors
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+
+    x, y = get_lat_lng_tiles(lats, lngs, LP_ZOOM)
+    tile_i = np.floor(x).astype(np.int64)
+    tile_j = np.floor(y).astype(np.int64)
+    pixel_x = np.clip((x % 1) * TILE_SIZE, 0, TILE_SIZE - 1).astype(np.int64)
+    pixel_y = np.clip((y % 1) * TILE_SIZE, 0, TILE_SIZE - 1).astype(np.int64)
+
+    # Points with no coverage (near poles) stay at 0
+    classes = np.zeros(lats.shape, dtype=np.uint8)
+
+    lp_raster = get_lp_raster()
+    if lp_raster is not None:
+        raster = lp_raster['raster']
+        tile_size = lp_raster['tile_size']
+        rows = (tile_j - lp_raster['tile_y_min']) * tile_size + pixel_y
+        cols = tile_i * tile_size + pixel_x
+        covered = (rows >= 0) & (rows < raster.shape[0]) & (cols >= 0) & (cols < raster.shape[1])
+        classes[covered] = raster[rows[covered], cols[covered]]
+        ratios = lp_raster['ratios']
+    else:
+        tile_keys = np.stack([tile_i, tile_j], axis=-1).reshape(-1, 2)
+        flat_classes = classes.reshape(-1)
+        flat_x = pixel_x.reshape(-1)
+        flat_y = pixel_y.reshape(-1)
+        unique_keys, tile_idx = np.unique(tile_keys, axis=0, return_inverse=True)
+        tile_idx = tile_idx.reshape(-1)
+        for idx, (i, j) in enumerate(unique_keys):
+            tile = get_tile_classes(int(i), int(j))
+            if tile is None:
+                continue
+            in_tile = tile_idx == idx
+            flat_classes[in_tile] = tile[flat_y[in_tile], flat_x[in_tile]]
+        ratios = class_ratio_table
+
+    ratio_lookup = np.full(256, -1, dtype=np.float64)
+    ratio_lookup[:len(ratios)] = ratios
+    return ratio_lookup[classes]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile lp_tiles PNGs into a memory-mappable raster")
+    parser.add_argument('--tiles', default=TILES_DIR_PATH, help="directory of tile_6_x_y.png files")
+    parser.add_argument('--out', default=LP_RASTER_PATH, help="path of compiled .npy raster")
+    args = parser.parse_args()
+
+    sizes = compile_lp_raster(args.tiles, args.out)
+    print("Compiled light pollution raster to %s: %d of %d blocks stored, %.0f MB" % (
+        args.out, sizes['stored_blocks'], sizes['blocks'], sizes['bytes'] / 1e6))
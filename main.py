@@ -7,53 +7,148 @@ import pprint
 import requests
 import time as t
 
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from datetime import datetime as dt
 
 import flask
+import numpy as np
 
 from helpers import (
     get_current_unix_time,
-    convert_YMDHMS_to_unix
 )
 
 import apis as apis
+import cache
+import dark_sites
+import elevation_store
+import ephemeris
+import light_pollution
+import metrics
+import nearest_csc
+import prewarm
+import shared_cache
+import upstream
 
 app = flask.Flask(__name__)
 
 SECONDS_IN_DAY = 86400
+# Hourly data in a DarkSky forecast request (48 hours, 168 with extend=hourly), less the
+# age a cached forecast can reach (see prewarm)
+FORECAST_HOURLY_S = 46 * 3600
+EXTENDED_HOURLY_S = 166 * 3600
+MAX_BATCH_POINTS = 1000
+MAX_AREA_BATCH_POINTS = 100  # Each area mean reads up to four tiles, far more than a single pixel
+MAX_CSC_COUNT = 25
+MAX_DISTANCE_SITES = 100
+MAX_DARK_SITES = 25
+MAX_BATCH_SITES = 50
+MAX_OUTLOOK_NIGHTS = 8
+
+# Overall time budget for a report, and for each of its sections (seconds)
+REPORT_DEADLINE_S = float(os.environ.get('REPORT_DEADLINE_S', 8))
+SECTION_TIMEOUTS_S = {
+    'weather': float(os.environ.get('WEATHER_TIMEOUT_S', 6)),
+    'elevation': float(os.environ.get('ELEVATION_TIMEOUT_S', 3)),
+    'lightPol': float(os.environ.get('LIGHT_POLLUTION_TIMEOUT_S', 3)),
+    'drivingDistance': float(os.environ.get('DISTANCE_TIMEOUT_S', 4)),
+    'CDSChart': float(os.environ.get('CSC_TIMEOUT_S', 2)),
+    'timeline': float(os.environ.get('TIMELINE_TIMEOUT_S', 6)),
+}
+# Distance Matrix element statuses meaning there is no driving route, anything else without a
+# duration means the lookup itself failed
+NO_ROUTE_ELEMENT_STATUSES = ("ZERO_RESULTS", "NOT_FOUND")
+NO_ROUTE_STATUS = "Error: No route found to destination"
+DISTANCE_UNAVAILABLE_STATUS = "Error: Driving distance unavailable, try again"
+INVALID_LAT_LNG_STATUS = "Error: lat must be between -90 and 90, lng between -180 and 180"
+
+# Sections a report can do without, skipped while the quota of the upstream they call runs low
+# (CDSChart is served from the local CSC dataset, so it never needs skipping)
+OPTIONAL_SECTION_UPSTREAMS = {
+    'drivingDistance': 'gmaps_distance',
+}
+SKIPPED_SECTIONS = {
+    'drivingDistance': {'status': "Error: Driving distance skipped, try again later"},
+}
+
+# Shared by all requests, each report uses up to one thread per section
+report_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('REPORT_WORKERS', 32)))
+
+# Set once warm_up has loaded the shared data files
+warm_up_status = {'ready': False}
+
+
+def warm_up():
+    """Load shared data (CSC sites, light pollution raster/pyramid, DEM) before serving.
+
+    Run in the server's master process before forking workers, so the loaded data and
+    mapped pages are shared copy-on-write instead of being loaded lazily by each worker.
+    Only data files are loaded here, no threads, sockets or sqlite connections, which
+    must not be shared across a fork.
+
+    returns: dict describing what was loaded
+    """
+    started = t.monotonic()
+
+    csc_index = nearest_csc.get_csc_index()
+    lp_raster = light_pollution.get_lp_raster()
+    lp_pyramid = dark_sites.get_lp_pyramid()
+    dem = elevation_store.load_dem()
+
+    warm_up_status.update({
+        'ready': True,
+        'cscSites': len(csc_index),
+        'lightPolSource': "raster" if lp_raster is not None else "png tiles",
+        'darkestSitesSearch': lp_pyramid is not None,
+        'elevationDEM': dem is not None,
+        'warmUpSeconds': round(t.monotonic() - started, 3),
+    })
+    return warm_up_status
+
+
+def start_background_tasks():
+    """Start per-process background threads (forecast pre-warming).
+
+    Run in each worker after forking, never in the preloading master.
+    """
+    prewarm.start_scheduler(get_darkness_times)
 
 
 def get_darkness_times(lat_selected, lng_selected, time):
-    """Call API Handler for sunrise/sunset, process input and response. 
+    """Calculate the times it is dark enough to stargaze around the given time.
 
-    Uses sunset/rise times to calculate what times it is dark enough to stargaze
-    on current day. Estimates times for following and previous days.
+    Uses the local solar ephemeris to find nautical twilight for the previous, current
+    and following days (UTC dates, anchored on local solar noon).
 
-    args: String representing lat/lng coords
+    args: lat/lng coords, unix time
     returns: Dict times, each a int of 10-digit Unix Time (integer seconds)
     """
-    sunset_data = apis.sunrise_sunset_time(lat_selected, lng_selected, time)
-
     # start of astronomical twilight is good enough to begin stargazing
     # Nautical Twilight End = Start of Astronomical Twilight and vice-versa
-    morning_stagazing_ends = sunset_data['results']['nautical_twilight_begin']
-    night_stagazing_begins = sunset_data['results']['nautical_twilight_end']
-
-    morning_stagazing_ends_unix = convert_YMDHMS_to_unix(morning_stagazing_ends)
-    night_stagazing_begins_unix = convert_YMDHMS_to_unix(night_stagazing_begins)
+    twilight = ephemeris.get_twilight_windows(lat_selected, lng_selected, time, 3, day_offset=-1)
+    dawns = twilight['dawn']
+    dusks = twilight['dusk']
 
     # Midnight Sun, never dark
-    if morning_stagazing_ends_unix == 1 or morning_stagazing_ends_unix == 1:
+    if twilight['status'][1] == ephemeris.SUN_ALWAYS_UP:
         return {'sun_status': 'Midnight Sun'}
     # Polar Night, always dark
-    if morning_stagazing_ends_unix == 0 or night_stagazing_begins_unix == 0:
+    if twilight['status'][1] == ephemeris.SUN_ALWAYS_DOWN:
         return {'sun_status': 'Polar Night'}
 
-    # Approximations of times following days. Looses accuracy at very high latitudes near equinox
-    # Needed for TZ offsets since API always uses UTC, the times returned may be wrong day
+    morning_stagazing_ends_unix = int(dawns[1])
+    night_stagazing_begins_unix = int(dusks[1])
+
+    # Near the start or end of Midnight Sun/Polar Night the neighbouring days may have no
+    # twilight, fall back to shifting the current day's times
     prevday_stagazing_begin_unix = night_stagazing_begins_unix - SECONDS_IN_DAY
     nxtday_stagazing_ends_unix = morning_stagazing_ends_unix + SECONDS_IN_DAY
     nxtday_stagazing_begin_unix = night_stagazing_begins_unix + SECONDS_IN_DAY
+    if not np.isnan(dusks[0]):
+        prevday_stagazing_begin_unix = int(dusks[0])
+    if not np.isnan(dawns[2]):
+        nxtday_stagazing_ends_unix = int(dawns[2])
+    if not np.isnan(dusks[2]):
+        nxtday_stagazing_begin_unix = int(dusks[2])
 
     darkness_times = {
         'sun_status': 'Normal',
@@ -79,9 +174,8 @@ def set_time_to_dark(darkness_times, curr_time_unix):
     args: Unix times for current time, darkness start/end time
     returns: int of 10-digit Unix Time (integer seconds)
     """
-    # Must consider several cases because sunrise-sunset API processes all times as UTC, such that
-    # depending on the time zone of user, the darkness times returned may be given for the following day.
-    # This might be fixed by using user time zone from location, or passing TZ from client
+    # Darkness times are for the UTC days before, of and after the requested time, so depending on
+    # the site's time zone the request may fall before, in or after the "current" day's night
     if curr_time_unix <= darkness_times["prev_day_dusk"]:
         return darkness_times['prev_day_dusk']  # if before sunset, adjust time to after
     elif curr_time_unix <= darkness_times['curr_day_dawn']:
@@ -128,35 +222,138 @@ def calculate_lunar_phase(moon_phase):
 
 
 def get_weather_at_time(lat_selected, lng_selected, time=None):
-    """Call API Handler for CSC Chart, process input and response
+    """Get the DarkSky forecast for a site at a time, keeping just the fields the report uses
 
     args: lat/lng and time for stargazing site
-    returns: dictionary with just the weather data needed
+    returns: dictionary with the weather at that time from apis.Forecast.currently (fields DarkSky
+             left out are None) and moon phase; marked stale if it's an expired forecast
     """
-    # TODO: ONLY get data we need from API requests? Would be faster but requires
-    # a lot more params in url request used. Probably worth it in the long run
-    weather_data = apis.dark_sky(lat_selected, lng_selected, time)
+    forecast = apis.dark_sky(lat_selected, lng_selected, time)
 
-    if 'currently' not in weather_data:
+    if forecast.currently is None:
         return {'status': "Error: Weather Report Failed. Try again."}
 
-    precip_prob = weather_data['currently']['precipProbability']
-    humidity = weather_data['currently']['humidity']
-    visibility = weather_data['currently']['visibility']
-    cloud_cover = weather_data['currently']['cloudCover']
-    moon_phase = weather_data['daily']['data'][0]['moonPhase']  # 0 tells to grab todays phase. allows 0-7 for phases over next week
+    # Moon phase comes from the local ephemeris, so it is exact for the requested time
+    moon_phase = float(ephemeris.get_lunar_phase(time if time else get_current_unix_time())['phase'])
+
+    weather = {
+        'status': "Sucess",
+        'precipProb': forecast.currently.precip_prob,
+        'humidity': forecast.currently.humidity,
+        'visibility': forecast.currently.visibility,
+        'cloudCover': forecast.currently.cloud_cover,
+        'moonPhase': calculate_lunar_phase(moon_phase),
+    }
+
+    if forecast.stale:
+        weather['stale'] = True
+
+    return weather
 
 
+def get_hourly_weather(lat_selected, lng_selected, night_window, curr_time):
+    """Get the hourly forecast covering a dark period, for the timeline
+
+    A Time Machine request (one with a time) only has the hours of its local day, which would
+    cut the night off at midnight. Nights within the week come from the forecast request (from
+    now on, extended past 48 hours where needed), later ones from a Time Machine request for the
+    days the night starts and ends on, merged. Hours of a night in progress already past are
+    left out.
+
+    args: lat/lng for stargazing site, tuple of unix times for start/end of darkness, current unix time
+    returns: dictionary with the hourly weather (fields DarkSky left out are None), marked stale
+             if any of it is from an expired forecast
+    """
+    night_start, night_end = night_window
+    if curr_time < night_end <= curr_time + EXTENDED_HOURLY_S:
+        forecasts = [apis.dark_sky(lat_selected, lng_selected, None, ('hourly',),
+                                   extend_hourly=night_end > curr_time + FORECAST_HOURLY_S)]
+    else:
+        forecasts = [apis.dark_sky(lat_selected, lng_selected, time, ('hourly',)) for time in (night_start, night_end)]
+
+    hours = {hour.time: hour for forecast in forecasts for hour in forecast.hourly}
+    if not hours:
+        return {'status': "Error: Hourly forecast failed. Try again."}
+
+    weather = {
+        'status': "Sucess",
+        'hourly': [
+            {
+                'time': hour.time,
+                'precipProb': hour.precip_prob,
+                'humidity': hour.humidity,
+                'cloudCover': hour.cloud_cover,
+            }
+            for _, hour in sorted(hours.items())
+        ],
+    }
+
+    if any(forecast.stale for forecast in forecasts):
+        weather['stale'] = True
+
+    return weather
+
+
+def get_night_window(darkness_times, stargazing_time):
+    """Start and end of the dark period containing stargazing_time
+
+    args: darkness times from get_darkness_times, unix time once it is dark (from set_time_to_dark)
+    returns: tuple of unix times (start, end)
+    """
+    if darkness_times['sun_status'] != 'Normal':
+        # Polar Night, just look at the next half day
+        return (stargazing_time, stargazing_time + SECONDS_IN_DAY // 2)
+    if stargazing_time <= darkness_times['curr_day_dawn']:
+        return (darkness_times['prev_day_dusk'], darkness_times['curr_day_dawn'])
+    return (darkness_times['curr_day_dusk'], darkness_times['next_day_dawn'])
+
+
+def get_moon_data(lat_selected, lng_selected, stargazing_time, night_window):
+    """Get moon phase, position and rise/set times over the night from the local ephemeris
+
+    args: lat/lng for stargazing site, unix time, tuple of unix times for start/end of darkness
+    returns: dictionary with moon illumination, altitude now, rise/set times and hourly altitude
+    """
+    night_start, night_end = night_window
+    hours = np.arange(night_start, night_end, 3600, dtype=np.float64)
+    hourly_altitude = ephemeris.lunar_altitude(lat_selected, lng_selected, hours)
+    moon_times = ephemeris.get_moon_times(lat_selected, lng_selected, night_start, night_end)
+    phase = ephemeris.get_lunar_phase(stargazing_time)
+    altitude = float(ephemeris.lunar_altitude(lat_selected, lng_selected, stargazing_time))
+
     return {
         'status': "Sucess",
-        'precipProb': precip_prob,
-        'humidity': humidity,
-        'visibility': visibility,
-        'cloudCover': cloud_cover,
-        'moonPhase': calculate_lunar_phase(moon_phase),
+        'illumination': round(float(phase['illumination']) * 100),
+        'altitude': round(altitude, 1),
+        'moonUp': altitude > ephemeris.MOONRISE_ALT,
+        'moonrise': moon_times['rise'],
+        'moonset': moon_times['set'],
+        'hourlyAltitude': [
+            {'time': int(hour), 'altitude': round(float(alt), 1)} for hour, alt in zip(hours, hourly_altitude)
+        ],
     }
 
 
+def parse_distance_element(element):
+    """Pull driving distance and time out of a Distance Matrix element
+
+    args: one element of a Distance Matrix response row
+    returns: dictionary with distance in time and space, in km and human readable
+    """
+    if 'duration' in element:
+        return {
+            'status': "Sucess",
+            'duration_text': element['duration']['text'],
+            'duration_value': element['duration']['value'],
+            'distance_text': element['distance']['text'],
+            'distance_value': element['distance']['value'],
+        }
+    if element.get('status') in NO_ROUTE_ELEMENT_STATUSES:
+        return {'status': NO_ROUTE_STATUS}
+    # The request itself failed (e.g. OVER_QUERY_LIMIT), says nothing about the route
+    return {'status': DISTANCE_UNAVAILABLE_STATUS}
+
+
 def get_driving_distance(lat_origin, lng_origin, lat_selected, lng_selected):
     """Call API Handler for GMaps Distance Matrix, process input and response
 
@@ -171,18 +368,26 @@ def get_driving_distance(lat_origin, lng_origin, lat_selected, lng_selected):
 
     dist_data = apis.gmaps_distance(lat_origin, lng_origin, lat_selected, lng_selected)
 
-    if 'duration' in dist_data['rows'][0]['elements'][0]:
-        driving_distance = {
-            'status': "Sucess",
-            'duration_text': dist_data['rows'][0]['elements'][0]['duration']['text'],
-            'duration_value': dist_data['rows'][0]['elements'][0]['duration']['value'],
-            'distance_text': dist_data['rows'][0]['elements'][0]['distance']['text'],
-            'distance_value': dist_data['rows'][0]['elements'][0]['distance']['value'],
-        }
-    else:
-        driving_distance = {'status': "Error: No route found to destination"}
+    return parse_distance_element(dist_data['rows'][0]['elements'][0])
+
+
+def get_driving_distances(lat_origin, lng_origin, sites):
+    """Call API Handler for GMaps Distance Matrix once for many sites
+
+    args: lat/lng for origin, list of (lat, lng) for stargazing sites
+    returns: list of dictionaries with site lat/lng and distance, sorted by drive time
+             with unreachable sites last
+    """
+    elements = apis.gmaps_distance_matrix(lat_origin, lng_origin, sites)
+
+    driving_distances = []
+    for (lat, lng), element in zip(sites, elements):
+        driving_distance = parse_distance_element(element)
+        driving_distance['lat'] = lat
+        driving_distance['lng'] = lng
+        driving_distances.append(driving_distance)
 
-    return driving_distance
+    return sorted(driving_distances, key=lambda dist: dist.get('duration_value', float('inf')))
 
 
 def get_CS_chart(lat_selected, lng_selected, curr_time, stargazing_time):
@@ -199,20 +404,37 @@ def get_CS_chart(lat_selected, lng_selected, curr_time, stargazing_time):
     return cs_chart
 
 
+def get_site_light_pollution(lat, lng, radius_km=None):
+    """Light pollution at a site, or averaged over the area within radius_km of it
+
+    args: lat/lng, optional radius in km
+    returns: tuple of (light pollution to rate the site with, max within the radius or None)
+    """
+    if not radius_km:
+        return apis.light_pollution(float(lat), float(lng)), None
+    return apis.light_pollution_area(lat, lng, radius_km, with_max=True)
+
+
 def get_site_elevation(lat, lng):
-    """Call API Handler for GMaps Elevation, process input and response
+    """Look up site elevation in the elevation store, calling API Handler for GMaps Elevation on a miss
 
     args: lat/lng for stargazing site selcted
     returns: dictionary with elevation, distance in meters
     """
-    elev_data = apis.gmaps_elevation(lat, lng)
+    elevation = elevation_store.get_elevation(lat, lng)
+
+    if elevation is None:
+        elev_data = apis.gmaps_elevation(lat, lng)
+
+        if elev_data['status'] != "OK":
+            return 0 # Default to Sea Level if there is an error
 
-    if elev_data['status'] != "OK":
-        return 0 # Default to Sea Level if there is an error
+        elevation = elev_data['results'][0]['elevation']
+        elevation_store.put_elevation(lat, lng, elevation)
 
     # Dont use elevations below Sea Level
     # TODO: Differentiate between below ocean or just Death Valley, Dead Sea, etc...
-    return max(round(elev_data['results'][0]['elevation']),0)
+    return max(round(elevation),0)
 
 
 def site_rating_desciption(site_quality):
@@ -238,12 +460,20 @@ def site_rating_desciption(site_quality):
     return site_quality_discript
 
 
+def weather_percent(fraction):
+    """Forecast fraction (0 - 1) as a rounded percent, None if the forecast left it out"""
+    return round(fraction*100) if fraction is not None else None
+
+
 def calculate_rating(precipProbability, humidity, cloudCover, lightPol):
     """Calculate the stargazing quality based off weather, light pollution, etc.
 
-    args: site statistics, light pollution
+    args: site statistics (None if missing from the forecast), light pollution
     returns: float rating from 0 - 100, -1 for err
     """
+    if precipProbability is None or humidity is None or cloudCover is None:
+        return -1
+
     # TODO Equation for calulcating the rating needs some work.
     # 7 percent cloud cover and otherwise perfect conditions should not be a rating of 77, Fair.
 
@@ -267,89 +497,984 @@ def calculate_rating(precipProbability, humidity, cloudCover, lightPol):
     return site_quality_rating
 
 
-@app.route('/',  methods=['GET', 'POST'])
-def get_stargaze_report():
+def site_rating_desciptions(site_qualities):
+    """Vectorized site_rating_desciption
 
-    # lat_selected, lng_selected, lat_org=None, lng_org=None, time=None):
-    """get stargazing report based on given coordinates.
+    args: sequence of site qualities 0-100, -1 for err
+    returns: list of Strings describing site quality
+    """
+    site_qualities = np.asarray(site_qualities)
+    descriptions = np.select(
+        [site_qualities > 95, site_qualities > 90, site_qualities > 80, site_qualities > 50, site_qualities > 30, site_qualities >= 0],
+        ["Excellent", "Very Good", "Good", "Fair", "Poor", "Terrible"],
+        "Could Not Determine Stargazing Quality. Weather or Light Pollution Data unavailible")
+    return descriptions.tolist()
 
-    args:
-    lat_org/lng_org: gps coords of origin (user location) as float
-    lat_selected/lng_selected: gps coords of selected stargazing site as float
-    time: in unix int
 
-    returns: dictionary with data needed for API response/display in front end
+def calculate_ratings(precipProbability, humidity, cloudCover, lightPol):
+    """Vectorized calculate_rating over arrays of weather values (e.g. every hour of a night)
+
+    args: numpy arrays of site statistics (None/nan where missing from the forecast), light
+          pollution (float, or array of floats, -1 for err)
+    returns: numpy int array of ratings from 0 - 100, -1 for err
     """
-    lat_selected = flask.request.args.get('lat_selected', type = float)
-    lng_selected = flask.request.args.get('lng_selected', type = float)
-    lat_org = flask.request.args.get('lat_org', None, type = float)
-    lng_org = flask.request.args.get('lng_org', None, type = float)
-    stargazing_time = flask.request.args.get('time', None, type = float)
+    # None becomes nan, which rates as unavailable below
+    precipProbability = np.asarray(precipProbability, dtype=np.float64)
+    humidity = np.asarray(humidity, dtype=np.float64)
+    cloudCover = np.asarray(cloudCover, dtype=np.float64)
+    precip_quality = 1 - np.sqrt(precipProbability)
+    humid_quality = np.cbrt(1 - humidity)
+    cloud_quality = 1 - np.sqrt(cloudCover)
+
+    if lightPol is None:
+        lightPol = -1
+    lightPol = np.asarray(lightPol, dtype=np.float64)
+    lightpol_quality = np.abs(50 - lightPol) / 50
+
+    site_quality_rating = np.round(((((precip_quality * lightpol_quality * cloud_quality) * 8) + (humid_quality * 2)) / 10) * 100)
+    available = (lightPol >= 0) & ~(np.isnan(precipProbability) | np.isnan(humidity) | np.isnan(cloudCover))
+    return np.where(available, site_quality_rating, -1).astype(int)
+
+
+def get_timeline(hourly, night_window, light_pol, lat_selected, lng_selected):
+    """Rate every forecast hour inside the dark period and pick the best one
+
+    args: hourly weather from get_hourly_weather, tuple of unix times for start/end of darkness,
+          light pollution, lat/lng for stargazing site
+    returns: dictionary with the rating for each dark hour and the best hour
+    """
+    night_start, night_end = night_window
+    hours = [hour for hour in hourly if night_start <= hour['time'] <= night_end]
+
+    if not hours:
+        return {'status': "Error: No hourly forecast during darkness"}
+
+    times = np.array([hour['time'] for hour in hours], dtype=np.float64)
+    ratings = calculate_ratings(
+        [hour['precipProb'] for hour in hours],
+        [hour['humidity'] for hour in hours],
+        [hour['cloudCover'] for hour in hours],
+        light_pol if light_pol is not None else -1)
+    moon_altitudes = ephemeris.lunar_altitude(lat_selected, lng_selected, times)
+
+    timeline = [
+        {
+            'time': hour['time'],
+            'siteQuality': int(rating),
+            'siteQualityDiscript': site_rating_desciption(rating),
+            'precipProb': hour['precipProb'],
+            'humidity': weather_percent(hour['humidity']),
+            'cloudCover': weather_percent(hour['cloudCover']),
+            'moonAltitude': round(float(moon_altitude), 1),
+        }
+        for hour, rating, moon_altitude in zip(hours, ratings, moon_altitudes)
+    ]
 
-    response_data = {}
+    return {
+        'status': "Sucess",
+        'hours': timeline,
+        'bestHour': timeline[int(np.argmax(ratings))],
+    }
 
-    curr_time = get_current_unix_time()
 
-    if not lat_selected or not lng_selected:
-        raise ValueError("Missing lat/lng parameters")
+def get_night_windows(lat_selected, lng_selected, curr_time, nights):
+    """Dark periods of the coming nights, with twilight for all of them computed at once
+
+    args: lat/lng coords, current unix time, number of nights
+    returns: list of dicts with the night's 'sun_status' and its 'start'/'end' unix times
+             (None in the land of the midnight sun), starting with tonight (or the current night)
+    """
+    twilight = ephemeris.get_twilight_windows(lat_selected, lng_selected, curr_time, nights + 2, day_offset=-1)
+    dawns = twilight['dawn']
+    dusks = twilight['dusk']
+
+    windows = []
+    for day in range(nights + 1):
+        day_start = int(twilight['day_starts'][day])
+        if twilight['status'][day] == ephemeris.SUN_ALWAYS_UP:
+            windows.append({'sun_status': 'Midnight Sun', 'start': None, 'end': None, 'day_start': day_start})
+            continue
+        if twilight['status'][day] == ephemeris.SUN_ALWAYS_DOWN:
+            windows.append({'sun_status': 'Polar Night', 'start': day_start, 'end': day_start + SECONDS_IN_DAY})
+            continue
+
+        start = int(dusks[day])
+        # Next morning may have no twilight near the start/end of Polar Night, shift this morning's
+        if not np.isnan(dawns[day + 1]):
+            end = int(dawns[day + 1])
+        elif not np.isnan(dawns[day]):
+            end = int(dawns[day]) + SECONDS_IN_DAY
+        else:
+            end = day_start + 2 * SECONDS_IN_DAY
+        windows.append({'sun_status': 'Normal', 'start': start, 'end': end})
+
+    # Drop nights already over, the first left is tonight (or the night in progress)
+    windows = [window for window in windows
+               if (window['end'] if window['end'] is not None else window['day_start'] + SECONDS_IN_DAY) > curr_time]
+    return windows[:nights]
+
+
+def rate_nights(night_windows, forecast, light_pol):
+    """Rate each night from one forecast, by its best dark hour where there is hourly data,
+    else by the day's daily summary
+
+    args: list of night windows from get_night_windows, apis.Forecast with hourly and daily
+          data, light pollution
+    returns: list of dicts with the rating of each night, in the same order
+    """
+    light_pol = light_pol if light_pol is not None else -1
+
+    # All hours of the forecast rated at once, each night then picks from its own hours
+    hour_times = np.array([hour.time for hour in forecast.hourly], dtype=np.float64)
+    hour_ratings = calculate_ratings(
+        [hour.precip_prob for hour in forecast.hourly],
+        [hour.humidity for hour in forecast.hourly],
+        [hour.cloud_cover for hour in forecast.hourly],
+        light_pol)
+    day_ratings = calculate_ratings(
+        [day.precip_prob for day in forecast.daily],
+        [day.humidity for day in forecast.daily],
+        [day.cloud_cover for day in forecast.daily],
+        light_pol)
+
+    mid_nights = np.array([(window['start'] + window['end']) / 2 if window['start'] is not None else window['day_start']
+                           for window in night_windows], dtype=np.float64)
+    illuminations = ephemeris.get_lunar_phase(mid_nights)['illumination'] if len(mid_nights) else []
+
+    nights = []
+    for window, illumination in zip(night_windows, illuminations):
+        if window['sun_status'] == 'Midnight Sun':
+            nights.append({
+                'status': "Error: One cannot stargaze in the land of the midnight sun. Try going closer to the equator!",
+                'nightStart': None,
+                'nightEnd': None,
+            })
+            continue
+
+        night = {
+            'nightStart': window['start'],
+            'nightEnd': window['end'],
+            'moonIllumination': round(float(illumination) * 100),
+        }
+
+        in_night = np.nonzero((hour_times >= window['start']) & (hour_times <= window['end']))[0]
+        if len(in_night):
+            best = in_night[int(np.argmax(hour_ratings[in_night]))]
+            weather, rating, source = forecast.hourly[best], hour_ratings[best], "hourly"
+            night['bestHour'] = weather.time
+        else:
+            # Daily data points start at local midnight of the day the night begins
+            days = [idx for idx, day in enumerate(forecast.daily)
+                    if day.time <= window['start'] < day.time + SECONDS_IN_DAY]
+            if not days:
+                night['status'] = "Error: No forecast for this night"
+                nights.append(night)
+                continue
+            weather, rating, source = forecast.daily[days[0]], day_ratings[days[0]], "daily"
+
+        night.update({
+            'status': "Sucess",
+            'forecast': source,
+            'siteQuality': int(rating),
+            'siteQualityDiscript': site_rating_desciption(rating),
+            'precipProb': weather.precip_prob,
+            'humidity': weather_percent(weather.humidity),
+            'cloudCover': weather_percent(weather.cloud_cover),
+        })
+        nights.append(night)
+
+    return nights
+
+
+def skip_optional_sections(sections):
+    """Optional sections to leave out of a report because their upstream's quota is running low
+
+    args: names of sections the report would include
+    returns: set of section names to skip
+    """
+    skipped = set()
+    for section in sections:
+        name = OPTIONAL_SECTION_UPSTREAMS.get(section)
+        if name is not None and upstream.quota_low(name):
+            metrics.metrics.count_error('stages', section, "skipped")
+            skipped.add(section)
+    return skipped
+
+
+def submit_section(timeout_s, started, deadline, fn, *args):
+    """Run a section of the report on the report executor, with its upstream calls bounded
+    by the section's timeout and the report deadline so they stop once it is given up on
+
+    args: per-section timeout in seconds, monotonic time the section is dispatched, monotonic
+          deadline for the whole report, function and args computing the section
+    returns: future of the section
+    """
+    return report_executor.submit(upstream.call_with_deadline, min(started + timeout_s, deadline), fn, *args)
+
+
+def collect_section(future, timeout_s, started, deadline, default):
+    """Wait for a section of the report, giving up at its timeout or the report deadline.
+
+    args: future of the section, per-section timeout in seconds, monotonic time the section
+          was dispatched, monotonic deadline for the whole report, value to use if it fails
+    returns: tuple of the section result (or default) and its status: "ok", "timeout" or "error"
+    """
+    remaining = min(started + timeout_s, deadline) - t.monotonic()
+    try:
+        return future.result(timeout=max(remaining, 0)), "ok"
+    except FuturesTimeoutError:
+        # Only stops a section still queued, a running one stops at its upstream call deadline
+        future.cancel()
+        print("Error: Report section timed out after %.1fs" % (t.monotonic() - started))
+        return default, "timeout"
+    except Exception as e:
+        print("Error: Report section failed: %s" % e)
+        return default, "error"
+
+
+def build_stargaze_report(lat_selected, lng_selected, lat_org=None, lng_org=None, stargazing_time=None, timeline=False,
+                          lp_radius_km=None, timings=None):
+    """Build the stargazing report for a site.
+
+    Weather, elevation, light pollution, driving distance and CSC are independent of each
+    other, so they are dispatched concurrently. Each has its own timeout and the whole report
+    has a deadline; sections that miss it are left out and marked in 'sections'. Optional
+    sections are skipped while their upstream quota is low, and weather served from an
+    expired forecast to save quota is marked stale.
+
+    args: lat/lng of stargazing site, lat/lng of origin (user location), time in unix int,
+          whether to add a timeline rating each dark hour of the hourly forecast,
+          radius in km to average light pollution over (None for just the site's pixel),
+          metrics.StageTimings to record how long each stage took in
+    returns: dictionary with data needed for API response/display in front end
+    """
+    curr_time = get_current_unix_time()
+    if timings is None:
+        timings = metrics.StageTimings()
 
     if not stargazing_time:
         stargazing_time = curr_time
 
     # Disallow requests for stargazing more than 8 days in future, or 1 day in past
     if stargazing_time > curr_time + SECONDS_IN_DAY * 8:
-        response_data = {'status': "Error: Reports are only availible for the next week"}
+        return {'status': "Error: Reports are only availible for the next week"}
     if stargazing_time < curr_time - SECONDS_IN_DAY:
-        response_data = {'status': "Error: Reports for previous days not supported"}
+        return {'status': "Error: Reports for previous days not supported"}
 
     # Determine what times it gets dark on a given day, if it is not dark at requested stargazing time, set time to once it gets dark
     # Account for 24+ hr long days and nights in the arctice and anarctice
-    darkness_times = get_darkness_times(lat_selected, lng_selected, stargazing_time)
-    if darkness_times['sun_status'] == 'Midnight Sun':
-        response_data = {'status': "Error: One cannot stargaze in the land of the midnight sun. Try going closer to the equator!"}
-    elif darkness_times['sun_status'] == 'Polar Night':
-        stargazing_time = curr_time
-    else:
-        # TODO User-facing message that time was changed to ___ (w/ TZ adjust!)
-        stargazing_time = set_time_to_dark(darkness_times, stargazing_time)
+    with timings.stage('darkness'):
+        darkness_times = get_darkness_times(lat_selected, lng_selected, stargazing_time)
+        if darkness_times['sun_status'] == 'Midnight Sun':
+            return {'status': "Error: One cannot stargaze in the land of the midnight sun. Try going closer to the equator!"}
+        elif darkness_times['sun_status'] == 'Polar Night':
+            stargazing_time = curr_time
+        else:
+            # TODO User-facing message that time was changed to ___ (w/ TZ adjust!)
+            stargazing_time = set_time_to_dark(darkness_times, stargazing_time)
+        night_window = get_night_window(darkness_times, stargazing_time)
+
+    section_calls = {
+        'weather': (get_weather_at_time, lat_selected, lng_selected, stargazing_time),
+        'elevation': (get_site_elevation, lat_selected, lng_selected),
+        'lightPol': (get_site_light_pollution, lat_selected, lng_selected, lp_radius_km),
+        'drivingDistance': (get_driving_distance, lat_org, lng_org, lat_selected, lng_selected),
+        'CDSChart': (get_CS_chart, lat_selected, lng_selected, curr_time, stargazing_time),
+    }
+    if timeline:
+        section_calls['timeline'] = (get_hourly_weather, lat_selected, lng_selected, night_window, curr_time)
+    defaults = {
+        'weather': {'status': "Error: Weather Report Failed. Try again."},
+        'elevation': None,
+        'lightPol': (None, None),
+        'drivingDistance': {'status': DISTANCE_UNAVAILABLE_STATUS},
+        'CDSChart': {'status': "Error: CSC unavailable, try again"},
+        'timeline': {'status': "Error: Hourly forecast failed. Try again."},
+    }
+
+    results = {}
+    sections = {}
+    # Without an origin there is no driving distance to look up, nothing to save by skipping it
+    candidates = [section for section in section_calls if section != 'drivingDistance' or lat_org is not None]
+    for section in skip_optional_sections(candidates):
+        del section_calls[section]
+        results[section], sections[section] = dict(SKIPPED_SECTIONS[section]), "skipped"
+
+    started = t.monotonic()
+    deadline = started + REPORT_DEADLINE_S
+    futures = {
+        section: submit_section(SECTION_TIMEOUTS_S[section], started, deadline, timings.call, section, *call)
+        for section, call in section_calls.items()
+    }
 
-    weather_data = get_weather_at_time(lat_selected, lng_selected, stargazing_time)
-    
+    for section, future in futures.items():
+        results[section], sections[section] = collect_section(
+            future, SECTION_TIMEOUTS_S[section], started, deadline, defaults[section])
+        if sections[section] == "timeout":
+            metrics.metrics.count_error('stages', section, "timeout")
+
+    weather_data = results['weather']
+    if weather_data.pop('stale', False):
+        sections['weather'] = "stale"
     if weather_data["status"] != "Sucess":
-        response_data = weather_data
-
-    if not response_data:
-        precip_prob = weather_data['precipProb']
-        humidity = weather_data['humidity']
-        cloud_cover = weather_data['cloudCover']
-        lunar_phase = weather_data['moonPhase']
-        elevation = get_site_elevation(lat_selected, lng_selected)
-        light_pol = apis.light_pollution(float(lat_selected), float(lng_selected))
+        response_data = dict(weather_data)
+        response_data['sections'] = sections
+        return response_data
+
+    precip_prob = weather_data['precipProb']
+    humidity = weather_data['humidity']
+    cloud_cover = weather_data['cloudCover']
+    lunar_phase = weather_data['moonPhase']
+    light_pol, light_pol_max = results['lightPol']
+    with timings.stage('rating'):
         site_quality = calculate_rating(precip_prob, humidity, cloud_cover, light_pol)
         site_quality_discript = site_rating_desciption(site_quality)
+    with timings.stage('moon'):
+        moon = get_moon_data(lat_selected, lng_selected, stargazing_time, night_window)
+
+    response_data = {
+        'status': "Success!",
+        'siteQuality': site_quality,
+        'siteQualityDiscript': site_quality_discript,
+        'precipProb': precip_prob,
+        'humidity': weather_percent(humidity),
+        'cloudCover': weather_percent(cloud_cover),
+        'lightPol': light_pol,
+        'elevation': results['elevation'],
+        'lunarphase': lunar_phase,
+        'moon': moon,
+        'drivingDistance': results['drivingDistance'],
+        'CDSChart': results['CDSChart'],
+        'sections': sections,
+    }
+
+    if lp_radius_km:
+        # lightPol is the mean over the area, the site is rated with it
+        response_data['lightPolRadiusKm'] = lp_radius_km
+        response_data['lightPolMax'] = light_pol_max
+
+    if timeline:
+        hourly_data = results['timeline']
+        if hourly_data.pop('stale', False):
+            sections['timeline'] = "stale"
+        if hourly_data['status'] != "Sucess":
+            response_data['timeline'] = hourly_data
+        else:
+            with timings.stage('rating_timeline'):
+                response_data['timeline'] = get_timeline(hourly_data['hourly'], night_window, light_pol, lat_selected,
+                                                         lng_selected)
+
+    return response_data
+
+
+def build_batch_report(sites, lat_org=None, lng_org=None, stargazing_time=None):
+    """Build stargazing reports for many sites, sharing upstream work between them.
+
+    Sites in the same weather cache cell and hour share one weather request, light pollution
+    and CSC are looked up in one batch each, driving distances come from one Distance Matrix
+    call and ratings are computed together.
+
+    args: list of (lat, lng) of stargazing sites, lat/lng of origin (user location), time in unix int
+    returns: dictionary with a report for each site, in the same order
+    """
+    curr_time = get_current_unix_time()
 
-        driving_distance = get_driving_distance(lat_org, lng_org, lat_selected, lng_selected)
-        cs_chart = get_CS_chart(lat_selected, lng_selected, curr_time, stargazing_time)
+    if not stargazing_time:
+        stargazing_time = curr_time
 
-        response_data = {
+    # Disallow requests for stargazing more than 8 days in future, or 1 day in past
+    if stargazing_time > curr_time + SECONDS_IN_DAY * 8:
+        return {'status': "Error: Reports are only availible for the next week"}
+    if stargazing_time < curr_time - SECONDS_IN_DAY:
+        return {'status': "Error: Reports for previous days not supported"}
+
+    reports = [{} for _ in sites]
+    site_times = {}
+    night_windows = {}
+
+    # Sites sharing a cache cell share the darkness computation
+    darkness_by_cell = {}
+    for idx, (lat, lng) in enumerate(sites):
+        cell = cache.geohash(lat, lng)
+        if cell not in darkness_by_cell:
+            darkness_by_cell[cell] = get_darkness_times(lat, lng, stargazing_time)
+        darkness_times = darkness_by_cell[cell]
+
+        if darkness_times['sun_status'] == 'Midnight Sun':
+            reports[idx] = {'status': "Error: One cannot stargaze in the land of the midnight sun. Try going closer to the equator!"}
+            continue
+        elif darkness_times['sun_status'] == 'Polar Night':
+            site_times[idx] = curr_time
+        else:
+            site_times[idx] = set_time_to_dark(darkness_times, stargazing_time)
+        night_windows[idx] = get_night_window(darkness_times, site_times[idx])
+
+    started = t.monotonic()
+    deadline = started + REPORT_DEADLINE_S
+
+    # One weather request per weather cache cell and hour
+    weather_futures = {}
+    for idx, site_time in site_times.items():
+        lat, lng = sites[idx]
+        weather_key = cache.weather_key(lat, lng, site_time)
+        if weather_key not in weather_futures:
+            weather_futures[weather_key] = submit_section(
+                SECTION_TIMEOUTS_S['weather'], started, deadline, get_weather_at_time, lat, lng, site_time)
+    elevation_futures = {
+        idx: submit_section(SECTION_TIMEOUTS_S['elevation'], started, deadline, get_site_elevation, *sites[idx])
+        for idx in site_times
+    }
+    distance_future = None
+    skipped = skip_optional_sections(['drivingDistance']) if lat_org is not None and site_times else set()
+    if lat_org is not None and site_times and 'drivingDistance' not in skipped:
+        distance_future = submit_section(SECTION_TIMEOUTS_S['drivingDistance'], started, deadline,
+                                         get_driving_distances, lat_org, lng_org, [sites[idx] for idx in site_times])
+
+    lats = [lat for lat, _ in sites]
+    lngs = [lng for _, lng in sites]
+    light_pols = apis.light_pollution_batch(lats, lngs)
+    cs_charts = apis.nearest_csc_batch(lats, lngs)
+
+    weather_results = {}
+    for weather_key, future in weather_futures.items():
+        weather_results[weather_key], _ = collect_section(
+            future, SECTION_TIMEOUTS_S['weather'], started, deadline, {'status': "Error: Weather Report Failed. Try again."})
+
+    driving_distances = {}
+    if distance_future is not None:
+        distances, _ = collect_section(distance_future, SECTION_TIMEOUTS_S['drivingDistance'], started, deadline, [])
+        driving_distances = {(dist['lat'], dist['lng']): dist for dist in distances}
+
+    rated = []
+    for idx, site_time in site_times.items():
+        lat, lng = sites[idx]
+        weather_data = weather_results[cache.weather_key(lat, lng, site_time)]
+        if weather_data["status"] != "Sucess":
+            reports[idx] = dict(weather_data)
+            continue
+        rated.append((idx, weather_data))
+
+    ratings = calculate_ratings(
+        [weather_data['precipProb'] for _, weather_data in rated],
+        [weather_data['humidity'] for _, weather_data in rated],
+        [weather_data['cloudCover'] for _, weather_data in rated],
+        [light_pols[idx] for idx, _ in rated])
+    descriptions = site_rating_desciptions(ratings)
+
+    for (idx, weather_data), rating, description in zip(rated, ratings, descriptions):
+        lat, lng = sites[idx]
+        site_time = site_times[idx]
+        elevation, _ = collect_section(elevation_futures[idx], SECTION_TIMEOUTS_S['elevation'], started, deadline, None)
+
+        if lat_org is None:
+            driving_distance = {'status': "Error: No start location specified"}
+        elif 'drivingDistance' in skipped:
+            driving_distance = dict(SKIPPED_SECTIONS['drivingDistance'])
+        else:
+            driving_distance = driving_distances.get((lat, lng), {'status': DISTANCE_UNAVAILABLE_STATUS})
+
+        if site_time < curr_time + SECONDS_IN_DAY:
+            cs_chart = cs_charts[idx]
+        else:
+            cs_chart = {'status': "Error: CSC Reports only availible for next 24 hours!"}
+
+        reports[idx] = {
             'status': "Success!",
-            'siteQuality': site_quality,
-            'siteQualityDiscript': site_quality_discript,
-            'precipProb': precip_prob,
-            'humidity': round(humidity*100),
-            'cloudCover': round(cloud_cover*100),
-            'lightPol': light_pol,
+            'siteQuality': int(rating),
+            'siteQualityDiscript': description,
+            'precipProb': weather_data['precipProb'],
+            'humidity': weather_percent(weather_data['humidity']),
+            'cloudCover': weather_percent(weather_data['cloudCover']),
+            'lightPol': light_pols[idx],
             'elevation': elevation,
-            'lunarphase': lunar_phase,
+            'lunarphase': weather_data['moonPhase'],
+            'moon': get_moon_data(lat, lng, site_time, night_windows[idx]),
             'drivingDistance': driving_distance,
-            'CDSChart': cs_chart
+            'CDSChart': cs_chart,
         }
+        if weather_data.get('stale'):
+            reports[idx]['weatherStale'] = True
+
+    for report, (lat, lng) in zip(reports, sites):
+        report['lat'] = lat
+        report['lng'] = lng
+
+    return {
+        'status': "Success!",
+        'reports': reports,
+        'weatherRequests': len(weather_futures),
+    }
+
+
+def get_outlook_forecast(lat_selected, lng_selected):
+    """The forecast from now with a week of hourly data, and daily data past it
+
+    args: lat/lng for stargazing site
+    returns: apis.Forecast
+    """
+    return apis.dark_sky(lat_selected, lng_selected, None, ('hourly', 'daily'), refresh=False, extend_hourly=True)
+
+
+def build_outlook(lat_selected, lng_selected, nights=MAX_OUTLOOK_NIGHTS, lp_radius_km=None, timings=None):
+    """Build a rating for each of the coming nights at a site.
+
+    One forecast fetch (a week of hourly data) covers every night and twilight for all of
+    them is computed at once. Light pollution and elevation don't change night to night,
+    so they are looked up once, concurrently with the forecast.
+
+    args: lat/lng of stargazing site, number of nights, radius in km to average light pollution
+          over (None for just the site's pixel), metrics.StageTimings to record stages in
+    returns: dictionary with shared site data and a rating per night
+    """
+    curr_time = get_current_unix_time()
+    if timings is None:
+        timings = metrics.StageTimings()
+
+    started = t.monotonic()
+    deadline = started + REPORT_DEADLINE_S
+    futures = {
+        'weather': submit_section(SECTION_TIMEOUTS_S['weather'], started, deadline, timings.call, 'weather',
+                                  get_outlook_forecast, lat_selected, lng_selected),
+        'elevation': submit_section(SECTION_TIMEOUTS_S['elevation'], started, deadline, timings.call, 'elevation',
+                                    get_site_elevation, lat_selected, lng_selected),
+        'lightPol': submit_section(SECTION_TIMEOUTS_S['lightPol'], started, deadline, timings.call, 'lightPol',
+                                   get_site_light_pollution, lat_selected, lng_selected, lp_radius_km),
+    }
+    defaults = {
+        'weather': None,
+        'elevation': None,
+        'lightPol': (None, None),
+    }
+
+    with timings.stage('darkness'):
+        night_windows = get_night_windows(lat_selected, lng_selected, curr_time, nights)
+
+    results = {}
+    sections = {}
+    for section, future in futures.items():
+        results[section], sections[section] = collect_section(
+            future, SECTION_TIMEOUTS_S[section], started, deadline, defaults[section])
+        if sections[section] == "timeout":
+            metrics.metrics.count_error('stages', section, "timeout")
+
+    forecast = results['weather']
+    if forecast is None or not (forecast.hourly or forecast.daily):
+        return {'status': "Error: Weather Report Failed. Try again.", 'sections': sections}
+    if forecast.stale:
+        sections['weather'] = "stale"
+
+    light_pol, light_pol_max = results['lightPol']
+    with timings.stage('rating'):
+        night_ratings = rate_nights(night_windows, forecast, light_pol)
+
+    response_data = {
+        'status': "Success!",
+        'lightPol': light_pol,
+        'elevation': results['elevation'],
+        'nights': night_ratings,
+        'sections': sections,
+    }
+    if lp_radius_km:
+        response_data['lightPolRadiusKm'] = lp_radius_km
+        response_data['lightPolMax'] = light_pol_max
+
+    return response_data
+
+
+def valid_lat_lng(lat, lng):
+    """Whether lat/lng are coordinates on the globe (False for nan and inf too)"""
+    return -90 <= lat <= 90 and -180 <= lng <= 180
+
+
+@app.route('/',  methods=['GET', 'POST'])
+def get_stargaze_report():
+    """get stargazing report based on given coordinates.
+
+    args:
+    lat_org/lng_org: gps coords of origin (user location) as float
+    lat_selected/lng_selected: gps coords of selected stargazing site as float
+    time: in unix int
+    timeline: 1 to also rate every hour of the night and return the best one
+    lp_radius_km: optional, rate light pollution by its mean within this many km of the site
+
+    returns: dictionary with data needed for API response/display in front end
+    """
+    lat_selected = flask.request.args.get('lat_selected', type = float)
+    lng_selected = flask.request.args.get('lng_selected', type = float)
+    lat_org = flask.request.args.get('lat_org', None, type = float)
+    lng_org = flask.request.args.get('lng_org', None, type = float)
+    stargazing_time = flask.request.args.get('time', None, type = float)
+    timeline = flask.request.args.get('timeline', 0, type = int)
+    lp_radius_km = flask.request.args.get('lp_radius_km', None, type = float)
+
+    if not lat_selected or not lng_selected:
+        raise ValueError("Missing lat/lng parameters")
+    if not valid_lat_lng(lat_selected, lng_selected) or \
+            (lat_org is not None and lng_org is not None and not valid_lat_lng(lat_org, lng_org)):
+        return flask.jsonify({'status': INVALID_LAT_LNG_STATUS})
+
+    if lp_radius_km is not None and not 0 < lp_radius_km <= light_pollution.LP_MAX_AREA_RADIUS_KM:
+        return flask.jsonify({'status': "Error: lp_radius_km must be between 0 and %d" % light_pollution.LP_MAX_AREA_RADIUS_KM})
+
+    prewarm.hot_spots.record(lat_selected, lng_selected)
+    flask.g.timings = metrics.StageTimings()
+    response_data = build_stargaze_report(lat_selected, lng_selected, lat_org, lng_org, stargazing_time, bool(timeline),
+                                          lp_radius_km, flask.g.timings)
+
+    return flask.jsonify(response_data)
+
+
+@app.route('/batch_report', methods=['POST'])
+def get_batch_report():
+    """get stargazing reports for a list of sites in one request.
+
+    args (json body):
+    sites: list of {"lat": float, "lng": float}
+    origin: optional {"lat": float, "lng": float} of user location
+    time: optional, in unix int
+
+    returns: dictionary with a report for each site, in the same order as sites
+    """
+    request_data = flask.request.get_json(silent=True) or {}
+    sites = request_data.get('sites')
+    origin = request_data.get('origin')
+    stargazing_time = request_data.get('time')
+
+    if not isinstance(sites, list) or not sites:
+        return flask.jsonify({'status': "Error: Missing list of sites"})
+    if len(sites) > MAX_BATCH_SITES:
+        return flask.jsonify({'status': "Error: At most %d sites per request" % MAX_BATCH_SITES})
+
+    try:
+        sites = [(float(site['lat']), float(site['lng'])) for site in sites]
+        lat_org = float(origin['lat']) if origin else None
+        lng_org = float(origin['lng']) if origin else None
+        stargazing_time = float(stargazing_time) if stargazing_time else None
+    except (KeyError, TypeError, ValueError):
+        return flask.jsonify({'status': "Error: origin and each site need a lat and lng"})
+    if not all(valid_lat_lng(lat, lng) for lat, lng in sites) or \
+            (lat_org is not None and not valid_lat_lng(lat_org, lng_org)):
+        return flask.jsonify({'status': INVALID_LAT_LNG_STATUS})
+
+    for lat, lng in sites:
+        prewarm.hot_spots.record(lat, lng)
+    return flask.jsonify(build_batch_report(sites, lat_org, lng_org, stargazing_time))
+
+
+@app.route('/outlook', methods=['GET'])
+def get_outlook():
+    """get a stargazing rating for each of the coming nights at a site.
+
+    args:
+    lat_selected/lng_selected: gps coords of selected stargazing site as float
+    nights: optional, number of nights (up to 8)
+    lp_radius_km: optional, rate light pollution by its mean within this many km of the site
 
-    response = flask.jsonify(response_data)
+    returns: dictionary with a rating for each night, tonight first
+    """
+    lat_selected = flask.request.args.get('lat_selected', type = float)
+    lng_selected = flask.request.args.get('lng_selected', type = float)
+    nights = flask.request.args.get('nights', MAX_OUTLOOK_NIGHTS, type = int)
+    lp_radius_km = flask.request.args.get('lp_radius_km', None, type = float)
+
+    if lat_selected is None or lng_selected is None:
+        return flask.jsonify({'status': "Error: Missing lat/lng parameters"})
+    if not valid_lat_lng(lat_selected, lng_selected):
+        return flask.jsonify({'status': INVALID_LAT_LNG_STATUS})
+    if not 1 <= nights <= MAX_OUTLOOK_NIGHTS:
+        return flask.jsonify({'status': "Error: nights must be between 1 and %d" % MAX_OUTLOOK_NIGHTS})
+    if lp_radius_km is not None and not 0 < lp_radius_km <= light_pollution.LP_MAX_AREA_RADIUS_KM:
+        return flask.jsonify({'status': "Error: lp_radius_km must be between 0 and %d" % light_pollution.LP_MAX_AREA_RADIUS_KM})
+
+    flask.g.timings = metrics.StageTimings()
+    return flask.jsonify(build_outlook(lat_selected, lng_selected, nights, lp_radius_km, flask.g.timings))
+
+
+@app.route('/light_pollution', methods=['POST'])
+def get_light_pollution_batch():
+    """get light pollution levels for a list of points in one request.
+
+    args (json body):
+    points: list of {"lat": float, "lng": float}, up to 1000 (100 with radius_km)
+    radius_km: optional, give the mean (and max) within this many km of each point
+
+    returns: dictionary with light pollution levels in the same order as points
+    """
+    request_data = flask.request.get_json(silent=True) or {}
+    points = request_data.get('points')
+    radius_km = request_data.get('radius_km')
+
+    if not isinstance(points, list) or not points:
+        return flask.jsonify({'status': "Error: Missing list of points"})
+    if len(points) > MAX_BATCH_POINTS:
+        return flask.jsonify({'status': "Error: At most %d points per request" % MAX_BATCH_POINTS})
+
+    try:
+        lats = [float(point['lat']) for point in points]
+        lngs = [float(point['lng']) for point in points]
+    except (KeyError, TypeError, ValueError):
+        return flask.jsonify({'status': "Error: Each point needs a lat and lng"})
+    if not all(valid_lat_lng(lat, lng) for lat, lng in zip(lats, lngs)):
+        return flask.jsonify({'status': INVALID_LAT_LNG_STATUS})
+
+    if radius_km is None:
+        return flask.jsonify({
+            'status': "Success!",
+            'lightPol': apis.light_pollution_batch(lats, lngs),
+        })
+
+    if not isinstance(radius_km, (int, float)) or not 0 < radius_km <= light_pollution.LP_MAX_AREA_RADIUS_KM:
+        return flask.jsonify({'status': "Error: radius_km must be between 0 and %d" % light_pollution.LP_MAX_AREA_RADIUS_KM})
+    if len(points) > MAX_AREA_BATCH_POINTS:
+        return flask.jsonify({'status': "Error: At most %d points per request with radius_km" % MAX_AREA_BATCH_POINTS})
+
+    areas = apis.light_pollution_area_batch(lats, lngs, radius_km, with_max=True)
+    return flask.jsonify({
+        'status': "Success!",
+        'radiusKm': radius_km,
+        'lightPol': [mean for mean, _ in areas],
+        'lightPolMax': [max_light_pol for _, max_light_pol in areas],
+    })
+
+
+@app.route('/driving_distances', methods=['POST'])
+def get_driving_distances_batch():
+    """get driving distance from one origin to many candidate sites in one request.
+
+    args (json body):
+    origin: {"lat": float, "lng": float} of user location
+    sites: list of {"lat": float, "lng": float}
+
+    returns: dictionary with driving distances for each site, shortest drive first
+    """
+    request_data = flask.request.get_json(silent=True) or {}
+    origin = request_data.get('origin')
+    sites = request_data.get('sites')
+
+    if not isinstance(sites, list) or not sites:
+        return flask.jsonify({'status': "Error: Missing list of sites"})
+    if len(sites) > MAX_DISTANCE_SITES:
+        return flask.jsonify({'status': "Error: At most %d sites per request" % MAX_DISTANCE_SITES})
+
+    try:
+        lat_org = float(origin['lat'])
+        lng_org = float(origin['lng'])
+        sites = [(float(site['lat']), float(site['lng'])) for site in sites]
+    except (KeyError, TypeError, ValueError):
+        return flask.jsonify({'status': "Error: origin and each site need a lat and lng"})
+    if not valid_lat_lng(lat_org, lng_org) or not all(valid_lat_lng(lat, lng) for lat, lng in sites):
+        return flask.jsonify({'status': INVALID_LAT_LNG_STATUS})
+
+    try:
+        driving_distances = get_driving_distances(lat_org, lng_org, sites)
+    except Exception as e:
+        print("Error: Driving distances failed: %s" % e)
+        return flask.jsonify({'status': "Error: Driving distances unavailable, try again"})
+
+    return flask.jsonify({
+        'status': "Success!",
+        'drivingDistances': driving_distances,
+    })
+
+
+def get_routable_sites(lat_org, lng_org, radius_km, count, candidates):
+    """Drop darkest sites with no driving route to them, searching again past them until count are left
+
+    Without a water mask in the pyramid, the darkest sites near a coast are out at sea. Each round
+    excludes the sites found to have no route, up to MAX_DISTANCE_SITES route checks in all.
+
+    args: lat/lng of origin, search radius in km, number of sites wanted, first search results
+    returns: list of sites with a route (or whose route check failed), with their driving distance
+    """
+    routes = {}
+    no_route = []
+    while True:
+        unchecked = [(site['lat'], site['lng']) for site in candidates if (site['lat'], site['lng']) not in routes]
+        unchecked = unchecked[:MAX_DISTANCE_SITES - len(routes)]
+        if not unchecked:
+            break
+        try:
+            driving_distances = get_driving_distances(lat_org, lng_org, unchecked)
+        except Exception as e:
+            print("Error: Could not check routes to darkest sites: %s" % e)
+            break
+
+        found_no_route = False
+        for driving_distance in driving_distances:
+            routes[(driving_distance['lat'], driving_distance['lng'])] = driving_distance
+            if driving_distance.get('status') == NO_ROUTE_STATUS:
+                no_route.append((driving_distance['lat'], driving_distance['lng']))
+                found_no_route = True
+        if not found_no_route or len(routes) >= MAX_DISTANCE_SITES:
+            break
+        candidates = dark_sites.find_darkest_sites(lat_org, lng_org, radius_km, count, exclude=no_route)
+
+    sites = []
+    for site in candidates:
+        driving_distance = routes.get((site['lat'], site['lng']))
+        if driving_distance is None:
+            # Where the route check itself failed the site stays in, without a driving distance
+            sites.append(site)
+        elif 'duration_value' in driving_distance:
+            site['drivingDistance'] = driving_distance
+            sites.append(site)
+        elif driving_distance['status'] != NO_ROUTE_STATUS:
+            sites.append(site)
+    return sites
+
+
+@app.route('/darkest_sites', methods=['GET'])
+def get_darkest_sites():
+    """get the darkest locations within driving range of the user.
+
+    args:
+    lat_org/lng_org: gps coords of origin (user location) as float
+    radius_km: search radius, default 100
+    count: max number of sites, default 10
+    sort: "darkness" (default), "distance" or "rating" (clear sky site quality)
+    check_route: 1 (default) to drop sites with no driving route, e.g. out at sea
+
+    returns: dictionary with list of darkest sites
+    """
+    lat_org = flask.request.args.get('lat_org', type = float)
+    lng_org = flask.request.args.get('lng_org', type = float)
+    radius_km = flask.request.args.get('radius_km', 100, type = float)
+    count = flask.request.args.get('count', 10, type = int)
+    sort = flask.request.args.get('sort', 'darkness')
+    check_route = flask.request.args.get('check_route', 1, type = int)
+
+    if lat_org is None or lng_org is None:
+        return flask.jsonify({'status': "Error: Missing lat/lng parameters"})
+    if not valid_lat_lng(lat_org, lng_org):
+        return flask.jsonify({'status': INVALID_LAT_LNG_STATUS})
+
+    radius_km = max(1, min(radius_km, dark_sites.MAX_SEARCH_RADIUS_KM))
+    count = max(1, min(count, MAX_DARK_SITES))
+
+    candidates = dark_sites.find_darkest_sites(lat_org, lng_org, radius_km, count)
+    if candidates is None:
+        return flask.jsonify({'status': "Error: Darkest site search is not available, light pollution pyramid not compiled"})
+
+    sites = candidates
+    if check_route:
+        sites = get_routable_sites(lat_org, lng_org, radius_km, count, candidates)
+
+    for site in sites:
+        site['clearSkyQuality'] = calculate_rating(0, 0, 0, float(site['lightPol']))
+
+    if sort == 'distance':
+        sites.sort(key=lambda site: site['dist_km'])
+    elif sort == 'rating':
+        sites.sort(key=lambda site: -site['clearSkyQuality'])
+
+    return flask.jsonify({
+        'status': "Success!",
+        'sites': sites[:count],
+    })
+
+
+@app.route('/csc', methods=['GET'])
+def get_nearest_cs_charts():
+    """get the nearest Clear Sky Charts to a site.
+
+    args:
+    lat_selected/lng_selected: gps coords of selected stargazing site as float
+    count: max number of charts to return, default 5
+
+    returns: dictionary with list of charts within 100 km, nearest first
+    """
+    lat_selected = flask.request.args.get('lat_selected', type = float)
+    lng_selected = flask.request.args.get('lng_selected', type = float)
+    count = flask.request.args.get('count', 5, type = int)
+
+    if lat_selected is None or lng_selected is None:
+        return flask.jsonify({'status': "Error: Missing lat/lng parameters"})
+    if not valid_lat_lng(lat_selected, lng_selected):
+        return flask.jsonify({'status': INVALID_LAT_LNG_STATUS})
+
+    count = max(1, min(count, MAX_CSC_COUNT))
+
+    return flask.jsonify({
+        'status': "Success!",
+        'CDSCharts': apis.nearest_cscs(lat_selected, lng_selected, count),
+    })
+
+
+@app.route('/ready', methods=['GET'])
+def get_readiness():
+    """Readiness probe, only reports ready once warm_up has loaded the shared data
+
+    returns: 200 with what was loaded, or 503 while warming up
+    """
+    if not warm_up_status['ready']:
+        return flask.jsonify({'status': "Warming up"}), 503
+
+    return flask.jsonify(dict(warm_up_status, status="Ready"))
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Latency histograms and error counts per request route, report stage and upstream, and
+    hit rates for the caches, for monitoring and SLOs. Counters are per worker process.
+
+    returns: dictionary of metrics
+    """
+    upstream_latency = metrics.metrics.snapshot('upstreams')
+    upstreams = {}
+    for name, client_stats in upstream.get_upstream_stats().items():
+        upstreams[name] = dict(client_stats, latency=upstream_latency.get(name))
+
+    caches = cache.get_cache_stats()
+    caches['lpTiles'] = light_pollution.get_tile_cache_stats()
+    caches['lpSummedArea'] = light_pollution.get_sat_cache_stats()
+    caches['shared'] = shared_cache.get_shared_cache_stats()
+
+    return flask.jsonify({
+        'status': "Sucess",
+        'requests': metrics.metrics.snapshot('requests'),
+        'stages': metrics.metrics.snapshot('stages'),
+        'upstreams': upstreams,
+        'caches': caches,
+        'coalescing': cache.get_coalescing_stats(),
+        'prewarm': prewarm.get_prewarm_stats(),
+    })
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.request_started = t.perf_counter()
+
+
+@app.after_request
+def record_request_timing(response):
+    """Record the request's latency and send its stage timings in a Server-Timing header"""
+    started = flask.g.get('request_started')
+    if started is None:
+        return response
+
+    seconds = t.perf_counter() - started
+    endpoint = flask.request.endpoint or "unknown"
+    error = "http_%d" % response.status_code if response.status_code >= 500 else None
+    metrics.metrics.observe('requests', endpoint, seconds, error)
+
+    timings = flask.g.get('timings')
+    server_timing = timings.server_timing() if timings is not None else ""
+    total = "total;dur=%.1f" % (seconds * 1000)
+    response.headers.set('Server-Timing', server_timing + ", " + total if server_timing else total)
+    return response
+
+
+@app.after_request
+def set_cors_headers(response):
     response.headers.set('Access-Control-Allow-Origin', '*')
     response.headers.set('Access-Control-Allow-Methods', 'GET, POST')
-
+    response.headers.set('Access-Control-Allow-Headers', 'Content-Type')
+    response.headers.set('Timing-Allow-Origin', '*')
     return response
 
+
 if __name__ == "__main__":
-    app.run(debug=False, host="0.0.0.0", port=8080)
\ No newline at end of file
+    # Development server, production runs wsgi:app under gunicorn (see gunicorn.conf.py)
+    warm_up()
+    start_background_tasks()
+    app.run(debug=False, host="0.0.0.0", port=int(os.environ.get('PORT', 8080)))
\ No newline at end of file
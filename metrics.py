@@ -0,0 +1,130 @@
+"""
+Latency histograms and error counts, for requests, report stages and upstream calls
+
+Everything observed is kept per process in fixed-bucket histograms, cheap enough to record
+on every call. Percentiles are estimated from the buckets (the upper edge of the bucket the
+percentile falls in). Each request's stage durations are also sent back in its
+Server-Timing header.
+"""
+import threading
+import time as t
+
+from contextlib import contextmanager
+
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram(object):
+    """Counts of observed durations per latency bucket, with error counts by kind"""
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        self.counts = [0] * (len(buckets_ms) + 1)  # Last bucket catches everything slower
+        self.count = 0
+        self.sum_ms = 0.0
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, error=None):
+        duration_ms = seconds * 1000
+        bucket = len(self.buckets_ms)
+        for idx, bucket_ms in enumerate(self.buckets_ms):
+            if duration_ms <= bucket_ms:
+                bucket = idx
+                break
+
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum_ms += duration_ms
+            if error:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def count_error(self, error):
+        """Count an error with no duration (e.g. a section that was abandoned at its timeout)"""
+        with self._lock:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def percentile(self, fraction):
+        """Upper edge of the bucket holding the given fraction of observations, in ms (None if slower than all buckets)"""
+        target = fraction * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.buckets_ms[idx] if idx < len(self.buckets_ms) else None
+        return None
+
+    def snapshot(self):
+        with self._lock:
+            buckets = {"le_%s" % bucket_ms: count for bucket_ms, count in zip(self.buckets_ms, self.counts)}
+            buckets['le_inf'] = self.counts[-1]
+            return {
+                'count': self.count,
+                'mean_ms': round(self.sum_ms / self.count, 3) if self.count else None,
+                'p50_ms': self.percentile(0.5),
+                'p95_ms': self.percentile(0.95),
+                'p99_ms': self.percentile(0.99),
+                'errors': dict(self.errors),
+                'buckets': buckets,
+            }
+
+
+class MetricsRegistry(object):
+    """Histograms by group ('requests', 'stages', 'upstreams') and name"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, group, name):
+        key = (group, name)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def observe(self, group, name, seconds, error=None):
+        self.histogram(group, name).observe(seconds, error)
+
+    def count_error(self, group, name, error):
+        self.histogram(group, name).count_error(error)
+
+    def snapshot(self, group):
+        with self._lock:
+            names = sorted(name for hist_group, name in self._histograms if hist_group == group)
+        return {name: self.histogram(group, name).snapshot() for name in names}
+
+
+class StageTimings(object):
+    """Durations of the stages of one request, recorded into the shared metrics as well"""
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = t.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception:
+            error = "error"
+            raise
+        finally:
+            seconds = t.perf_counter() - started
+            self.durations[name] = seconds
+            metrics.observe('stages', name, seconds, error)
+
+    def call(self, name, fn, *args):
+        """Call fn(*args) timed as stage name, e.g. as a function submitted to an executor"""
+        with self.stage(name):
+            return fn(*args)
+
+    def server_timing(self):
+        """Value for a Server-Timing header, e.g. "weather;dur=120.5, elevation;dur=3.1" """
+        return ", ".join("%s;dur=%.1f" % (name, seconds * 1000) for name, seconds in list(self.durations.items()))
+
+
+metrics = MetricsRegistry()
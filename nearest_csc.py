@@ -1,10 +1,32 @@
+import argparse
 import json
 import math
+import mmap
 import os
+import struct
+import threading
+import time as t
 
-PATH = "csc_data"
+import numpy as np
+
+PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "csc_data")
 FILENAME = "csc_sites.json"
 MAX_DIST_KM = 100
+EARTH_RADIUS_KM = 6371  # Earth Radius in kilometres (assume perfect sphere)
+CSC_IMG_URL = "https://www.cleardarksky.com/c/%s%s.gif"
+CSC_BINARY_PATH = os.environ.get('CSC_BINARY_PATH', os.path.join(PATH, "csc_sites.bin"))
+CSC_RELOAD_CHECK_S = float(os.environ.get('CSC_RELOAD_CHECK_S', 60))
+
+# Compiled dataset layout, see pack_csc_sites
+CSC_MAGIC = b"CSC1"
+CSC_HEADER = "<4sIII"  # magic, site count, string table bytes, reserved
+CSC_HEADER_SIZE = struct.calcsize(CSC_HEADER)
+CSC_STRING_FIELDS = ('id', 'name', 'loc')
+
+_csc_index = None
+_csc_index_version = None
+_csc_index_checked = 0.0
+_csc_index_lock = threading.Lock()
 
 
 def calc_great_circle_distance(lat1, lng1, lat2, lng2):
@@ -16,7 +38,7 @@ def calc_great_circle_distance(lat1, lng1, lat2, lng2):
     args: Float lat/lng for two points on Earth
     returns: Float representing distance in kilometres
     """
-    R = 6371  # Earth Radius in kilometres (assume perfect sphere)
+    R = EARTH_RADIUS_KM
 
     phi1 = math.radians(lat1)
     phi2 = math.radians(lat2)
@@ -31,58 +53,317 @@ def calc_great_circle_distance(lat1, lng1, lat2, lng2):
     return round(d, 1)  # Assume Accurate within ~0.1km due to Idealized Sphere Earth
 
 
-def get_nearest_csc(lat, lng):
-    """Nearest Clear Sky Chart from A. Danko's site: https://www.cleardarksky.com/
+def lat_lng_to_unit_vectors(lats, lngs):
+    """Convert lat/lng in degrees to points on the unit sphere
+
+    args: floats or numpy arrays of lat/lng
+    returns: numpy array with a trailing axis of (x, y, z)
+    """
+    phi = np.radians(lats)
+    lam = np.radians(lngs)
+    return np.stack([np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)], axis=-1)
+
+
+def calc_great_circle_distances(lat, lng, lats, lngs):
+    """Vectorized calc_great_circle_distance from one point to many, in kilometres (unrounded)
+
+    args: Float lat/lng of one point, numpy arrays of lat/lng of other points
+    returns: numpy array of distances in kilometres
+    """
+    chord = np.linalg.norm(lat_lng_to_unit_vectors(lats, lngs) - lat_lng_to_unit_vectors(lat, lng), axis=-1)
+    return EARTH_RADIUS_KM * 2 * np.arcsin(np.minimum(chord / 2, 1.0))
 
-    All 5000+ sities are binned by 1x1 degree lat/lng. Only check the
-    distance to sites within current bin +/- 1 degree, searching 9 bins total.
 
-    args: request object w/ args for lat/lng
-    returns: String, either with json representation of nearest site information or an error message
+class CSCIndex(object):
+    """Spatial index over Clear Sky Chart sites.
+
+    Sites are kept sorted by latitude with their unit sphere vectors, so a query only
+    computes distances for the latitude band that can be within range. Unlike
+    lat/lng degree bins, this has no edge effects around lat/lng 0 or at the antimeridian.
+
+    Site data is read in place from the compiled binary layout (see pack_csc_sites), which
+    may be a memory-mapped file shared by all workers.
     """
 
-    file_path = os.path.join(PATH, FILENAME)
-    closest_site = {}
+    def __init__(self, buffer):
+        magic, count, strings_size, _ = struct.unpack_from(CSC_HEADER, buffer, 0)
+        if magic != CSC_MAGIC:
+            raise ValueError("Not a compiled CSC dataset")
+
+        offset = CSC_HEADER_SIZE
+        self.lats = np.frombuffer(buffer, dtype=np.float32, count=count, offset=offset)
+        offset += self.lats.nbytes
+        self.lngs = np.frombuffer(buffer, dtype=np.float32, count=count, offset=offset)
+        offset += self.lngs.nbytes
+        self.string_offsets = np.frombuffer(buffer, dtype=np.uint32, count=len(CSC_STRING_FIELDS) * count + 1,
+                                            offset=offset)
+        offset += self.string_offsets.nbytes
+        self.strings = memoryview(buffer)[offset:offset + strings_size]
+
+        self.buffer = buffer  # Keep the mapping open while the index is in use
+        self.vectors = lat_lng_to_unit_vectors(self.lats.astype(np.float64), self.lngs.astype(np.float64))
+
+    def __len__(self):
+        return len(self.lats)
+
+    def get_string(self, idx):
+        return str(self.strings[self.string_offsets[idx]:self.string_offsets[idx + 1]], 'utf-8')
+
+    def get_site(self, site_idx):
+        """Site data as it appears in the source json (lat, lon, id, name, loc)"""
+        site = {
+            # float32 holds ~1 m precision, don't show float32 rounding noise
+            'lat': round(float(self.lats[site_idx]), 5),
+            'lon': round(float(self.lngs[site_idx]), 5),
+        }
+        for field_idx, field in enumerate(CSC_STRING_FIELDS):
+            site[field] = self.get_string(len(CSC_STRING_FIELDS) * site_idx + field_idx)
+        return site
+
+    def query_radius(self, lat, lng, radius_km):
+        """Find all sites within radius_km of a point
+
+        args: Float lat/lng, Float radius in kilometres
+        returns: list of (distance km, site index) sorted by distance
+        """
+        band_deg = math.degrees(radius_km / EARTH_RADIUS_KM)
+        start = np.searchsorted(self.lats, lat - band_deg, side='left')
+        end = np.searchsorted(self.lats, lat + band_deg, side='right')
+        if start >= end:
+            return []
+
+        chord = np.linalg.norm(self.vectors[start:end] - lat_lng_to_unit_vectors(lat, lng), axis=-1)
+        dists = EARTH_RADIUS_KM * 2 * np.arcsin(np.minimum(chord / 2, 1.0))
+
+        in_range = np.nonzero(dists < radius_km)[0]
+        order = in_range[np.argsort(dists[in_range], kind='stable')]
+        return [(float(dists[k]), int(start + k)) for k in order]
 
-    # Get list of all csc site locations
+    def query_nearest(self, lat, lng, k=1, max_dist_km=MAX_DIST_KM):
+        """Find the k nearest sites within max_dist_km of a point
+
+        args: Float lat/lng, number of sites, Float max distance in kilometres (None for no limit)
+        returns: list of (distance km, site index) sorted by distance
+        """
+        if max_dist_km is None:
+            max_dist_km = math.pi * EARTH_RADIUS_KM + 1
+        return self.query_radius(lat, lng, max_dist_km)[:k]
+
+    def site_report(self, site_idx, dist_km):
+        """Copy of a site's data with distance and chart image urls added"""
+        site = self.get_site(site_idx)
+        site['status'] = "SUCCESS"
+        site['dist_km'] = round(dist_km, 1)  # Assume Accurate within ~0.1km due to Idealized Sphere Earth
+        site['full_img'] = CSC_IMG_URL % (site['id'], "csk")
+        site['mini_img'] = CSC_IMG_URL % (site['id'], "cs0")
+        return site
+
+
+def read_csc_sites(file_path):
+    """Read the list of CSC sites from the json file of sites binned by 1x1 degree lat/lng
+
+    args: path to json file
+    returns: list of site dicts
+    """
     with open(file_path, 'r') as f:
         data = json.load(f)
-        nearby_csc = []
 
-        # Get list of all sites within same or adjacent 1 degree lat/lng bin
+    return [site for lat_bin in data.values() for lng_bin in lat_bin.values() for site in lng_bin]
+
+
+def pack_csc_sites(sites):
+    """Pack sites into the compact binary layout read by CSCIndex.
+
+    Layout (little endian): header (magic, site count, string table size), float32 lats,
+    float32 lngs, uint32 offsets into the string table for each site's id, name and loc
+    (plus one end offset), then the utf-8 string table. Sites are sorted by latitude.
+
+    args: list of site dicts with lat, lon, id, name and loc
+    returns: bytes
+    """
+    sites = sorted(sites, key=lambda site: site['lat'])
+    lats = np.array([site['lat'] for site in sites], dtype='<f4')
+    lngs = np.array([site['lon'] for site in sites], dtype='<f4')
+
+    strings = [str(site.get(field, "")).encode('utf-8') for site in sites for field in CSC_STRING_FIELDS]
+    string_offsets = np.zeros(len(strings) + 1, dtype='<u4')
+    string_offsets[1:] = np.cumsum([len(string) for string in strings])
+    string_table = b"".join(strings)
+
+    header = struct.pack(CSC_HEADER, CSC_MAGIC, len(sites), len(string_table), 0)
+    return header + lats.tobytes() + lngs.tobytes() + string_offsets.tobytes() + string_table
+
+
+def compile_csc_sites(json_paths, out_path=CSC_BINARY_PATH):
+    """Compile json site lists (merged, de-duplicated by id) into the binary dataset.
+
+    Written to a temporary file and renamed into place, so running servers never see a
+    partial file and pick up the new dataset on their next reload check.
+
+    args: list of json file paths, path to write the binary dataset to
+    returns: number of sites written
+    """
+    sites = {}
+    for json_path in json_paths:
+        for site in read_csc_sites(json_path):
+            sites[site['id']] = site
+
+    out_dir = os.path.dirname(out_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(pack_csc_sites(list(sites.values())))
+    os.replace(tmp_path, out_path)
+    return len(sites)
+
+
+def get_file_version(file_path):
+    """Identifies a version of a file, changes when a new file is renamed into place"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def load_csc_index(file_path=None):
+    """Load all CSC sites into the spatial index used by lookups, replacing the current one.
+
+    The compiled binary dataset is memory-mapped if there is one, otherwise the json file
+    is read and packed in memory. Lookups in progress keep using the index they started with.
+
+    args: path to a compiled dataset or json file of sites, defaults to the binary dataset
+          if it exists, else the json file
+    returns: CSCIndex
+    """
+    global _csc_index, _csc_index_version, _csc_index_checked
+
+    if file_path is None:
+        file_path = CSC_BINARY_PATH if os.path.exists(CSC_BINARY_PATH) else os.path.join(PATH, FILENAME)
+
+    version = get_file_version(file_path)
+    if file_path.endswith(".json"):
+        csc_index = CSCIndex(pack_csc_sites(read_csc_sites(file_path)))
+    else:
+        with open(file_path, 'rb') as f:
+            csc_index = CSCIndex(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    _csc_index = csc_index
+    _csc_index_version = (file_path, version)
+    _csc_index_checked = t.monotonic()
+    return csc_index
+
+
+def reload_csc_index_if_changed():
+    """Swap in a newly compiled binary dataset, if one has replaced the loaded file
+
+    returns: True if the index was reloaded
+    """
+    global _csc_index_checked
+
+    _csc_index_checked = t.monotonic()
+    version = get_file_version(CSC_BINARY_PATH)
+    if version is None or _csc_index_version == (CSC_BINARY_PATH, version):
+        return False
+
+    with _csc_index_lock:
+        if _csc_index_version == (CSC_BINARY_PATH, get_file_version(CSC_BINARY_PATH)):
+            return False
         try:
-            for x in range(-1, 2):
-                for y in range(-1, 2):
-                    lat_str = str(int(lat)+x)
-                    lng_str = str(int(lng)+y)
-                    if lat_str in data:
-                        if lng_str in data[lat_str]:
-                            sites_in_bin = data[lat_str][lng_str]
-                            for site in sites_in_bin:
-                                nearby_csc.append(site)
-        except:
-            # API returns error
-            closest_site = {'status': "ERROR parsing coordinates or reading from list of CSC sites"}
-
-        curr_closest_km = MAX_DIST_KM
-
-        # Find the closest site in Clear Dark Sky database within bins
-        for site in nearby_csc:
-            dist = calc_great_circle_distance(lat, lng, site["lat"], site["lon"])
-
-            if dist < curr_closest_km:
-                curr_closest_km = dist
-                closest_site = site
-
-        # Grab site url and return site data if within 100 km
-        if curr_closest_km < MAX_DIST_KM:
-            closest_site['status'] = "SUCCESS"
-            closest_site['dist_km'] = curr_closest_km
-            closest_site['full_img'] = "https://www.cleardarksky.com/c/"+closest_site['id']+"csk.gif"
-            closest_site['mini_img'] = "https://www.cleardarksky.com/c/"+closest_site['id']+"cs0.gif"
+            load_csc_index(CSC_BINARY_PATH)
+        except (IOError, ValueError, struct.error) as e:
+            print("Error: Could not reload CSC dataset %s: %s" % (CSC_BINARY_PATH, e))
+            return False
+    print("Reloaded CSC dataset %s (%d sites)" % (CSC_BINARY_PATH, len(_csc_index)))
+    return True
+
+
+def get_csc_index():
+    """Get the CSC site index, loading it on first use and reloading it when it is recompiled"""
+    if _csc_index is None:
+        with _csc_index_lock:
+            if _csc_index is None:
+                load_csc_index()
+    elif t.monotonic() - _csc_index_checked >= CSC_RELOAD_CHECK_S:
+        reload_csc_index_if_changed()
+    return _csc_index
+
+
+def get_nearest_cscs(lat, lng, k=5, max_dist_km=MAX_DIST_KM):
+    """The k nearest Clear Sky Charts within max_dist_km
+
+    args: Float lat/lng, number of sites, Float max distance in kilometres
+    returns: list of site data dicts sorted by distance, may be empty
+    """
+    csc_index = get_csc_index()
+    return [csc_index.site_report(site_idx, dist) for dist, site_idx in csc_index.query_nearest(lat, lng, k, max_dist_km)]
+
+
+def get_cscs_within(lat, lng, radius_km):
+    """All Clear Sky Charts within radius_km, sorted by distance
+
+    args: Float lat/lng, Float radius in kilometres
+    returns: list of site data dicts
+    """
+    csc_index = get_csc_index()
+    return [csc_index.site_report(site_idx, dist) for dist, site_idx in csc_index.query_radius(lat, lng, radius_km)]
+
+
+def get_nearest_csc_batch(lats, lngs):
+    """get_nearest_csc for many points, with all distances computed in one array operation
+
+    args: sequences of lat/lng
+    returns: list of dicts, one per point, as from get_nearest_csc
+    """
+    csc_index = get_csc_index()
+    points = lat_lng_to_unit_vectors(np.asarray(lats, dtype=np.float64), np.asarray(lngs, dtype=np.float64))
+
+    # Chord distance from every point to every site, sites x points is small (5000 x 50)
+    chord = np.linalg.norm(csc_index.vectors[np.newaxis, :, :] - points[:, np.newaxis, :], axis=-1)
+    dists = EARTH_RADIUS_KM * 2 * np.arcsin(np.minimum(chord / 2, 1.0))
+    nearest = np.argmin(dists, axis=1)
+
+    closest_sites = []
+    for point_idx, site_idx in enumerate(nearest):
+        dist = dists[point_idx, site_idx]
+        if dist < MAX_DIST_KM:
+            closest_sites.append(csc_index.site_report(int(site_idx), float(dist)))
         else:
-            closest_site = {
+            closest_sites.append({
                 'status': "No sites within 100 km. CSC sites are only available in the Continental US, Canada, and Northern Mexico"
-            }
+            })
+    return closest_sites
+
+
+def get_nearest_csc(lat, lng):
+    """Nearest Clear Sky Chart from A. Danko's site: https://www.cleardarksky.com/
+
+    All 5000+ sities are held in a spatial index loaded once, only sites within
+    MAX_DIST_KM are considered.
+
+    args: Float lat/lng
+    returns: dict, either with the nearest site information or an error message
+    """
+    if not (math.isfinite(lat) and math.isfinite(lng)):
+        return {'status': "ERROR parsing coordinates or reading from list of CSC sites"}
+
+    nearest_sites = get_nearest_cscs(lat, lng, 1)
+
+    # Return site data if within 100 km
+    if nearest_sites:
+        return nearest_sites[0]
+
+    return {
+        'status': "No sites within 100 km. CSC sites are only available in the Continental US, Canada, and Northern Mexico"
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile CSC site json into the binary dataset served by the API")
+    parser.add_argument('--sites', action='append', help="json file of sites, repeatable (default %s)" % FILENAME)
+    parser.add_argument('--out', default=CSC_BINARY_PATH, help="path to write the binary dataset to")
+    args = parser.parse_args()
 
-        return closest_site
+    site_count = compile_csc_sites(args.sites or [os.path.join(PATH, FILENAME)], args.out)
+    print("Compiled %d CSC sites to %s" % (site_count, args.out))
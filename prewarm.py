@@ -0,0 +1,240 @@
+"""
+Background pre-warming of forecasts for the most requested locations, ahead of dusk
+
+Traffic peaks at dusk, when reports ask for the forecast at nautical twilight. Requests are
+counted per weather cache cell, and shortly before twilight in each of the busiest cells the
+forecasts a report at dusk asks for (the weather at that hour, and the hourly forecast from now
+for its timeline) are fetched into the cache, so the peak is served from memory. They are kept
+until the end of the dusk hour, whatever the cache's TTL.
+Twilight times come from the local ephemeris and need no upstream calls.
+"""
+import heapq
+import os
+import threading
+import time as t
+
+from collections import deque
+
+import apis
+import cache
+import upstream
+from helpers import get_current_unix_time
+
+PREWARM_ENABLED = os.environ.get('PREWARM_ENABLED', '1') == '1'
+PREWARM_INTERVAL_S = float(os.environ.get('PREWARM_INTERVAL_S', 5 * 60))
+# How long before dusk to fetch, prewarmed entries are kept until the end of the dusk hour
+PREWARM_LEAD_S = float(os.environ.get('PREWARM_LEAD_S', 20 * 60))
+PREWARM_TIMELINE = os.environ.get('PREWARM_TIMELINE', '1') == '1'  # Also fetch the forecast timelines use
+PREWARM_TOP_CELLS = int(os.environ.get('PREWARM_TOP_CELLS', 50))
+PREWARM_BUDGET_PER_HOUR = int(os.environ.get('PREWARM_BUDGET_PER_HOUR', 60))
+HOT_SPOT_MAX_CELLS = int(os.environ.get('HOT_SPOT_MAX_CELLS', 10000))
+HOT_SPOT_DECAY = 0.5  # Counts are halved every hour so old hot spots fade out
+HOT_SPOT_DECAY_S = 3600
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class HotSpotTracker(object):
+    """Decaying request counts per weather cache cell"""
+
+    def __init__(self, max_cells=HOT_SPOT_MAX_CELLS):
+        self.max_cells = max_cells
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, lat, lng):
+        cell = cache.geohash(lat, lng)
+        with self._lock:
+            self._counts[cell] = self._counts.get(cell, 0) + 1
+            if len(self._counts) > self.max_cells:
+                # Drop the coldest half rather than one cell per request
+                keep = heapq.nlargest(self.max_cells // 2, self._counts.items(), key=lambda item: item[1])
+                self._counts = dict(keep)
+
+    def decay(self, factor=HOT_SPOT_DECAY):
+        with self._lock:
+            self._counts = {cell: count * factor for cell, count in self._counts.items() if count * factor >= 0.5}
+
+    def top(self, n):
+        """The n most requested cells
+
+        returns: list of (geohash, count), busiest first
+        """
+        with self._lock:
+            return heapq.nlargest(n, self._counts.items(), key=lambda item: item[1])
+
+    def __len__(self):
+        return len(self._counts)
+
+
+class CallBudget(object):
+    """Allows at most `calls` upstream calls in any `period_s` second window"""
+
+    def __init__(self, calls, period_s=3600):
+        self.calls = calls
+        self.period_s = period_s
+        self._spent = deque()
+        self._lock = threading.Lock()
+
+    def try_spend(self):
+        """Take one call from the budget
+
+        returns: True if the call may be made
+        """
+        now = t.monotonic()
+        with self._lock:
+            while self._spent and self._spent[0] <= now - self.period_s:
+                self._spent.popleft()
+            if len(self._spent) >= self.calls:
+                return False
+            self._spent.append(now)
+            return True
+
+    def remaining(self):
+        now = t.monotonic()
+        with self._lock:
+            return self.calls - sum(1 for spent in self._spent if spent > now - self.period_s)
+
+
+class PrewarmScheduler(object):
+    """Periodically fetches forecasts for the busiest cells whose dusk is coming up.
+
+    get_darkness_times is passed in (from main) so this module doesn't import the app.
+    """
+
+    def __init__(self, tracker, get_darkness_times, top_cells=PREWARM_TOP_CELLS, lead_s=PREWARM_LEAD_S,
+                 interval_s=PREWARM_INTERVAL_S, budget=None, timeline=PREWARM_TIMELINE):
+        self.tracker = tracker
+        self.get_darkness_times = get_darkness_times
+        self.top_cells = top_cells
+        self.lead_s = lead_s
+        self.timeline = timeline
+        self.interval_s = interval_s
+        self.budget = budget or CallBudget(PREWARM_BUDGET_PER_HOUR)
+
+        self.warmed_hours = {}  # (lat, lng, hour) -> dusk, so each dusk is fetched once
+        self.runs = 0
+        self.fetches = 0
+        self.failures = 0
+        self.over_budget = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def due_hours(self, lat, lng, now):
+        """Weather cache keys for the dusks at this cell starting within the lead time
+
+        returns: list of (cache key, dusk unix time)
+        """
+        darkness_times = self.get_darkness_times(lat, lng, now)
+        if darkness_times['sun_status'] != 'Normal':
+            return []
+
+        due = []
+        for dusk_key in ('prev_day_dusk', 'curr_day_dusk', 'next_day_dusk'):
+            dusk = darkness_times[dusk_key]
+            if now <= dusk <= now + self.lead_s:
+                due.append((cache.weather_key(lat, lng, dusk), dusk))
+        return due
+
+    def prewarm_calls(self, lat, lng, dusk):
+        """The DarkSky calls a report at dusk makes, as build_stargaze_report makes them
+
+        returns: list of (args, kwargs) for apis.dark_sky
+        """
+        calls = [((lat, lng, dusk), {})]
+        if self.timeline:
+            # get_hourly_weather, for a night starting within the 48 hours of the forecast
+            calls.append(((lat, lng, None, ('hourly',)), {}))
+        return calls
+
+    def run_once(self, now=None):
+        """Fetch forecasts for the busiest cells reaching dusk soon, within the budget
+
+        returns: number of forecasts fetched
+        """
+        now = now if now is not None else get_current_unix_time()
+        self.runs += 1
+        self.warmed_hours = {key: dusk for key, dusk in self.warmed_hours.items() if dusk >= now}
+
+        fetched = 0
+        for cell, _ in self.tracker.top(self.top_cells):
+            lat, lng = cache.geohash_center(cell)
+            for key, dusk in self.due_hours(lat, lng, now):
+                if key in self.warmed_hours:
+                    continue
+                self.warmed_hours[key] = dusk
+                # Kept for requests all through the dusk hour, not just until the TTL runs out
+                ttl = max(cache.WEATHER_CACHE_TTL_S,
+                          cache.quantize_time(dusk, cache.SECONDS_IN_HOUR) + cache.SECONDS_IN_HOUR - now)
+                for args, kwargs in self.prewarm_calls(lat, lng, dusk):
+                    # Leave a low DarkSky quota to the requests themselves
+                    if upstream.quota_low('darksky') or not self.budget.try_spend():
+                        self.over_budget += 1
+                        return fetched
+                    try:
+                        apis.dark_sky(*args, refresh=True, ttl=ttl, **kwargs)
+                        self.fetches += 1
+                        fetched += 1
+                    except Exception as e:
+                        self.failures += 1
+                        print("Error: Pre-warming forecast for %s,%s failed: %s" % (lat, lng, e))
+        return fetched
+
+    def run(self):
+        last_decay = t.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print("Error: Pre-warm run failed: %s" % e)
+            if t.monotonic() - last_decay >= HOT_SPOT_DECAY_S:
+                self.tracker.decay()
+                last_decay = t.monotonic()
+            self._stop.wait(self.interval_s)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="prewarm", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'hotCells': len(self.tracker),
+            'runs': self.runs,
+            'fetches': self.fetches,
+            'failures': self.failures,
+            'overBudget': self.over_budget,
+            'budgetRemaining': self.budget.remaining(),
+        }
+
+
+hot_spots = HotSpotTracker()
+
+
+def start_scheduler(get_darkness_times):
+    """Start the pre-warm thread for this process, if enabled and not already running.
+
+    Must be called in each worker after forking (threads don't survive a fork), the hot
+    spot counts and caches it fills are per process.
+
+    args: function (lat, lng, unix time) -> darkness times dict, as main.get_darkness_times
+    returns: PrewarmScheduler, None if disabled
+    """
+    global _scheduler
+
+    if not PREWARM_ENABLED:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PrewarmScheduler(hot_spots, get_darkness_times)
+            _scheduler.start()
+    return _scheduler
+
+
+def get_prewarm_stats():
+    """Pre-warm counters, None if the scheduler isn't running in this process"""
+    return _scheduler.stats() if _scheduler is not None else None
@@ -0,0 +1,279 @@
+"""
+Cache shared by all replicas, so an upstream response fetched by one is reused by the rest
+
+Speaks the Redis protocol (RESP) to any Redis compatible server, with a minimal client
+here rather than a new dependency. Values are zlib-compressed json, keyed by cache name
+and the (geohash, time bucket) keys from cache.py. Set SHARED_CACHE_URL to
+redis://[:password@]host:port[/db] to enable it, or fake:// for an in-process stand-in.
+
+The shared cache is only ever a second level behind each process's own cache: if it is
+unreachable, calls skip it for a while (see upstream.BREAKER_RESET_S) and the local cache is used alone.
+"""
+import json
+import os
+import socket
+import threading
+import time as t
+import zlib
+
+from urllib.parse import urlparse
+
+from upstream import CircuitBreaker
+
+SHARED_CACHE_URL = os.environ.get('SHARED_CACHE_URL', '')
+SHARED_CACHE_TIMEOUT_S = float(os.environ.get('SHARED_CACHE_TIMEOUT_S', 0.25))
+SHARED_CACHE_PREFIX = os.environ.get('SHARED_CACHE_PREFIX', 'stargazr:v1')
+COMPRESSION_LEVEL = 6
+
+_backend = None
+_backend_loaded = False
+_backend_lock = threading.Lock()
+
+
+class SharedCacheError(Exception):
+    """The shared cache could not be reached or returned an error"""
+
+
+class RespClient(object):
+    """Minimal Redis protocol client, one connection per thread"""
+
+    def __init__(self, host, port=6379, db=0, password=None, timeout=SHARED_CACHE_TIMEOUT_S):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            connection = (sock, sock.makefile('rb'))
+            self._local.connection = connection
+            if self.password:
+                self.send_command(connection, "AUTH", self.password)
+            if self.db:
+                self.send_command(connection, "SELECT", self.db)
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            for closeable in reversed(connection):
+                try:
+                    closeable.close()
+                except OSError:
+                    pass
+
+    @staticmethod
+    def encode_command(args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    @classmethod
+    def read_reply(cls, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise SharedCacheError("Connection closed by shared cache")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b"+":
+            return body.decode('utf-8')
+        if prefix == b"-":
+            raise SharedCacheError(body.decode('utf-8', 'replace'))
+        if prefix == b":":
+            return int(body)
+        if prefix == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise SharedCacheError("Connection closed by shared cache")
+            return data[:-2]
+        if prefix == b"*":
+            length = int(body)
+            return None if length < 0 else [cls.read_reply(reader) for _ in range(length)]
+        raise SharedCacheError("Unexpected reply from shared cache: %r" % line)
+
+    def send_command(self, connection, *args):
+        sock, reader = connection
+        sock.sendall(self.encode_command(args))
+        return self.read_reply(reader)
+
+    def execute(self, *args):
+        """Send one command and read its reply
+
+        raises: SharedCacheError if the server can't be reached or replies with an error
+        """
+        try:
+            return self.send_command(self.connect(), *args)
+        except SharedCacheError as e:
+            if "Connection closed" in str(e):
+                self.close()
+            raise
+        except (OSError, ValueError) as e:
+            # Timeouts and broken connections leave the stream in an unknown state, reconnect
+            self.close()
+            raise SharedCacheError("Shared cache unavailable: %s" % e)
+
+
+class FakeRespClient(object):
+    """In-process stand-in for a Redis server, for tests and single-instance runs.
+
+    Handles the commands the shared cache uses (GET, SET with EX, DEL, PING, FLUSHDB),
+    with values stored as bytes just as Redis would return them.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        self.available = True  # Set False to test falling back to the local cache
+
+    def execute(self, *args):
+        if not self.available:
+            raise SharedCacheError("Shared cache unavailable: fake is down")
+
+        command = str(args[0]).upper()
+        with self._lock:
+            if command == "PING":
+                return "PONG"
+            if command == "GET":
+                entry = self._values.get(args[1])
+                if entry is None or (entry[1] is not None and entry[1] < t.monotonic()):
+                    self._values.pop(args[1], None)
+                    return None
+                return entry[0]
+            if command == "SET":
+                value = args[2] if isinstance(args[2], bytes) else str(args[2]).encode('utf-8')
+                expires = None
+                if len(args) >= 5 and str(args[3]).upper() == "EX":
+                    expires = t.monotonic() + int(args[4])
+                self._values[args[1]] = (value, expires)
+                return "OK"
+            if command == "DEL":
+                return sum(1 for key in args[1:] if self._values.pop(key, None) is not None)
+            if command == "FLUSHDB":
+                self._values.clear()
+                return "OK"
+        raise SharedCacheError("ERR unknown command '%s'" % command)
+
+
+class SharedCache(object):
+    """Compressed get/set over a Redis protocol client, skipped while the server is failing"""
+
+    def __init__(self, client, prefix=SHARED_CACHE_PREFIX, breaker=None):
+        self.client = client
+        self.prefix = prefix
+        self.breaker = breaker or CircuitBreaker()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def make_key(self, name, key):
+        """Redis key for a cache key tuple, e.g. "stargazr:v1:darksky:9q8yy:1700000000:currently" """
+        parts = key if isinstance(key, tuple) else (key,)
+        return ":".join([self.prefix, name] + [",".join(map(str, part)) if isinstance(part, tuple) else str(part)
+                                               for part in parts])
+
+    def call(self, *args):
+        """Run a command, or return None without trying while the circuit is open"""
+        if not self.breaker.allow():
+            self.skipped += 1
+            return None
+        try:
+            reply = self.client.execute(*args)
+        except SharedCacheError as e:
+            self.errors += 1
+            self.breaker.record_failure()
+            print("Error: %s" % e)
+            return None
+        self.breaker.record_success()
+        return reply
+
+    def get(self, name, key):
+        """Get a value stored by any replica
+
+        args: cache name, key tuple
+        returns: decoded json value, None on a miss or if the shared cache is unavailable
+        """
+        data = self.call("GET", self.make_key(name, key))
+        if not isinstance(data, bytes):
+            self.misses += 1
+            return None
+        try:
+            value = json.loads(zlib.decompress(data).decode('utf-8'))
+        except (zlib.error, ValueError) as e:
+            print("Error: Bad shared cache entry %s: %s" % (self.make_key(name, key), e))
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_in += len(data)
+        return value
+
+    def set(self, name, key, value, ttl):
+        """Store a json-serializable value for ttl seconds"""
+        data = zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'), COMPRESSION_LEVEL)
+        if self.call("SET", self.make_key(name, key), data, "EX", max(int(ttl), 1)) is not None:
+            self.bytes_out += len(data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'circuit': self.breaker.state,
+        }
+
+
+def make_shared_cache(url):
+    """Shared cache for a url: redis://[:password@]host[:port][/db], fake://, or '' for none"""
+    if not url:
+        return None
+
+    parsed = urlparse(url)
+    if parsed.scheme == "fake":
+        return SharedCache(FakeRespClient())
+    if parsed.scheme == "redis":
+        db = int(parsed.path.strip("/") or 0)
+        return SharedCache(RespClient(parsed.hostname or "localhost", parsed.port or 6379, db, parsed.password))
+    raise ValueError("Unsupported SHARED_CACHE_URL scheme: %s" % parsed.scheme)
+
+
+def get_shared_cache():
+    """The shared cache configured by SHARED_CACHE_URL, None if there isn't one"""
+    global _backend, _backend_loaded
+
+    if not _backend_loaded:
+        with _backend_lock:
+            if not _backend_loaded:
+                _backend = make_shared_cache(SHARED_CACHE_URL)
+                _backend_loaded = True
+    return _backend
+
+
+def set_shared_cache(shared_cache):
+    """Replace the shared cache, e.g. with SharedCache(FakeRespClient()) in tests"""
+    global _backend, _backend_loaded
+
+    _backend = shared_cache
+    _backend_loaded = True
+
+
+def get_shared_cache_stats():
+    """Hit, error and byte counters for the shared cache, None if there isn't one"""
+    shared_cache = get_shared_cache()
+    return shared_cache.stats() if shared_cache is not None else None
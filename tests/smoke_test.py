@@ -19,6 +19,13 @@ def call_endpoint(lat_selected, lng_selected, lat_org=None, lng_org=None, time=N
     return request.json()
 
 
+def call_light_pollution_endpoint(points):
+
+    request = requests.post(ENDPOINT_URL + "/light_pollution", json={'points': points})
+    print(request)
+    return request.json()
+
+
 def test():
     # Test at Pt Reyes w/o specified user location or time
     print("********** Pt. Reyes TEST w/o time, w/o origin**********")
@@ -50,5 +57,14 @@ def test():
     result = call_endpoint(37.7360512, -122.4997348, 39.580110, -122.524105, time + SECONDS_IN_DAY*1.5)
     print(result, "\n")
 
+    # Light pollution for several sites in one call: Downtown LA, Pt Reyes, Stony Gorge
+    print("********** Light Pollution batch **********")
+    result = call_light_pollution_endpoint([
+        {'lat': 34.05, 'lng': -118.25},
+        {'lat': 38.116947, 'lng': -122.925357},
+        {'lat': 39.580110, 'lng': -122.524105},
+    ])
+    print(result, "\n")
+
 if __name__ == "__main__":
     test()
\ No newline at end of file
@@ -0,0 +1,77 @@
+import pytest
+
+import apis
+import cache
+import main
+
+# Three sites in one weather cell, one in another and one whose weather call fails
+SHARED = [(40.0101, -105.2701), (40.0102, -105.2702), (40.0103, -105.2703)]
+OTHER = (39.5, -106.0)
+FAILING = (41.0, -104.0)
+SITES = [SHARED[0], OTHER, SHARED[1], FAILING, SHARED[2]]
+
+
+@pytest.fixture
+def upstreams(monkeypatch):
+    """Stubs every upstream of a batch report, recording the calls made to each"""
+    calls = {'darkness': [], 'dark_sky': [], 'distances': []}
+    get_darkness_times = main.get_darkness_times
+
+    def darkness_times(lat, lng, time):
+        calls['darkness'].append((lat, lng))
+        return get_darkness_times(lat, lng, time)
+
+    def dark_sky(lat, lng, time, blocks=('currently',), refresh=False, extend_hourly=False):
+        calls['dark_sky'].append((lat, lng))
+        if (lat, lng) == FAILING:
+            raise apis.UpstreamError("DarkSky returned 503")
+        # Cloudier further north, so each site's rating shows which forecast it got
+        point = apis.WeatherPoint(time, 0.0, 0.4, 10, round(lat - 39, 2) / 4)
+        return apis.Forecast(point, (), (), 0, 0)
+
+    def driving_distances(lat_origin, lng_origin, sites):
+        calls['distances'].append(sites)
+        return [{'lat': lat, 'lng': lng, 'duration_value': int(lat * 100)} for lat, lng in reversed(sites)]
+
+    monkeypatch.setattr(main, 'get_darkness_times', darkness_times)
+    monkeypatch.setattr(apis, 'dark_sky', dark_sky)
+    monkeypatch.setattr(main, 'get_driving_distances', driving_distances)
+    monkeypatch.setattr(main, 'get_site_elevation', lambda lat, lng: round(lat * 10))
+    monkeypatch.setattr(apis, 'light_pollution_batch', lambda lats, lngs: [0.1] * len(lats))
+    monkeypatch.setattr(apis, 'nearest_csc_batch', lambda lats, lngs: [{'status': "SUCCESS", 'lat': lat} for lat in lats])
+    monkeypatch.setattr(main, 'skip_optional_sections', lambda sections: set())
+    return calls
+
+
+def test_shared_cell_fetched_once(upstreams):
+    assert len({cache.geohash(lat, lng) for lat, lng in SHARED}) == 1
+
+    batch = main.build_batch_report(SITES, lat_org=39.7, lng_org=-105.0)
+    assert batch['weatherRequests'] == 3
+    assert len(upstreams['dark_sky']) == 3
+    assert len(upstreams['darkness']) == 3
+    assert upstreams['distances'] == [SITES]
+
+
+def test_reports_in_input_order(upstreams):
+    reports = main.build_batch_report(SITES, lat_org=39.7, lng_org=-105.0)['reports']
+    assert [(report['lat'], report['lng']) for report in reports] == SITES
+
+    for report, (lat, lng) in zip(reports, SITES):
+        if (lat, lng) == FAILING:
+            continue
+        assert report['elevation'] == round(lat * 10)
+        assert report['drivingDistance']['duration_value'] == int(lat * 100)
+        assert report['CDSChart']['lat'] == lat
+    # The shared cell's sites were all rated from the one forecast
+    assert len({reports[idx]['cloudCover'] for idx in (0, 2, 4)}) == 1
+    assert reports[1]['cloudCover'] != reports[0]['cloudCover']
+
+
+def test_failed_weather_only_fails_its_sites(upstreams):
+    reports = main.build_batch_report(SITES)['reports']
+    statuses = [report['status'] for report in reports]
+    assert statuses[SITES.index(FAILING)] == "Error: Weather Report Failed. Try again."
+    assert statuses.count("Success!") == len(SITES) - 1
+    assert all(report['drivingDistance']['status'] == "Error: No start location specified"
+               for report in reports if report['status'] == "Success!")
@@ -0,0 +1,182 @@
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import dark_sites
+import elevation_store
+import light_pollution as lp
+import main
+from nearest_csc import calc_great_circle_distances
+
+TILE = (10, 24)
+COAST_COL = 512  # Sea to the west of it, land to the east
+TOWN = (slice(400, 600), slice(700, 800))
+DARK_PATCH = (slice(480, 560), slice(900, 1000))  # Darker land, far inland
+NORTH, WEST = (float(v) for v in lp.get_tile_lat_lngs(TILE[0], TILE[1], lp.LP_ZOOM))
+COAST_LNG = float(lp.get_tile_lat_lngs(TILE[0] + COAST_COL / lp.TILE_SIZE, TILE[1], lp.LP_ZOOM)[1])
+ORIGIN = (38.8, COAST_LNG + 0.05)  # On the coast
+
+
+@pytest.fixture(scope='module')
+def pyramid_dirs(tmp_path_factory):
+    """Raster of one synthetic tile (dark sea, dimmer land and a bright town) and its pyramids
+    compiled with and without a DEM masking out the sea"""
+    tmp_path = tmp_path_factory.mktemp('pyramid')
+    tiles_dir = tmp_path / 'tiles'
+    tiles_dir.mkdir()
+    pixels = np.zeros((lp.TILE_SIZE, lp.TILE_SIZE, 3), dtype=np.uint8)
+    pixels[:, COAST_COL:] = (70, 70, 70)
+    pixels[TOWN] = (255, 255, 0)
+    pixels[DARK_PATCH] = (35, 35, 35)
+    Image.fromarray(pixels).save(str(tiles_dir / ("tile_6_%d_%d.png" % TILE)))
+    raster_path = str(tmp_path / 'lp_raster.npy')
+    lp.compile_lp_raster(str(tiles_dir), raster_path)
+
+    cell_deg = 0.0625
+    dem = np.full((80, 100), 300, dtype=np.int16)
+    dem[:, :int(round((COAST_LNG - WEST) / cell_deg))] = -50
+    dem_path = str(tmp_path / 'dem.npy')
+    np.save(dem_path, dem)
+    with open(str(tmp_path / 'dem.json'), 'w') as f:
+        json.dump({'north': 41.0, 'west': WEST, 'cell_deg': cell_deg}, f)
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(lp, '_lp_raster', None)
+        mp.setattr(elevation_store, '_dem', None)
+        mp.setattr(elevation_store, '_dem_loaded', False)
+        dark_sites.compile_lp_pyramid(raster_path, str(tmp_path / 'unmasked'))
+        dark_sites.compile_lp_pyramid(raster_path, str(tmp_path / 'masked'), dem_path)
+    return str(tmp_path / 'unmasked'), str(tmp_path / 'masked')
+
+
+def use_pyramid(monkeypatch, pyramid_dir):
+    monkeypatch.setattr(dark_sites, '_lp_pyramid', None)
+    monkeypatch.setattr(dark_sites, '_lp_pyramid_loaded', False)
+    return dark_sites.load_lp_pyramid(pyramid_dir)
+
+
+@pytest.fixture
+def unmasked(pyramid_dirs, monkeypatch):
+    return use_pyramid(monkeypatch, pyramid_dirs[0])
+
+
+@pytest.fixture
+def masked(pyramid_dirs, monkeypatch):
+    return use_pyramid(monkeypatch, pyramid_dirs[1])
+
+
+def tile_blocks(level_array, level):
+    """The part of a pyramid level covering TILE"""
+    size = lp.TILE_SIZE // 2**level
+    row, col = (TILE[1] - lp.TILE_Y_MIN) * size, TILE[0] * size
+    return np.asarray(level_array[row:row + size, col:col + size])
+
+
+def test_pyramid_levels_match_tile(unmasked):
+    ratios = np.array(unmasked['ratios'])
+    leaf = unmasked['leaf_level']
+    mins, means = (tile_blocks(array, leaf) for array in unmasked['levels'][leaf])
+
+    tile = np.zeros((lp.TILE_SIZE, lp.TILE_SIZE), dtype=np.uint8)
+    tile[:, COAST_COL:] = lp.color_class_table[(70, 70, 70)]
+    tile[TOWN] = lp.color_class_table[(255, 255, 0)]
+    tile[DARK_PATCH] = lp.color_class_table[(35, 35, 35)]
+    blocks = tile.reshape(mins.shape[0], 2**leaf, mins.shape[1], 2**leaf)
+    assert (mins == blocks.min(axis=(1, 3))).all()
+    assert np.allclose(means, ratios[blocks].mean(axis=(1, 3)))
+
+    top_mins, top_means = (tile_blocks(array, unmasked['top_level']) for array in unmasked['levels'][unmasked['top_level']])
+    assert top_mins.tolist() == [[0]]
+    assert np.isclose(top_means[0, 0], ratios[tile].mean())
+
+
+def test_levels_reduce_their_children(unmasked):
+    for level in range(unmasked['leaf_level'] + 1, unmasked['top_level'] + 1):
+        mins, means = (tile_blocks(array, level) for array in unmasked['levels'][level])
+        child_mins, child_means = (tile_blocks(array, level - 1) for array in unmasked['levels'][level - 1])
+        shape = (mins.shape[0], 2, mins.shape[1], 2)
+        assert (mins == child_mins.reshape(shape).min(axis=(1, 3))).all()
+        assert np.allclose(means, child_means.reshape(shape).mean(axis=(1, 3)))
+
+
+def test_dem_masks_sea_leaves(masked):
+    leaf = masked['leaf_level']
+    mins = tile_blocks(masked['levels'][leaf][0], leaf)
+    coast = COAST_COL // 2**leaf
+    assert (mins[:, :coast] == lp.NO_DATA_INDEX).all()
+    assert (mins[:, coast:] != lp.NO_DATA_INDEX).all()
+    # The whole tile's min is now the land's
+    top_mins = tile_blocks(masked['levels'][masked['top_level']][0], masked['top_level'])
+    assert top_mins.tolist() == [[lp.color_class_table[(35, 35, 35)]]]
+
+
+def test_unmasked_search_finds_the_sea(unmasked):
+    sites = dark_sites.find_darkest_sites(ORIGIN[0], ORIGIN[1], 30, count=5)
+    assert len(sites) == 5
+    assert all(site['lng'] < COAST_LNG and site['lightPol'] == 0 for site in sites)
+
+
+def test_masked_search_only_finds_land(masked):
+    sites = dark_sites.find_darkest_sites(ORIGIN[0], ORIGIN[1], 30, count=10)
+    assert len(sites) == 10
+    assert all(site['lng'] > COAST_LNG and site['lightPol'] == pytest.approx(0.085) for site in sites)
+
+
+def test_darker_sites_before_nearer_ones(masked):
+    sites = dark_sites.find_darkest_sites(ORIGIN[0], ORIGIN[1], 200, count=25)  # Short of the next tile
+    assert len(sites) == 25
+    values = [site['lightPol'] for site in sites]
+    assert values == sorted(values)
+    patch = [site for site in sites if site['lightPol'] == pytest.approx(0.035)]
+    # The patch (~40 x 50 km) fits more than 10 sites 5 km apart, all further away than the land sites after them
+    assert 10 < len(patch) < 25 and values[:len(patch)] == [site['lightPol'] for site in patch]
+    assert min(site['dist_km'] for site in patch) > max(site['dist_km'] for site in sites[len(patch):])
+
+
+@pytest.mark.parametrize("radius_km, count, min_separation_km", [(30, 10, 5), (15, 25, 5), (50, 8, 20), (10, 12, 0)])
+def test_radius_count_and_separation(masked, radius_km, count, min_separation_km):
+    sites = dark_sites.find_darkest_sites(ORIGIN[0], ORIGIN[1], radius_km, count, min_separation_km)
+    assert 0 < len(sites) <= count
+    lats, lngs = np.array([site['lat'] for site in sites]), np.array([site['lng'] for site in sites])
+    assert (calc_great_circle_distances(ORIGIN[0], ORIGIN[1], lats, lngs) <= radius_km + 0.1).all()
+    for i, site in enumerate(sites):
+        seps = calc_great_circle_distances(site['lat'], site['lng'], np.delete(lats, i), np.delete(lngs, i))
+        assert (seps >= min_separation_km - 0.1).all()
+    # Nearest first among equally dark sites
+    assert [site['dist_km'] for site in sites] == sorted(site['dist_km'] for site in sites)
+
+
+def test_small_radius_returns_fewer_sites(masked):
+    # Only a few sites 5 km apart fit on the land within 10 km
+    sites = dark_sites.find_darkest_sites(ORIGIN[0], ORIGIN[1], 10, count=25)
+    assert 0 < len(sites) < 25
+
+
+def test_excluded_points_are_skipped(unmasked):
+    first = dark_sites.find_darkest_sites(ORIGIN[0], ORIGIN[1], 30, count=3)
+    excluded = [(site['lat'], site['lng']) for site in first]
+    sites = dark_sites.find_darkest_sites(ORIGIN[0], ORIGIN[1], 30, count=3, exclude=excluded)
+    assert len(sites) == 3
+    for site in sites:
+        seps = calc_great_circle_distances(site['lat'], site['lng'], *np.array(excluded).T)
+        assert seps.min() >= dark_sites.MIN_SEPARATION_KM
+
+
+def test_route_check_searches_past_the_sea(unmasked, monkeypatch):
+    checked = []
+
+    def get_driving_distances(lat_origin, lng_origin, sites):
+        assert len(sites) <= main.MAX_DISTANCE_SITES
+        checked.extend(sites)
+        return [{'lat': lat, 'lng': lng, 'status': main.NO_ROUTE_STATUS} if lng < COAST_LNG else
+                {'lat': lat, 'lng': lng, 'duration_value': 600} for lat, lng in sites]
+
+    monkeypatch.setattr(main, 'get_driving_distances', get_driving_distances)
+    response = main.app.test_client().get("/darkest_sites?lat_org=%f&lng_org=%f&radius_km=15&count=5" % ORIGIN)
+    sites = response.get_json()['sites']
+    assert len(sites) == 5
+    assert all(site['lng'] > COAST_LNG and 'drivingDistance' in site for site in sites)
+    assert len(checked) <= main.MAX_DISTANCE_SITES
+    assert len(set(checked)) == len(checked)  # No site is checked twice
@@ -0,0 +1,69 @@
+import pytest
+
+import apis
+import main
+
+from upstream import UpstreamError
+
+
+class FakeDistanceMatrix(object):
+    """Answers Distance Matrix requests with each destination's lat/lng as its distance/duration,
+    failing requests starting at chosen destinations: raising, or with a request level status and no rows"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.requests = []
+
+    def get_json(self, url, params=None):
+        destinations = [tuple(float(v) for v in dest.split(",")) for dest in params['destinations'].split("|")]
+        self.requests.append(destinations)
+        failure = self.failures.get(destinations[0])
+        if isinstance(failure, Exception):
+            raise failure
+        if failure:
+            return {'status': failure}
+        return {'status': "OK", 'rows': [{'elements': [
+            {'status': "OK", 'distance': {'value': lat, 'text': ""}, 'duration': {'value': lng, 'text': ""}}
+            for lat, lng in destinations
+        ]}]}
+
+
+@pytest.fixture
+def distance_matrix(monkeypatch):
+    def install(failures):
+        fake = FakeDistanceMatrix(failures)
+        monkeypatch.setattr(apis, 'G_MAPS_API_KEY', "test")
+        monkeypatch.setitem(apis.clients, 'gmaps_distance', fake)
+        return fake
+    return install
+
+
+DESTINATIONS = [(float(i), float(-i)) for i in range(60)]
+
+
+def test_chunks_in_order(distance_matrix):
+    fake = distance_matrix({})
+    elements = apis.gmaps_distance_matrix(40.0, -105.0, DESTINATIONS)
+    assert [len(request) for request in fake.requests] == [25, 25, 10]
+    assert len(elements) == len(DESTINATIONS)
+    assert [(element['distance']['value'], element['duration']['value']) for element in elements] == DESTINATIONS
+
+
+@pytest.mark.parametrize("failure, status", [(UpstreamError("timed out"), "UNAVAILABLE"),
+                                             ("OVER_QUERY_LIMIT", "OVER_QUERY_LIMIT")])
+def test_failed_chunk_keeps_the_others(distance_matrix, failure, status):
+    distance_matrix({DESTINATIONS[25]: failure})
+    elements = apis.gmaps_distance_matrix(40.0, -105.0, DESTINATIONS)
+    assert len(elements) == len(DESTINATIONS)
+    for idx, element in enumerate(elements):
+        if 25 <= idx < 50:
+            assert element == {'status': status}
+        else:
+            assert element['distance']['value'] == DESTINATIONS[idx][0]
+
+    # The failed chunk's sites are unavailable, not unreachable
+    driving_distances = main.get_driving_distances(40.0, -105.0, DESTINATIONS)
+    unavailable = [dist for dist in driving_distances if 'duration_value' not in dist]
+    assert sorted((dist['lat'], dist['lng']) for dist in unavailable) == sorted(DESTINATIONS[25:50])
+    assert all(dist['status'] != main.NO_ROUTE_STATUS for dist in unavailable)
+    assert driving_distances[-len(unavailable):] == unavailable
@@ -0,0 +1,82 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+
+import elevation_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """A fresh store in a temporary database, opened on this thread, with no DEM"""
+    monkeypatch.setattr(elevation_store, '_local', threading.local())
+    monkeypatch.setattr(elevation_store, '_dem', None)
+    monkeypatch.setattr(elevation_store, '_dem_loaded', True)
+    db_path = str(tmp_path / 'elevation' / 'elevation.sqlite')
+    connection = elevation_store.get_connection(db_path)
+    yield db_path
+    connection.close()
+
+
+def test_grid_key():
+    grid = elevation_store.ELEVATION_GRID_DEG
+    assert elevation_store.grid_key(40.0, -105.0) == (round(40.0 / grid), round(-105.0 / grid))
+    assert elevation_store.grid_key(40.0 + grid * 0.4, -105.0) == elevation_store.grid_key(40.0, -105.0)
+    assert elevation_store.grid_key(40.0 + grid, -105.0) != elevation_store.grid_key(40.0, -105.0)
+
+
+def test_put_get_round_trip(store):
+    grid = elevation_store.ELEVATION_GRID_DEG
+    assert elevation_store.get_elevation(40.0, -105.0) is None
+
+    elevation_store.put_elevation(40.0, -105.0, 1655.4)
+    assert elevation_store.get_elevation(40.0, -105.0) == 1655.4
+    # Anywhere in the same grid cell
+    assert elevation_store.get_elevation(40.0 + grid * 0.4, -105.0 - grid * 0.4) == 1655.4
+    # Not in the cells next to it
+    assert elevation_store.get_elevation(40.0 + grid, -105.0) is None
+    assert elevation_store.get_elevation(40.0, -105.0 - grid) is None
+
+    elevation_store.put_elevation(40.0, -105.0, 1700)
+    assert elevation_store.get_elevation(40.0, -105.0) == 1700
+
+
+def test_kept_across_connections(store, monkeypatch):
+    elevation_store.put_elevation(40.0, -105.0, 1655.4)
+    elevation_store.get_connection().close()
+
+    monkeypatch.setattr(elevation_store, '_local', threading.local())
+    elevation_store.get_connection(store)
+    assert elevation_store.get_elevation(40.0, -105.0) == 1655.4
+
+
+def test_dem_before_the_store(store, tmp_path):
+    dem = np.array([[100, 200], [-9999, 400]], dtype=np.int16)
+    dem_path = str(tmp_path / 'dem.npy')
+    np.save(dem_path, dem)
+    with open(str(tmp_path / 'dem.json'), 'w') as f:
+        json.dump({'north': 41.0, 'west': -106.0, 'cell_deg': 1.0, 'nodata': -9999}, f)
+    assert elevation_store.load_dem(dem_path) is not None
+
+    elevation_store.put_elevation(40.5, -105.5, 1234)
+    assert elevation_store.get_elevation(40.5, -105.5) == 100.0
+    assert elevation_store.get_elevation(40.5, -104.5) == 200.0
+    # No data and outside the DEM fall back to the store
+    assert elevation_store.get_elevation(39.5, -105.5) is None
+    elevation_store.put_elevation(39.5, -105.5, 1500)
+    assert elevation_store.get_elevation(39.5, -105.5) == 1500
+    assert elevation_store.get_elevation(45.0, -105.5) is None
+
+    elevations, covered = elevation_store.get_dem_elevation_batch(np.array([40.5, 39.5, 45.0]),
+                                                                  np.array([-104.5, -105.5, -105.5]))
+    assert covered.tolist() == [True, True, False]
+    assert elevations[0] == 200.0 and np.isnan(elevations[1:]).all()
+
+
+def test_missing_dem(tmp_path, monkeypatch):
+    monkeypatch.setattr(elevation_store, '_dem', None)
+    monkeypatch.setattr(elevation_store, '_dem_loaded', False)
+    assert elevation_store.load_dem(str(tmp_path / 'missing.npy')) is None
+    assert elevation_store.get_dem_elevation(40.0, -105.0) is None
+    assert elevation_store.get_dem_elevation_batch([40.0], [-105.0]) is None
@@ -0,0 +1,107 @@
+import calendar
+import datetime
+
+import numpy as np
+import pytest
+
+import ephemeris
+
+# Dallas, inside the path of totality of the 2024-04-08 solar eclipse
+DALLAS = (32.78, -96.8)
+GREENWICH = (51.4779, 0.0)
+TROMSO = (69.65, 18.96)
+LONGYEARBYEN = (78.22, 15.65)
+
+
+def unix(*args):
+    return calendar.timegm(datetime.datetime(*args).timetuple())
+
+
+def minutes_apart(a, b):
+    return abs(float(a) - float(b)) / 60
+
+
+def test_sunrise_sunset_greenwich_solstice():
+    # Published times for 2024-06-21: sunrise 04:43 BST, sunset 21:21 BST
+    events = ephemeris.get_sun_event_times(*GREENWICH, [unix(2024, 6, 21)], ephemeris.SUNRISE_ALT)
+    assert events['status'][0] == ephemeris.SUN_CROSSES
+    assert minutes_apart(events['morning'][0], unix(2024, 6, 21, 3, 43)) < 2
+    assert minutes_apart(events['evening'][0], unix(2024, 6, 21, 20, 21)) < 2
+
+
+@pytest.mark.parametrize("location, day, dusk", [
+    # Solar noon 12:07 UTC (equation of time -7.4 min) plus 102 degrees of hour angle
+    ((0.0, 0.0), (2024, 3, 20), (2024, 3, 20, 18, 55)),
+    # Nautical twilight ends 23:22 BST at Greenwich on the solstice
+    (GREENWICH, (2024, 6, 21), (2024, 6, 21, 22, 22)),
+])
+def test_nautical_dusk(location, day, dusk):
+    windows = ephemeris.get_twilight_windows(*location, unix(*day), 1)
+    assert windows['status'][0] == ephemeris.SUN_CROSSES
+    assert minutes_apart(windows['dusk'][0], unix(*dusk)) < 3
+    assert abs(ephemeris.solar_altitude(*location, windows['dusk'][0]) - ephemeris.NAUTICAL_TWILIGHT_ALT) < 0.1
+
+
+def test_polar_day_has_no_nautical_dusk():
+    windows = ephemeris.get_twilight_windows(*TROMSO, unix(2024, 6, 21), 1)
+    assert windows['status'][0] == ephemeris.SUN_ALWAYS_UP
+    assert np.isnan(windows['dawn'][0]) and np.isnan(windows['dusk'][0])
+
+
+def test_polar_night():
+    # Near the pole the sun stays below nautical twilight all day in December
+    windows = ephemeris.get_twilight_windows(89.0, 0.0, unix(2024, 12, 21), 1)
+    assert windows['status'][0] == ephemeris.SUN_ALWAYS_DOWN
+    assert np.isnan(windows['dusk'][0])
+
+    # In Tromso the sun never rises, but still climbs back above -12 degrees around noon
+    day = unix(2024, 12, 21)
+    assert ephemeris.get_sun_event_times(*TROMSO, [day], ephemeris.SUNRISE_ALT)['status'][0] == ephemeris.SUN_ALWAYS_DOWN
+    assert ephemeris.get_twilight_windows(*TROMSO, day, 1)['status'][0] == ephemeris.SUN_CROSSES
+
+
+@pytest.mark.parametrize("when, phase", [
+    ((2024, 1, 11, 11, 57), 0.0),   # New moon
+    ((2024, 1, 18, 3, 53), 0.25),   # First quarter
+    ((2024, 1, 25, 17, 54), 0.5),   # Full moon
+    ((2024, 4, 8, 18, 21), 0.0),    # New moon, day of the total solar eclipse
+    ((2024, 4, 23, 23, 49), 0.5),   # Full moon
+])
+def test_lunar_phase_at_published_times(when, phase):
+    result = ephemeris.get_lunar_phase(unix(*when))
+    # Phase wraps, so a new moon may come back as just under 1
+    assert min(abs(result['phase'] - phase), 1 - abs(result['phase'] - phase)) < 0.005
+    assert abs(result['illumination'] - (1 - np.cos(2 * np.pi * phase)) / 2) < 0.01
+
+
+def test_moon_covers_sun_at_totality():
+    # Totality over Dallas at 18:40 UTC, so the topocentric moon sits on the sun
+    when = unix(2024, 4, 8, 18, 40)
+    assert abs(ephemeris.lunar_altitude(*DALLAS, when) - ephemeris.solar_altitude(*DALLAS, when)) < 0.3
+
+
+def test_new_moon_rises_and_sets_with_the_sun():
+    moon = ephemeris.get_moon_times(*DALLAS, unix(2024, 4, 8, 6), unix(2024, 4, 9, 6))
+    sun = ephemeris.get_sun_event_times(*DALLAS, [unix(2024, 4, 8)], ephemeris.SUNRISE_ALT)
+    assert len(moon['rise']) == 1 and len(moon['set']) == 1
+    assert minutes_apart(moon['rise'][0], sun['morning'][0]) < 30
+    assert minutes_apart(moon['set'][0], sun['evening'][0]) < 30
+
+
+def test_moon_times_cross_the_horizon():
+    moon = ephemeris.get_moon_times(*GREENWICH, unix(2024, 1, 20), unix(2024, 1, 27))
+    assert len(moon['rise']) >= 6 and len(moon['set']) >= 6
+    for rise in moon['rise']:
+        assert abs(ephemeris.lunar_altitude(*GREENWICH, rise) - ephemeris.MOONRISE_ALT) < 0.1
+        assert ephemeris.lunar_altitude(*GREENWICH, rise + 600) > ephemeris.lunar_altitude(*GREENWICH, rise - 600)
+    for moonset in moon['set']:
+        assert abs(ephemeris.lunar_altitude(*GREENWICH, moonset) - ephemeris.MOONRISE_ALT) < 0.1
+        assert ephemeris.lunar_altitude(*GREENWICH, moonset + 600) < ephemeris.lunar_altitude(*GREENWICH, moonset - 600)
+
+
+def test_no_moonrise_at_high_latitude():
+    # Around the moon's southern standstill it stays below the Svalbard horizon for days
+    start, end = unix(2024, 1, 9), unix(2024, 1, 10)
+    moon = ephemeris.get_moon_times(*LONGYEARBYEN, start, end)
+    assert moon['rise'] == [] and moon['set'] == []
+    assert ephemeris.lunar_altitude(*LONGYEARBYEN, np.arange(start, end, 600)).max() < ephemeris.MOONRISE_ALT
@@ -0,0 +1,159 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import light_pollution as lp
+
+TILE = (10, 24)  # Covers the western US, mixes dark land, cities and ocean
+
+
+@pytest.fixture(scope='module')
+def compiled(tmp_path_factory):
+    """Raster compiled from a single PNG tile, every other tile is missing"""
+    tmp_path = tmp_path_factory.mktemp('lp')
+    tiles_dir = tmp_path / 'tiles'
+    tiles_dir.mkdir()
+    shutil.copy(os.path.join(lp.TILES_DIR_PATH, "tile_6_%d_%d.png" % TILE), str(tiles_dir))
+    raster_path = str(tmp_path / 'lp_raster.npy')
+    sizes = lp.compile_lp_raster(str(tiles_dir), raster_path)
+    return raster_path, sizes
+
+
+@pytest.fixture
+def lp_raster(compiled, monkeypatch):
+    monkeypatch.setattr(lp, '_lp_raster', None)
+    monkeypatch.setattr(lp, '_lp_raster_loaded', False)
+    return lp.load_lp_raster(compiled[0])
+
+
+def test_only_mixed_blocks_stored(compiled):
+    _, sizes = compiled
+    tile_blocks = (lp.TILE_SIZE // lp.LP_BLOCK_SIZE)**2
+    assert sizes['blocks'] == lp.TILE_X_COUNT * lp.TILE_Y_COUNT * tile_blocks
+    assert 0 < sizes['stored_blocks'] <= tile_blocks
+
+
+def test_block_raster_matches_tile(lp_raster):
+    raster = lp_raster['raster']
+    assert isinstance(raster, lp.BlockRaster)
+    assert raster.shape == (lp.TILE_Y_COUNT * lp.TILE_SIZE, lp.TILE_X_COUNT * lp.TILE_SIZE)
+
+    tile = lp.decode_tile_classes(os.path.join(lp.TILES_DIR_PATH, "tile_6_%d_%d.png" % TILE))
+    row, col = (TILE[1] - lp.TILE_Y_MIN) * lp.TILE_SIZE, TILE[0] * lp.TILE_SIZE
+
+    # Whole tile, and windows crossing block and tile edges
+    assert (raster[row:row + lp.TILE_SIZE, col:col + lp.TILE_SIZE] == tile).all()
+    assert (raster[row + 100:row + 300, col + 50:col + 1000] == tile[100:300, 50:1000]).all()
+    window = raster[row - 10:row + 10, col + 1014:col + 1034]
+    assert (window[10:, :10] == tile[:10, 1014:]).all()
+    assert (window[:10] == 0).all() and (window[:, 10:] == 0).all()
+
+    ys, xs = np.meshgrid(np.arange(0, lp.TILE_SIZE, 7), np.arange(0, lp.TILE_SIZE, 13), indexing='ij')
+    assert (raster[row + ys, col + xs] == tile[ys, xs]).all()
+    assert raster[row + 500, col + 600] == tile[500, 600]
+    assert raster[0, 0] == 0
+
+
+def test_lookups_match_png_tiles(lp_raster, monkeypatch):
+    rng = np.random.default_rng(0)
+    north, west = lp.get_tile_lat_lngs(TILE[0], TILE[1], lp.LP_ZOOM)
+    south, east = lp.get_tile_lat_lngs(TILE[0] + 1, TILE[1] + 1, lp.LP_ZOOM)
+    lats = rng.uniform(south, north, 200)
+    lngs = rng.uniform(west, east, 200)
+
+    from_raster = lp.get_light_pollution_batch(lats, lngs)
+    assert from_raster.tolist() == [lp.get_light_pollution(lat, lng) for lat, lng in zip(lats, lngs)]
+
+    # Same values from the PNG tile
+    monkeypatch.setattr(lp, '_lp_raster', None)
+    assert lp.get_light_pollution_batch(lats, lngs).tolist() == from_raster.tolist()
+
+
+@pytest.mark.parametrize("lat, lng", [(89.999, 10), (-89.999, 10), (90, 0), (85.05, 179.99), (float('nan'), 0)])
+def test_area_past_coverage_is_empty(lp_raster, lat, lng):
+    # Pixels shrink to nothing near the poles, the window must not grow with them
+    assert lp.get_light_pollution_area(lat, lng, lp.LP_MAX_AREA_RADIUS_KM, with_max=True) == (0, 0)
+
+
+def test_area_batch_builds_each_tile_once(lp_raster, monkeypatch):
+    builds = []
+    build = lp.build_tile_sat
+
+    def build_tile_sat(tile_key):
+        builds.append(tile_key)
+        return build(tile_key)
+
+    # Room for a single tile's tables, points alternating between two tiles would rebuild them every time
+    monkeypatch.setattr(lp, 'sat_cache', lp.TileCache(2 * (lp.TILE_SIZE + 1)**2 * 8))
+    monkeypatch.setattr(lp, 'build_tile_sat', build_tile_sat)
+    lats = [38.0, 38.5] * 5
+    lngs = [-121.0, -115.0] * 5  # TILE and the tile east of it
+    areas = lp.get_light_pollution_area_batch(lats, lngs, 2, with_max=True)
+    assert sorted(builds) == [TILE, (TILE[0] + 1, TILE[1])]
+
+    monkeypatch.setattr(lp, 'sat_cache', lp.TileCache(lp.LP_SAT_CACHE_BYTES))
+    assert areas == [lp.get_light_pollution_area(lat, lng, 2, with_max=True) for lat, lng in zip(lats, lngs)]
+
+
+RANDOM_TILES = [(10, 24), (11, 24), (10, 25), (11, 25), (63, 30), (0, 30)]
+
+
+@pytest.fixture(scope='module')
+def random_compiled(tmp_path_factory):
+    """Raster of tiles of random colors from the key (and some unknown ones), around a tile
+    corner and on both sides of the antimeridian"""
+    tmp_path = tmp_path_factory.mktemp('lp_random')
+    tiles_dir = tmp_path / 'tiles'
+    tiles_dir.mkdir()
+    rng = np.random.default_rng(1)
+    colors = np.array(list(lp.color_class_table) + [(1, 2, 3)], dtype=np.uint8)
+    for i, j in RANDOM_TILES:
+        # Blotches of 16 px so windows see a mix of classes, not just their average
+        blotches = rng.integers(0, len(colors), (lp.TILE_SIZE // 16, lp.TILE_SIZE // 16))
+        pixels = colors[np.kron(blotches, np.ones((16, 16), dtype=np.int64))]
+        Image.fromarray(pixels).save(str(tiles_dir / ("tile_6_%d_%d.png" % (i, j))))
+    raster_path = str(tmp_path / 'lp_raster.npy')
+    lp.compile_lp_raster(str(tiles_dir), raster_path)
+    return raster_path
+
+
+@pytest.fixture
+def random_raster(random_compiled, monkeypatch):
+    monkeypatch.setattr(lp, '_lp_raster', None)
+    monkeypatch.setattr(lp, '_lp_raster_loaded', False)
+    monkeypatch.setattr(lp, 'sat_cache', lp.TileCache(lp.LP_SAT_CACHE_BYTES))
+    return lp.load_lp_raster(random_compiled)
+
+
+def brute_force_area(lp_raster, lat, lng, radius_km):
+    """Mean and max over every pixel of the window, read straight from the raster"""
+    x, y = lp.get_lat_lng_tile(lat, lng, lp.LP_ZOOM)
+    pixel_km = 2 * np.pi * lp.EARTH_RADIUS_KM * np.cos(np.radians(lat)) / (2**lp.LP_ZOOM * lp.TILE_SIZE)
+    radius_px = radius_km / pixel_km
+    rows = np.arange(int(np.floor(y * lp.TILE_SIZE - radius_px)), int(np.floor(y * lp.TILE_SIZE + radius_px)) + 1)
+    cols = np.arange(int(np.floor(x * lp.TILE_SIZE - radius_px)), int(np.floor(x * lp.TILE_SIZE + radius_px)) + 1)
+    rows, cols = np.meshgrid(rows - lp.TILE_Y_MIN * lp.TILE_SIZE, cols % (lp.TILE_X_COUNT * lp.TILE_SIZE), indexing='ij')
+
+    classes = lp_raster['raster'][rows, cols]
+    ratios = np.array(lp_raster['ratios'])
+    known = classes[classes < len(ratios)]
+    return round(float(ratios[known].mean()), 4), ratios[known.max()]
+
+
+@pytest.mark.parametrize("corner, offset_deg, radius_km", [
+    ((11, 25), (0.0, 0.0), 25),       # Window centered on the corner of four tiles
+    ((11, 25), (0.05, -0.1), 10),     # Crossing two tile edges off center
+    ((11, 25), (0.5, 0.02), 3),       # Crossing one edge
+    ((0, 30), (0.0, -0.02), 20),      # Across the antimeridian, centered on the west side
+    ((0, 30), (-0.1, 0.03), 25),      # ...and on the east side
+])
+def test_area_matches_brute_force(random_raster, corner, offset_deg, radius_km):
+    lat, lng = (float(v) for v in lp.get_tile_lat_lngs(corner[0], corner[1], lp.LP_ZOOM))
+    lat, lng = lat + offset_deg[0], lng + offset_deg[1]
+    if lng < -180:
+        lng += 360
+    mean, max_light_pol = lp.get_light_pollution_area(lat, lng, radius_km, with_max=True)
+    assert (mean, max_light_pol) == pytest.approx(brute_force_area(random_raster, lat, lng, radius_km))
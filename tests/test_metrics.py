@@ -0,0 +1,98 @@
+import re
+
+import pytest
+
+import metrics
+
+
+class FakeClock(object):
+    """Stands in for the stage timer, each stage takes what the test says"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def perf_counter(self):
+        return self.now
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = metrics.MetricsRegistry()
+    monkeypatch.setattr(metrics, 'metrics', registry)
+    return registry
+
+
+def test_bucket_counts():
+    histogram = metrics.LatencyHistogram()
+    # On an edge counts in that bucket, just over it in the next
+    for seconds in (0.0005, 0.001, 0.0011, 0.003, 0.1, 0.1001, 20.0):
+        histogram.observe(seconds)
+
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 7
+    assert snapshot['mean_ms'] == pytest.approx((0.5 + 1 + 1.1 + 3 + 100 + 100.1 + 20000) / 7, abs=1e-3)
+    buckets = snapshot['buckets']
+    assert (buckets['le_1'], buckets['le_2.5'], buckets['le_5'], buckets['le_100'], buckets['le_250']) == (2, 1, 1, 1, 1)
+    assert buckets['le_inf'] == 1
+    assert sum(buckets.values()) == 7
+    assert list(buckets) == ["le_%s" % bucket_ms for bucket_ms in metrics.LATENCY_BUCKETS_MS] + ['le_inf']
+
+
+def test_quantiles():
+    histogram = metrics.LatencyHistogram()
+    assert histogram.snapshot()['p50_ms'] is None and histogram.snapshot()['mean_ms'] is None
+
+    for _ in range(90):
+        histogram.observe(0.004)  # 5 ms bucket
+    for _ in range(8):
+        histogram.observe(0.2)  # 250 ms bucket
+    histogram.observe(2.0)  # 2500 ms bucket
+    histogram.observe(60.0)  # Slower than every bucket
+
+    assert histogram.percentile(0.5) == 5
+    assert histogram.percentile(0.9) == 5
+    assert histogram.percentile(0.95) == 250
+    assert histogram.percentile(0.99) == 2500
+    assert histogram.percentile(1.0) is None
+    snapshot = histogram.snapshot()
+    assert (snapshot['p50_ms'], snapshot['p95_ms'], snapshot['p99_ms']) == (5, 250, 2500)
+
+
+def test_errors_by_kind():
+    histogram = metrics.LatencyHistogram()
+    histogram.observe(0.01, "timeout")
+    histogram.observe(0.01, "timeout")
+    histogram.observe(0.01)
+    histogram.count_error("http_503")
+    snapshot = histogram.snapshot()
+    assert snapshot['errors'] == {'timeout': 2, 'http_503': 1}
+    assert snapshot['count'] == 3
+
+
+def test_server_timing_header(registry, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(metrics, 't', clock)
+    timings = metrics.StageTimings()
+    for name, seconds in (('darkness', 0.00012), ('weather', 0.12049), ('rating', 1.5)):
+        with timings.stage(name):
+            clock.now += seconds
+
+    header = timings.server_timing()
+    assert header == "darkness;dur=0.1, weather;dur=120.5, rating;dur=1500.0"
+    assert all(re.match(r"^[A-Za-z_]+;dur=\d+\.\d$", entry) for entry in header.split(", "))
+    assert metrics.StageTimings().server_timing() == ""
+    # Recorded into the shared histograms too
+    assert registry.snapshot('stages')['weather']['buckets']['le_250'] == 1
+
+
+def test_failed_stage_still_timed(registry, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(metrics, 't', clock)
+    timings = metrics.StageTimings()
+    with pytest.raises(ValueError):
+        with timings.stage('elevation'):
+            clock.now += 0.002
+            raise ValueError("no elevation")
+
+    assert timings.server_timing() == "elevation;dur=2.0"
+    assert registry.snapshot('stages')['elevation']['errors'] == {'error': 1}
@@ -0,0 +1,101 @@
+import json
+import math
+import os
+
+import numpy as np
+import pytest
+
+import nearest_csc
+
+SITES_JSON = os.path.join(nearest_csc.PATH, nearest_csc.FILENAME)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Brute force reference, the haversine formula over numpy arrays"""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    a = np.sin((phi2 - phi1) / 2)**2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lng2 - lng1) / 2)**2
+    return 2 * nearest_csc.EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+@pytest.fixture
+def binary_path(tmp_path, monkeypatch):
+    """Sites compiled from the json, served as the binary dataset"""
+    path = str(tmp_path / 'csc_sites.bin')
+    nearest_csc.compile_csc_sites([SITES_JSON], path)
+    monkeypatch.setattr(nearest_csc, 'CSC_BINARY_PATH', path)
+    monkeypatch.setattr(nearest_csc, '_csc_index', None)
+    monkeypatch.setattr(nearest_csc, '_csc_index_version', None)
+    monkeypatch.setattr(nearest_csc, '_csc_index_checked', 0.0)
+    return path
+
+
+@pytest.fixture
+def sites():
+    return nearest_csc.read_csc_sites(SITES_JSON)
+
+
+def test_compiled_from_json(binary_path, sites):
+    index = nearest_csc.get_csc_index()
+    assert len(index) == len({site['id'] for site in sites})
+    assert list(index.lats) == sorted(index.lats)
+
+    by_id = {site['id']: site for site in sites}
+    for site_idx in range(0, len(index), 97):
+        site = index.get_site(site_idx)
+        expected = by_id[site['id']]
+        assert (site['name'], site['loc']) == (expected['name'], expected['loc'])
+        assert site['lat'] == pytest.approx(expected['lat'], abs=1e-4)  # float32
+        assert site['lon'] == pytest.approx(expected['lon'], abs=1e-4)
+
+
+def test_known_site(binary_path):
+    site = nearest_csc.get_nearest_csc(24.78812, -80.8894)
+    assert site['id'] == "CrlKyVObFL"
+    assert site['name'] == "Coral Key Village Observatory"
+    assert site['dist_km'] == 0
+    assert site['full_img'] == nearest_csc.CSC_IMG_URL % ("CrlKyVObFL", "csk")
+
+    assert nearest_csc.get_nearest_csc(0.0, 0.0)['status'].startswith("No sites within 100 km")
+
+
+def test_nearest_matches_brute_force(binary_path, sites):
+    index = nearest_csc.get_csc_index()
+    lats = np.array([site['lat'] for site in sites], dtype=np.float32).astype(np.float64)
+    lngs = np.array([site['lon'] for site in sites], dtype=np.float32).astype(np.float64)
+
+    rng = np.random.default_rng(0)
+    for lat, lng in zip(rng.uniform(25, 55, 200), rng.uniform(-125, -65, 200)):
+        dists = haversine_km(lat, lng, lats, lngs)
+        nearest = index.query_nearest(lat, lng, k=3, max_dist_km=None)
+        assert [dist for dist, _ in nearest] == pytest.approx(np.sort(dists)[:3], abs=1e-3)
+
+        within = index.query_radius(lat, lng, 50)
+        assert len(within) == int((dists < 50).sum())
+        assert [dist for dist, _ in within] == sorted(dist for dist, _ in within)
+
+
+def test_batch_matches_single_lookups(binary_path):
+    lats, lngs = [24.78812, 40.0, 0.0, 49.5], [-80.8894, -105.3, 0.0, -123.1]
+    assert nearest_csc.get_nearest_csc_batch(lats, lngs) == [nearest_csc.get_nearest_csc(lat, lng)
+                                                              for lat, lng in zip(lats, lngs)]
+
+
+def test_reload_on_recompile(binary_path, tmp_path, monkeypatch):
+    index = nearest_csc.get_csc_index()
+    assert not nearest_csc.reload_csc_index_if_changed()
+
+    new_site = {'lat': 45.0, 'lon': -100.0, 'id': "TestSite", 'name': "Test Site", 'loc': "Nowhere"}
+    with open(str(tmp_path / 'extra.json'), 'w') as f:
+        json.dump({'45': {'-100': [new_site]}}, f)
+    nearest_csc.compile_csc_sites([SITES_JSON, str(tmp_path / 'extra.json')], binary_path)
+
+    # Not checked again until CSC_RELOAD_CHECK_S has passed
+    monkeypatch.setattr(nearest_csc, 'CSC_RELOAD_CHECK_S', math.inf)
+    assert nearest_csc.get_csc_index() is index
+
+    monkeypatch.setattr(nearest_csc, 'CSC_RELOAD_CHECK_S', 0)
+    reloaded = nearest_csc.get_csc_index()
+    assert reloaded is not index
+    assert len(reloaded) == len(index) + 1
+    assert nearest_csc.get_nearest_csc(45.0, -100.0)['id'] == "TestSite"
+    assert not nearest_csc.reload_csc_index_if_changed()
@@ -0,0 +1,75 @@
+import pytest
+
+import apis
+import main
+
+NOW = 1600000000  # 12:26 UTC, early morning at the site
+HOUR = 3600
+LAT, LNG = 40.0, -105.0
+LOCAL_MIDNIGHT = NOW - NOW % main.SECONDS_IN_DAY + 7 * HOUR  # UTC-7, the local day NOW falls in
+HOURLY_HOURS = 49  # Not extended, later nights fall back to the daily data
+DAILY_DAYS = 7
+
+
+@pytest.fixture
+def outlook_calls(monkeypatch):
+    calls = []
+
+    def dark_sky(*args, **kwargs):
+        calls.append((args, kwargs))
+        first_hour = NOW - NOW % HOUR
+        # Cloudy every hour but one, in the second night
+        hourly = tuple(apis.WeatherPoint(first_hour + i * HOUR, 0.1, 0.5, 10, 0.9) for i in range(HOURLY_HOURS))
+        clear_hour = main.get_night_windows(LAT, LNG, NOW, 2)[1]['start'] + HOUR
+        hourly = tuple(hour._replace(cloud_cover=0.0) if hour.time == clear_hour - clear_hour % HOUR else hour
+                       for hour in hourly)
+        daily = tuple(apis.WeatherPoint(LOCAL_MIDNIGHT + day * main.SECONDS_IN_DAY, 0.0, 0.4, 10, day / 10.0)
+                      for day in range(DAILY_DAYS))
+        return apis.Forecast(None, hourly, daily, 0, 0)
+
+    monkeypatch.setattr(main, 'get_current_unix_time', lambda: NOW)
+    monkeypatch.setattr(apis, 'dark_sky', dark_sky)
+    monkeypatch.setattr(main, 'get_site_elevation', lambda lat, lng: 1600)
+    monkeypatch.setattr(main, 'get_site_light_pollution', lambda lat, lng, radius_km=None: (0.2, None))
+    return calls
+
+
+def test_one_forecast_with_a_week_of_hourly(outlook_calls):
+    main.build_outlook(LAT, LNG)
+    assert outlook_calls == [((LAT, LNG, None, ('hourly', 'daily')), {'refresh': False, 'extend_hourly': True})]
+
+
+def test_nights_rated_from_hourly_then_daily(outlook_calls):
+    outlook = main.build_outlook(LAT, LNG)
+    assert outlook['status'] == "Success!"
+    assert (outlook['lightPol'], outlook['elevation']) == (0.2, 1600)
+
+    nights = outlook['nights']
+    assert len(nights) == main.MAX_OUTLOOK_NIGHTS
+    assert [night['nightStart'] for night in nights] == sorted(night['nightStart'] for night in nights)
+
+    hourly_end = NOW - NOW % HOUR + (HOURLY_HOURS - 1) * HOUR
+    for idx, night in enumerate(nights):
+        if night['nightStart'] < hourly_end:
+            assert night['forecast'] == "hourly"
+            assert night['nightStart'] <= night['bestHour'] <= night['nightEnd']
+        elif night['nightStart'] < LOCAL_MIDNIGHT + DAILY_DAYS * main.SECONDS_IN_DAY:
+            # Rated from the day the night begins on
+            day = (night['nightStart'] - LOCAL_MIDNIGHT) // main.SECONDS_IN_DAY
+            assert night['forecast'] == "daily"
+            assert 'bestHour' not in night
+            assert night['cloudCover'] == round(day * 10)
+            assert night['siteQuality'] == main.calculate_rating(0.0, 0.4, day / 10.0, 0.2)
+        else:
+            assert night['status'] == "Error: No forecast for this night"
+
+    forecasts = [night.get('forecast') for night in nights]
+    assert forecasts[:2] == ["hourly", "hourly"] and "daily" in forecasts and forecasts[-1] is None
+    # Rated by its clearest hour
+    assert nights[1]['cloudCover'] == 0
+    assert nights[1]['siteQuality'] > nights[0]['siteQuality']
+
+
+def test_no_forecast(monkeypatch, outlook_calls):
+    monkeypatch.setattr(apis, 'dark_sky', lambda *args, **kwargs: apis.Forecast(None, (), (), 0, 0))
+    assert main.build_outlook(LAT, LNG)['status'] == "Error: Weather Report Failed. Try again."
@@ -0,0 +1,112 @@
+import pytest
+
+import apis
+import cache
+import main
+import prewarm
+import upstream
+
+HOUR = 3600
+LAT, LNG = 40.0, -105.0
+DUSK = 1600000000 - 1600000000 % HOUR + 10 * 60  # Early in its hour, so the hour outlasts the cache's TTL
+NIGHT = 10 * HOUR
+
+
+class FakeClock(object):
+    """Stands in for the cache's clocks"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+def darkness_times(lat, lng, time):
+    return {
+        'sun_status': 'Normal',
+        'prev_day_dusk': DUSK - main.SECONDS_IN_DAY,
+        'curr_day_dawn': DUSK - main.SECONDS_IN_DAY + NIGHT,
+        'curr_day_dusk': DUSK,
+        'next_day_dawn': DUSK + NIGHT,
+        'next_day_dusk': DUSK + main.SECONDS_IN_DAY,
+    }
+
+
+@pytest.fixture
+def darksky_calls(monkeypatch):
+    """DarkSky answered locally, recording the params of each call; a fresh weather cache"""
+    calls = []
+
+    def request_json(url, params=None):
+        calls.append(params)
+        first_hour = clock.now - clock.now % HOUR
+        hourly = [{'time': first_hour + i * HOUR, 'precipProbability': 0.0, 'humidity': 0.4, 'visibility': 10,
+                   'cloudCover': 0.1} for i in range(49)]
+        return {'currently': hourly[0], 'hourly': {'data': hourly}}, 100, 10
+
+    clock = FakeClock(DUSK - prewarm.PREWARM_LEAD_S)
+    monkeypatch.setattr(cache, 't', clock)
+    monkeypatch.setattr(cache, 'caches', dict(cache.caches, darksky=cache.TTLCache('darksky', cache.WEATHER_CACHE_TTL_S)))
+    monkeypatch.setattr(apis, 'DARKSKY_API_KEY', "test")
+    monkeypatch.setattr(upstream.clients['darksky'], 'request_json', request_json)
+    monkeypatch.setattr(main, 'get_darkness_times', darkness_times)
+    monkeypatch.setattr(main, 'get_site_elevation', lambda lat, lng: 1600)
+    monkeypatch.setattr(main, 'get_site_light_pollution', lambda lat, lng, radius_km=None: (0.2, None))
+    monkeypatch.setattr(main, 'get_CS_chart', lambda *args: {'status': "SUCCESS"})
+    monkeypatch.setattr(main, 'skip_optional_sections', lambda sections: set())
+    return calls, clock
+
+
+def prewarmed(clock, **kwargs):
+    tracker = prewarm.HotSpotTracker()
+    tracker.record(LAT, LNG)
+    scheduler = prewarm.PrewarmScheduler(tracker, darkness_times, budget=prewarm.CallBudget(10), **kwargs)
+    fetched = scheduler.run_once(now=clock.now)
+    return scheduler, fetched
+
+
+@pytest.mark.parametrize("after_dusk_s", [0, 20 * 60, 45 * 60])  # The last past the cache's TTL
+def test_report_in_the_dusk_hour_hits_the_cache(darksky_calls, monkeypatch, after_dusk_s):
+    calls, clock = darksky_calls
+    _, fetched = prewarmed(clock)
+    assert fetched == len(calls) == 2
+
+    clock.now = DUSK + after_dusk_s
+    monkeypatch.setattr(main, 'get_current_unix_time', lambda: clock.now)
+    lat, lng = cache.geohash_center(cache.geohash(LAT, LNG))
+    report = main.build_stargaze_report(lat, lng, timeline=True)
+    assert report['status'] == "Success!"
+    assert report['sections']['weather'] == report['sections']['timeline'] == "ok"
+    assert len(calls) == 2
+
+
+def test_report_before_dusk_hits_the_cache(darksky_calls, monkeypatch):
+    calls, clock = darksky_calls
+    prewarmed(clock)
+    monkeypatch.setattr(main, 'get_current_unix_time', lambda: clock.now)
+    # Snapped to dusk
+    report = main.build_stargaze_report(LAT, LNG, timeline=True)
+    assert report['status'] == "Success!"
+    assert len(calls) == 2
+
+
+def test_timeline_prewarm_off(darksky_calls, monkeypatch):
+    calls, clock = darksky_calls
+    _, fetched = prewarmed(clock, timeline=False)
+    assert fetched == 1
+    assert calls[0]['exclude'].split(",").count('currently') == 0
+
+    monkeypatch.setattr(main, 'get_current_unix_time', lambda: clock.now)
+    main.build_stargaze_report(LAT, LNG, timeline=True)
+    assert [params['exclude'].split(",").count('hourly') for params in calls] == [1, 0]
+
+
+def test_each_dusk_prewarmed_once(darksky_calls):
+    calls, clock = darksky_calls
+    scheduler, _ = prewarmed(clock)
+    assert scheduler.run_once(now=clock.now + 60) == 0
+    assert len(calls) == 2
@@ -0,0 +1,109 @@
+import pytest
+
+import upstream
+
+from upstream import QuotaBudget, TokenBucket
+
+
+class FakeClock(object):
+    """Stands in for upstream's monotonic clock, sleeping just moves it forward"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(upstream.t, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(upstream.t, 'sleep', clock.sleep)
+    return clock
+
+
+def test_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=4)
+    bucket.tokens = 0
+
+    bucket.refill(clock.now + 1)
+    assert bucket.tokens == 2
+    assert bucket.wait_for(3) == 0.5
+
+    bucket.refill(clock.now + 10)
+    assert bucket.tokens == 4
+    assert bucket.wait_for(3) == 0
+    assert bucket.fraction_left() == 1
+
+
+def test_burst_then_waits_for_refill(clock):
+    quota = QuotaBudget(per_second=10, burst_s=1, max_wait_s=0.25)
+    assert all(quota.try_spend() for _ in range(10))
+    assert clock.slept == []
+
+    # Empty, the next call waits a tenth of a second for its token
+    assert quota.try_spend()
+    assert clock.slept == [pytest.approx(0.1)]
+    assert quota.stats()['spent'] == 11
+
+
+def test_refuses_when_wait_exceeds_max_wait(clock):
+    quota = QuotaBudget(per_second=1, burst_s=1, max_wait_s=0.25)
+    assert quota.try_spend()
+    assert not quota.try_spend()  # Would wait a whole second
+    assert clock.slept == []
+
+    clock.now += 0.8
+    assert quota.try_spend()  # 0.2s left to wait
+    assert clock.slept == [pytest.approx(0.2)]
+    assert quota.stats()['refused'] == 1
+
+
+def test_daily_bucket_exhaustion(clock):
+    quota = QuotaBudget(per_day=3)
+    assert all(quota.try_spend() for _ in range(3))
+    assert not quota.try_spend()
+    assert not quota.try_spend()
+    assert quota.stats()['refused'] == 2
+
+    # A third of a day refills one call
+    clock.now += 86400 / 3.0
+    assert quota.try_spend()
+    assert not quota.try_spend()
+
+
+def test_low_at_threshold(clock):
+    quota = QuotaBudget(per_day=100, low_fraction=0.1)
+    for _ in range(89):
+        assert quota.try_spend()
+    assert not quota.low()  # 11 left
+
+    assert quota.try_spend()
+    assert quota.low()  # 10 left, exactly the threshold
+
+    clock.now += 864  # Refills one call
+    assert not quota.low()
+
+
+def test_unlimited_quota(clock):
+    quota = QuotaBudget()
+    assert quota.buckets() == []
+    assert all(quota.try_spend() for _ in range(1000))
+    assert not quota.low()
+
+
+def test_make_quota_reads_env(monkeypatch, clock):
+    monkeypatch.setenv('UPSTREAM_QUOTA_DARKSKY_PER_S', '0')
+    monkeypatch.setenv('UPSTREAM_QUOTA_DARKSKY_PER_DAY', '1000')
+    quota = upstream.make_quota('darksky')
+    assert (quota.per_second, quota.per_day) == (0, 1000)
+    assert quota.second_bucket is None
+
+    quota = upstream.make_quota('gmaps_distance')
+    assert quota.per_second == upstream.QUOTA_DEFAULTS['gmaps_distance']['per_second']
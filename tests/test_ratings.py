@@ -0,0 +1,41 @@
+import apis
+import main
+
+
+def test_missing_forecast_fields_are_none():
+    point = apis.parse_weather_point({'time': 1000, 'humidity': 0.4})
+    assert point == apis.WeatherPoint(1000, None, 0.4, None, None)
+
+
+def test_missing_weather_rates_as_unavailable():
+    assert main.calculate_rating(None, 0.5, 0.1, 20.0) == -1
+    assert main.calculate_rating(0.1, 0.5, None, 20.0) == -1
+    # Not the optimal rating a missing (0) cloud cover used to give
+    assert main.calculate_rating(0.0, 0.0, 0.0, 0.0) > 95
+
+    ratings = main.calculate_ratings([0.1, None, 0.1, 0.1], [0.5, 0.5, None, 0.5], [0.1, 0.1, 0.1, None], 20.0)
+    assert ratings[0] == main.calculate_rating(0.1, 0.5, 0.1, 20.0)
+    assert ratings[1:].tolist() == [-1, -1, -1]
+    assert main.site_rating_desciptions(ratings)[1] == main.site_rating_desciption(-1)
+
+
+def test_timeline_skips_hours_without_weather():
+    hourly = [
+        {'time': 100, 'precipProb': None, 'humidity': None, 'cloudCover': None},
+        {'time': 200, 'precipProb': 0.3, 'humidity': 0.6, 'cloudCover': 0.4},
+    ]
+    timeline = main.get_timeline(hourly, (0, 300), 20.0, 40.0, -100.0)
+    assert timeline['hours'][0]['siteQuality'] == -1
+    assert timeline['hours'][0]['cloudCover'] is None
+    assert timeline['bestHour']['time'] == 200
+
+
+def test_night_rated_from_hours_with_weather():
+    forecast = apis.parse_forecast({'hourly': {'data': [
+        {'time': 100},
+        {'time': 200, 'precipProbability': 0.2, 'humidity': 0.5, 'cloudCover': 0.3},
+    ]}})
+    night, = main.rate_nights([{'sun_status': 'Normal', 'start': 0, 'end': 300}], forecast, 20.0)
+    assert night['bestHour'] == 200
+    assert (night['humidity'], night['cloudCover']) == (50, 30)
+    assert night['siteQuality'] == int(main.calculate_ratings(0.2, 0.5, 0.3, 20.0))
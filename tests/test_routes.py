@@ -0,0 +1,38 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize("url", [
+    "/?lat_selected=nan&lng_selected=10",
+    "/?lat_selected=91&lng_selected=10",
+    "/?lat_selected=40&lng_selected=10&lat_org=40&lng_org=inf",
+    "/outlook?lat_selected=40&lng_selected=181",
+    "/outlook?lat_selected=-inf&lng_selected=10",
+    "/darkest_sites?lat_org=nan&lng_org=10",
+    "/csc?lat_selected=100&lng_selected=10",
+])
+def test_get_routes_reject_bad_lat_lng(client, url):
+    assert client.get(url).get_json()['status'] == main.INVALID_LAT_LNG_STATUS
+
+
+@pytest.mark.parametrize("url, body", [
+    ("/light_pollution", {'points': [{'lat': 40, 'lng': 10}, {'lat': "nan", 'lng': 10}], 'radius_km': 5}),
+    ("/light_pollution", {'points': [{'lat': 95, 'lng': 10}]}),
+    ("/batch_report", {'sites': [{'lat': 40, 'lng': 10}, {'lat': 40, 'lng': -200}]}),
+    ("/batch_report", {'sites': [{'lat': 40, 'lng': 10}], 'origin': {'lat': "inf", 'lng': 10}}),
+    ("/driving_distances", {'origin': {'lat': 40, 'lng': 10}, 'sites': [{'lat': -91, 'lng': 10}]}),
+])
+def test_post_routes_reject_bad_lat_lng(client, url, body):
+    assert client.post(url, json=body).get_json()['status'] == main.INVALID_LAT_LNG_STATUS
+
+
+def test_area_batch_point_cap(client):
+    points = [{'lat': 40, 'lng': 10}] * (main.MAX_AREA_BATCH_POINTS + 1)
+    status = client.post("/light_pollution", json={'points': points, 'radius_km': 5}).get_json()['status']
+    assert status == "Error: At most %d points per request with radius_km" % main.MAX_AREA_BATCH_POINTS
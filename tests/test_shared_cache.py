@@ -0,0 +1,187 @@
+import io
+import time as t
+import zlib
+
+import pytest
+
+import cache
+import shared_cache
+
+from shared_cache import FakeRespClient, RespClient, SharedCache, SharedCacheError
+from upstream import CircuitBreaker
+
+
+@pytest.fixture
+def shared(monkeypatch):
+    """A shared cache on the in-process fake, installed as the one cache.py uses"""
+    store = SharedCache(FakeRespClient(), prefix="test")
+    monkeypatch.setattr(shared_cache, '_backend', store)
+    monkeypatch.setattr(shared_cache, '_backend_loaded', True)
+    return store
+
+
+class CountingFetch(object):
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_encode_command():
+    assert RespClient.encode_command(("SET", "k", b"\x00v", "EX", 60)) == \
+        b"*5\r\n$3\r\nSET\r\n$1\r\nk\r\n$2\r\n\x00v\r\n$2\r\nEX\r\n$2\r\n60\r\n"
+
+
+@pytest.mark.parametrize("reply, expected", [
+    (b"+OK\r\n", "OK"),
+    (b":42\r\n", 42),
+    (b"$5\r\nhe\r\no\r\n", b"he\r\no"),
+    (b"$-1\r\n", None),
+    (b"*2\r\n$1\r\na\r\n:1\r\n", [b"a", 1]),
+    (b"*-1\r\n", None),
+])
+def test_read_reply(reply, expected):
+    assert RespClient.read_reply(io.BytesIO(reply)) == expected
+
+
+@pytest.mark.parametrize("reply", [
+    b"-ERR wrong type\r\n",
+    b"$10\r\nshort\r\n",  # Connection closed mid value
+    b"",
+    b"?what\r\n",
+])
+def test_read_reply_errors(reply):
+    with pytest.raises(SharedCacheError):
+        RespClient.read_reply(io.BytesIO(reply))
+
+
+def test_resp_client_unreachable():
+    # Nothing listens on port 1
+    client = RespClient("127.0.0.1", 1, timeout=0.1)
+    with pytest.raises(SharedCacheError):
+        client.execute("PING")
+
+
+def test_make_shared_cache():
+    assert shared_cache.make_shared_cache("") is None
+    assert isinstance(shared_cache.make_shared_cache("fake://").client, FakeRespClient)
+
+    client = shared_cache.make_shared_cache("redis://:secret@cache.internal:6380/2").client
+    assert (client.host, client.port, client.db, client.password) == ("cache.internal", 6380, 2, "secret")
+
+    with pytest.raises(ValueError):
+        shared_cache.make_shared_cache("memcached://localhost")
+
+
+def test_set_get_round_trip_compressed():
+    store = SharedCache(FakeRespClient(), prefix="test")
+    value = {'results': [{'elevation': 1234.5}], 'status': "OK", 'padding': "x" * 1000}
+    store.set('gmaps_elevation', (37770, -122420), value, 60)
+
+    raw = store.client.execute("GET", "test:gmaps_elevation:37770:-122420")
+    assert len(raw) < 200  # Compressed
+    assert zlib.decompress(raw).startswith(b"{")
+    assert store.get('gmaps_elevation', (37770, -122420)) == value
+    assert store.get('gmaps_elevation', (0, 0)) is None
+    assert (store.hits, store.misses) == (1, 1)
+
+
+def test_make_key_flattens_tuples():
+    store = SharedCache(FakeRespClient(), prefix="p")
+    assert store.make_key('darksky', ("9q8yy", 3600, ('currently', 'hourly'))) == "p:darksky:9q8yy:3600:currently,hourly"
+
+
+def test_fake_expires_entries(monkeypatch):
+    fake = FakeRespClient()
+    fake.execute("SET", "k", b"v", "EX", 10)
+    assert fake.execute("GET", "k") == b"v"
+
+    later = t.monotonic() + 11
+    monkeypatch.setattr(shared_cache.t, 'monotonic', lambda: later)
+    assert fake.execute("GET", "k") is None
+
+
+def test_unreachable_store_opens_circuit():
+    fake = FakeRespClient()
+    fake.available = False
+    store = SharedCache(fake, prefix="test", breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+
+    assert store.get('darksky', ("a",)) is None
+    store.set('darksky', ("a",), 1, 60)
+    assert store.errors == 2
+    assert store.breaker.state == "open"
+
+    # Skipped without calling the store while the circuit is open
+    assert store.get('darksky', ("a",)) is None
+    assert store.errors == 2
+    assert store.skipped == 1
+
+
+def test_replicas_share_fetched_values(shared):
+    replica_a = cache.TTLCache('darksky', 60)
+    replica_b = cache.TTLCache('darksky', 60)
+    for replica in (replica_a, replica_b):
+        replica.set_codec(list, tuple)
+
+    fetch = CountingFetch((0.1, 0.5))
+    assert replica_a.get_or_fetch(("9q8yy", 0), fetch) == (0.1, 0.5)
+    assert replica_b.get_or_fetch(("9q8yy", 0), fetch) == (0.1, 0.5)  # Decoded back to a tuple
+    assert fetch.calls == 1
+    assert replica_b.stats()['shared_hits'] == 1
+
+    # Now held locally by replica b too
+    assert replica_b.get(("9q8yy", 0)) == (0.1, 0.5)
+
+
+def test_forecast_codec_round_trip(shared):
+    import apis
+
+    forecast = apis.Forecast(
+        apis.WeatherPoint(1000, 0.1, 0.5, 10, 0.2),
+        (apis.WeatherPoint(1000, 0.1, 0.5, 10, 0.2), apis.WeatherPoint(4600, None, 0.6, None, 0.3)),
+        (),
+        2048,
+        120,
+    )
+    darksky = cache.caches['darksky']
+    other_replica = cache.TTLCache('darksky', 60)
+    other_replica.set_codec(darksky.encode, darksky.decode)
+
+    darksky.get_or_fetch(("test_forecast", 0), lambda: forecast)
+    assert other_replica.get_or_fetch(("test_forecast", 0), CountingFetch(None)) == forecast
+
+
+def test_expired_shared_entry_is_refetched(shared):
+    shared.set('darksky', ("old",), {'value': 1, 'expires': t.time() - 1}, 60)
+    fetch = CountingFetch(2)
+    assert cache.TTLCache('darksky', 60).get_or_fetch(("old",), fetch) == 2
+    assert fetch.calls == 1
+
+
+def test_refresh_skips_shared_lookup(shared):
+    cache.TTLCache('darksky', 60).get_or_fetch(("k",), CountingFetch(1))
+    fetch = CountingFetch(2)
+    assert cache.TTLCache('darksky', 60).get_or_fetch(("k",), fetch, refresh=True) == 2
+    assert fetch.calls == 1
+    assert cache.TTLCache('darksky', 60).get_or_fetch(("k",), CountingFetch(3)) == 2
+
+
+def test_uncacheable_values_not_shared(shared):
+    cache.TTLCache('darksky', 60).get_or_fetch(("bad",), CountingFetch({'status': "ERROR"}),
+                                               should_cache=lambda value: value['status'] == "OK")
+    fetch = CountingFetch({'status': "OK"})
+    cache.TTLCache('darksky', 60).get_or_fetch(("bad",), fetch)
+    assert fetch.calls == 1
+
+
+def test_falls_back_to_local_cache_when_store_down(shared):
+    shared.client.available = False
+    local = cache.TTLCache('darksky', 60)
+    fetch = CountingFetch(5)
+    assert local.get_or_fetch(("down",), fetch) == 5
+    assert local.get_or_fetch(("down",), fetch) == 5
+    assert fetch.calls == 1
+    assert shared.errors >= 1
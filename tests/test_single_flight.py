@@ -0,0 +1,92 @@
+import threading
+import time as t
+
+import pytest
+
+from cache import SingleFlight
+
+WAIT_S = 5
+
+
+def run_waiters(flight, key, fn, count):
+    """Start count threads calling flight.do(key, fn), each filling in its (kind, result)"""
+    results = [None] * count
+
+    def waiter(i):
+        try:
+            results[i] = ('value', flight.do(key, fn))
+        except Exception as e:
+            results[i] = ('error', e)
+
+    threads = [threading.Thread(target=waiter, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def wait_until(condition):
+    for _ in range(WAIT_S * 100):
+        if condition():
+            return
+        t.sleep(0.01)
+    raise AssertionError("Timed out waiting")
+
+
+def test_concurrent_calls_coalesce():
+    flight = SingleFlight('test')
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        assert release.wait(WAIT_S)
+        return 42
+
+    leader, leader_result = run_waiters(flight, 'k', fetch, 1)
+    assert started.wait(WAIT_S)
+    followers, results = run_waiters(flight, 'k', fetch, 4)
+    wait_until(lambda: flight.coalesced == 4)
+
+    release.set()
+    for thread in leader + followers:
+        thread.join(WAIT_S)
+    assert leader_result == [('value', 42)]
+    assert results == [('value', 42)] * 4
+    assert len(calls) == 1
+    assert flight.stats() == {'calls': 1, 'coalesced': 4, 'in_flight': 0}
+
+
+def test_exception_propagates_to_waiters():
+    flight = SingleFlight('test')
+    started, release = threading.Event(), threading.Event()
+
+    def fetch():
+        started.set()
+        assert release.wait(WAIT_S)
+        raise ValueError("upstream down")
+
+    leader, leader_result = run_waiters(flight, 'k', fetch, 1)
+    assert started.wait(WAIT_S)
+    followers, results = run_waiters(flight, 'k', fetch, 3)
+    wait_until(lambda: flight.coalesced == 3)
+
+    release.set()
+    for thread in leader + followers:
+        thread.join(WAIT_S)
+    for kind, error in leader_result + results:
+        assert kind == 'error' and isinstance(error, ValueError)
+    assert flight.stats()['in_flight'] == 0
+
+    # The failed call isn't remembered, the next one is made again
+    assert flight.do('k', lambda: 7) == 7
+    assert flight.calls == 2
+
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight('test')
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.do('b', lambda: 2) == 2
+    with pytest.raises(KeyError):
+        flight.do('c', lambda: {}['missing'])
+    assert flight.stats() == {'calls': 3, 'coalesced': 0, 'in_flight': 0}
@@ -0,0 +1,129 @@
+import pytest
+
+import apis
+import main
+
+NOW = 1600000000
+HOUR = 3600
+
+
+class FakeDarkSky(object):
+    """Stands in for apis.dark_sky, answering with hourly data from the request's time
+    (local midnight for a Time Machine request, this hour for the forecast) and recording calls"""
+
+    def __init__(self, stale=False):
+        self.calls = []
+        self.stale = stale
+
+    def __call__(self, lat, lng, time, blocks=('currently',), refresh=False, extend_hourly=False):
+        self.calls.append((time, blocks, extend_hourly))
+        if time is None:
+            start, hours = NOW - NOW % HOUR, 169 if extend_hourly else 49
+        else:
+            start, hours = time - time % main.SECONDS_IN_DAY, 24
+        hourly = tuple(apis.WeatherPoint(start + i * HOUR, 0.1, 0.5, 10, 0.2) for i in range(hours))
+        return apis.Forecast(None, hourly, (), 0, 0, self.stale)
+
+
+@pytest.fixture
+def dark_sky(monkeypatch):
+    fake = FakeDarkSky()
+    monkeypatch.setattr(apis, 'dark_sky', fake)
+    return fake
+
+
+@pytest.mark.parametrize("days_ahead, extend_hourly", [(0, False), (1, False), (3, True), (6, True)])
+def test_nights_within_the_week_come_from_the_forecast(dark_sky, days_ahead, extend_hourly):
+    night = (NOW + days_ahead * main.SECONDS_IN_DAY + 10 * HOUR, NOW + days_ahead * main.SECONDS_IN_DAY + 19 * HOUR)
+    weather = main.get_hourly_weather(40.0, -100.0, night, NOW)
+    assert dark_sky.calls == [(None, ('hourly',), extend_hourly)]
+    times = [hour['time'] for hour in weather['hourly']]
+    # Every hour of the night is there, past midnight too
+    assert all(time in times for time in range(night[0] - night[0] % HOUR + HOUR, night[1], HOUR))
+
+
+def test_far_nights_merge_time_machine_days(dark_sky):
+    midnight = NOW - NOW % main.SECONDS_IN_DAY + 8 * main.SECONDS_IN_DAY
+    night = (midnight - 4 * HOUR, midnight + 5 * HOUR)
+    weather = main.get_hourly_weather(40.0, -100.0, night, NOW)
+    assert [call[0] for call in dark_sky.calls] == list(night)
+
+    times = [hour['time'] for hour in weather['hourly']]
+    assert times == sorted(set(times))
+    assert len(times) == 48
+    timeline = main.get_timeline(weather['hourly'], night, 0.1, 40.0, -100.0)
+    assert [hour['time'] for hour in timeline['hours']] == list(range(night[0], night[1] + 1, HOUR))
+
+
+def test_stale_or_missing_hourly(monkeypatch):
+    monkeypatch.setattr(apis, 'dark_sky', FakeDarkSky(stale=True))
+    assert main.get_hourly_weather(40.0, -100.0, (NOW, NOW + 8 * HOUR), NOW)['stale']
+
+    monkeypatch.setattr(apis, 'dark_sky', lambda *args, **kwargs: apis.Forecast(None, (), (), 0, 0, False))
+    assert main.get_hourly_weather(40.0, -100.0, (NOW, NOW + 8 * HOUR), NOW)['status'].startswith("Error")
+
+
+def solar_midnights(lng, start, end):
+    """Unix times of local (solar) midnight at a longitude between start and end"""
+    offset = -lng / 360.0 * main.SECONDS_IN_DAY
+    first = start - (start - offset) % main.SECONDS_IN_DAY + main.SECONDS_IN_DAY
+    return list(range(int(first), end, main.SECONDS_IN_DAY))
+
+
+def test_night_windows_cross_local_midnight():
+    lat, lng = 40.0, -100.0
+    windows = main.get_night_windows(lat, lng, NOW, 3)
+    assert len(windows) == 3
+    for window in windows:
+        assert window['sun_status'] == 'Normal'
+        assert 6 * HOUR < window['end'] - window['start'] < 14 * HOUR
+        assert len(solar_midnights(lng, window['start'], window['end'])) == 1
+    # One night after another
+    assert all(a['end'] < b['start'] for a, b in zip(windows, windows[1:]))
+    assert windows[0]['end'] > NOW
+
+
+def test_night_windows_polar_night_and_midnight_sun():
+    december, june = 1608508800, 1592697600  # Solstices
+    windows = main.get_night_windows(80.0, 15.0, december, 2)
+    assert [window['sun_status'] for window in windows] == ['Polar Night'] * 2
+    assert all(window['end'] - window['start'] == main.SECONDS_IN_DAY for window in windows)
+
+    windows = main.get_night_windows(80.0, 15.0, june, 2)
+    assert [window['sun_status'] for window in windows] == ['Midnight Sun'] * 2
+    assert all(window['start'] is None and window['end'] is None for window in windows)
+    assert main.rate_nights(windows, apis.Forecast(None, (), (), 0, 0), 0.1)[0]['status'].startswith("Error")
+
+
+def test_timeline_rates_hours_past_midnight():
+    lat, lng = 40.0, -100.0
+    window = main.get_night_windows(lat, lng, NOW, 1)[0]
+    midnight, = solar_midnights(lng, window['start'], window['end'])
+    first_hour = window['start'] - window['start'] % HOUR
+    hourly = [{'time': time, 'precipProb': 0.1, 'humidity': 0.5, 'cloudCover': 0.8}
+              for time in range(first_hour - 2 * HOUR, window['end'] + 2 * HOUR, HOUR)]
+    # Clearest an hour after midnight
+    clear = next(hour for hour in hourly if hour['time'] >= midnight + HOUR)
+    clear['cloudCover'] = 0.0
+
+    timeline = main.get_timeline(hourly, (window['start'], window['end']), 0.1, lat, lng)
+    times = [hour['time'] for hour in timeline['hours']]
+    assert times == [hour['time'] for hour in hourly if window['start'] <= hour['time'] <= window['end']]
+    assert times[-1] > midnight
+    assert timeline['bestHour']['time'] == clear['time']
+    assert timeline['bestHour']['cloudCover'] == 0
+
+
+def test_polar_night_timeline():
+    window = (NOW, NOW + main.SECONDS_IN_DAY // 2)
+    hourly = [{'time': NOW + i * HOUR, 'precipProb': 0.0, 'humidity': 0.3, 'cloudCover': 0.1} for i in range(24)]
+    timeline = main.get_timeline(hourly, window, 0.1, 80.0, 15.0)
+    assert len(timeline['hours']) == 13
+
+
+def test_empty_hourly_timeline():
+    assert main.get_timeline([], (NOW, NOW + 8 * HOUR), 0.1, 40.0, -100.0) == {
+        'status': "Error: No hourly forecast during darkness"}
+    # Hours, just none in the dark
+    hourly = [{'time': NOW + 10 * HOUR, 'precipProb': 0.0, 'humidity': 0.3, 'cloudCover': 0.1}]
+    assert main.get_timeline(hourly, (NOW, NOW + 8 * HOUR), 0.1, 40.0, -100.0)['status'].startswith("Error")
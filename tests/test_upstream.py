@@ -0,0 +1,129 @@
+import pytest
+import requests
+
+import upstream
+
+from upstream import CircuitBreaker, DeadlineExceededError, QuotaBudget, UpstreamClient, UpstreamError
+
+
+class FakeClock(object):
+    """Stands in for upstream's monotonic clock, sleeping just moves it forward"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeSession(object):
+    """Answers session.get with the given responses in turn, recording each call's timeout.
+
+    A requests.Timeout response takes the call's whole read timeout to arrive.
+    """
+
+    def __init__(self, clock, *responses):
+        self.clock = clock
+        self.responses = list(responses)
+        self.timeouts = []
+
+    def get(self, url, params=None, timeout=None):
+        self.timeouts.append(timeout)
+        response = self.responses.pop(0)
+        if isinstance(response, requests.Timeout):
+            self.clock.sleep(timeout[1])
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, data=None):
+        self.status_code = status_code
+        self.content = b"{}"
+        self.request = requests.Request('GET', "http://upstream/").prepare()
+        self.data = data or {}
+
+    def json(self):
+        return self.data
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(upstream.t, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(upstream.t, 'sleep', clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def client(clock):
+    return UpstreamClient('test', connect_timeout=3, read_timeout=5, max_retries=2,
+                          breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60), quota=QuotaBudget())
+
+
+def test_no_deadline_uses_configured_timeouts(client, clock):
+    client.session = FakeSession(clock, FakeResponse(503), FakeResponse(data={'ok': True}))
+    assert client.get_json("http://upstream/") == {'ok': True}
+    assert client.session.timeouts == [(3, 5), (3, 5)]
+
+
+def test_timeouts_capped_to_deadline(client, clock):
+    client.session = FakeSession(clock, FakeResponse(data={'ok': True}))
+    with upstream.call_deadline(clock.now + 1):
+        assert client.get_json("http://upstream/") == {'ok': True}
+    assert client.session.timeouts == [(1, 1)]
+
+
+def test_no_call_past_deadline(client, clock):
+    client.session = FakeSession(clock)
+    with upstream.call_deadline(clock.now - 1):
+        with pytest.raises(DeadlineExceededError):
+            client.get_json("http://upstream/")
+    assert client.session.timeouts == []
+    assert client.stats()['past_deadline'] == 1
+
+
+def test_no_retry_past_deadline(client, clock, monkeypatch):
+    monkeypatch.setattr(upstream.random, 'uniform', lambda low, high: high)
+    monkeypatch.setattr(upstream, 'BACKOFF_BASE_S', 2)  # Backoff longer than the time left
+    client.session = FakeSession(clock, FakeResponse(503), FakeResponse(data={'ok': True}))
+    with upstream.call_deadline(clock.now + 1):
+        with pytest.raises(UpstreamError):
+            client.get_json("http://upstream/")
+    assert len(client.session.timeouts) == 1
+    assert client.retries == 0
+
+
+def test_timeout_cut_short_by_deadline_leaves_circuit_closed(client, clock):
+    client.session = FakeSession(clock, requests.Timeout("read timed out"))
+    with upstream.call_deadline(clock.now + 0.5):
+        with pytest.raises(DeadlineExceededError):
+            client.get_json("http://upstream/")
+    assert client.breaker.state == "closed"
+    assert client.failures == 0
+
+    # The same timeout with the full configured timeouts counts against the upstream
+    client.session = FakeSession(clock, *[requests.Timeout("read timed out")] * 3)
+    with pytest.raises(UpstreamError):
+        client.get_json("http://upstream/")
+    assert client.breaker.state == "open"
+
+
+def test_nested_deadline_only_shortens(clock):
+    assert upstream.time_left() is None
+    with upstream.call_deadline(clock.now + 10):
+        with upstream.call_deadline(clock.now + 20):
+            assert upstream.time_left() == 10
+        with upstream.call_deadline(clock.now + 5):
+            assert upstream.time_left() == 5
+        assert upstream.time_left() == 10
+    assert upstream.time_left() is None
+
+
+def test_call_with_deadline(clock):
+    assert upstream.call_with_deadline(clock.now + 3, upstream.time_left) == 3
+    assert upstream.time_left() is None
@@ -0,0 +1,391 @@
+"""
+Shared HTTP client for upstream APIs (DarkSky, Google Maps)
+
+Each upstream gets its own pooled keep-alive session, timeouts, bounded retries with
+jittered backoff and a circuit breaker, so a slow or dead upstream can't tie up workers.
+
+Calls also spend from a quota of token buckets per upstream (per second and per day), so a
+traffic spike can't run through a billed API key. Callers can check quota_low() to serve
+what they already have instead of calling.
+
+Calls made inside call_deadline() are bounded by it: each attempt's timeouts are cut to the
+time left, and there are no retries once it has passed. A report uses this so a section it
+has given up on stops calling instead of running on in its worker thread.
+"""
+import os
+import random
+import threading
+import time as t
+
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+CONNECT_TIMEOUT_S = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT_S', 3.05))
+READ_TIMEOUT_S = float(os.environ.get('UPSTREAM_READ_TIMEOUT_S', 5))
+MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 2))
+BACKOFF_BASE_S = float(os.environ.get('UPSTREAM_BACKOFF_BASE_S', 0.1))
+BACKOFF_MAX_S = float(os.environ.get('UPSTREAM_BACKOFF_MAX_S', 1))
+POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 16))
+BREAKER_FAILURES = int(os.environ.get('UPSTREAM_BREAKER_FAILURES', 5))
+BREAKER_RESET_S = float(os.environ.get('UPSTREAM_BREAKER_RESET_S', 30))
+
+# Token bucket quotas per upstream, per worker process (0 for no limit). Split the API key's
+# limits between all workers of all replicas
+QUOTA_DEFAULTS = {
+    'darksky': {'per_second': 10, 'per_day': 0},
+    'gmaps_elevation': {'per_second': 50, 'per_day': 0},
+    'gmaps_distance': {'per_second': 20, 'per_day': 0},
+}
+QUOTA_BURST_S = float(os.environ.get('UPSTREAM_QUOTA_BURST_S', 2))  # Per second buckets hold this many seconds of calls
+QUOTA_MAX_WAIT_S = float(os.environ.get('UPSTREAM_QUOTA_MAX_WAIT_S', 0.25))
+QUOTA_LOW_FRACTION = float(os.environ.get('UPSTREAM_QUOTA_LOW_FRACTION', 0.1))
+
+# Responses worth retrying, anything else is returned to the caller as is
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class UpstreamError(Exception):
+    """An upstream API could not be reached or kept failing"""
+
+
+class CircuitOpenError(UpstreamError):
+    """The upstream failed repeatedly, calls are skipped until it has had time to recover"""
+
+
+class QuotaExceededError(UpstreamError):
+    """The upstream's call quota is used up, calls are refused until it refills"""
+
+
+class DeadlineExceededError(UpstreamError):
+    """The caller's deadline passed before the upstream answered"""
+
+
+class CircuitBreaker(object):
+    """Stops calls to an upstream after consecutive failures.
+
+    After reset_timeout seconds one trial call is let through (half open), its result
+    decides whether the circuit closes again or stays open.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_S):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if t.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        """Give back a half open trial that never made its call"""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = t.monotonic()
+
+
+class TokenBucket(object):
+    """Holds up to capacity tokens, refilled continuously at rate tokens per second.
+
+    Not thread safe on its own, QuotaBudget locks around it.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = t.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, tokens):
+        """Seconds until the bucket holds tokens (0 if it already does)"""
+        return max(tokens - self.tokens, 0) / self.rate
+
+    def fraction_left(self):
+        return max(self.tokens, 0) / self.capacity
+
+
+class QuotaBudget(object):
+    """Per second and per day call limits for one upstream, as token buckets.
+
+    A call briefly waits (up to max_wait_s) for the per second bucket to refill, the
+    daily bucket has to have the call left. low() is true once either bucket is down to
+    low_fraction of its capacity, before calls start being refused.
+    """
+
+    def __init__(self, per_second=0, per_day=0, burst_s=QUOTA_BURST_S, max_wait_s=QUOTA_MAX_WAIT_S,
+                 low_fraction=QUOTA_LOW_FRACTION):
+        self.per_second = per_second
+        self.per_day = per_day
+        self.max_wait_s = max_wait_s
+        self.low_fraction = low_fraction
+        self.second_bucket = TokenBucket(per_second, max(per_second * burst_s, 1)) if per_second else None
+        self.day_bucket = TokenBucket(per_day / 86400.0, per_day) if per_day else None
+        self.spent = 0
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    def buckets(self):
+        return [bucket for bucket in (self.second_bucket, self.day_bucket) if bucket is not None]
+
+    def try_spend(self):
+        """Take one call from the budget, waiting up to max_wait_s for the per second limit
+
+        returns: True if the call may be made
+        """
+        with self._lock:
+            now = t.monotonic()
+            for bucket in self.buckets():
+                bucket.refill(now)
+            wait_s = self.second_bucket.wait_for(1) if self.second_bucket else 0
+            if (self.day_bucket and self.day_bucket.tokens < 1) or wait_s > self.max_wait_s:
+                self.refused += 1
+                return False
+            # Taking the token now reserves it, other callers wait behind this one
+            for bucket in self.buckets():
+                bucket.tokens -= 1
+            self.spent += 1
+        if wait_s:
+            t.sleep(wait_s)
+        return True
+
+    def low(self):
+        """Whether the budget is nearly used up, and calls are best saved for what can't do without"""
+        with self._lock:
+            now = t.monotonic()
+            for bucket in self.buckets():
+                bucket.refill(now)
+            return any(bucket.fraction_left() <= self.low_fraction for bucket in self.buckets())
+
+    def stats(self):
+        with self._lock:
+            now = t.monotonic()
+            for bucket in self.buckets():
+                bucket.refill(now)
+            return {
+                'per_second': self.per_second,
+                'per_day': self.per_day,
+                'second_tokens': round(self.second_bucket.tokens, 2) if self.second_bucket else None,
+                'day_tokens': round(self.day_bucket.tokens, 2) if self.day_bucket else None,
+                'spent': self.spent,
+                'refused': self.refused,
+            }
+
+
+def make_quota(name):
+    """QuotaBudget for an upstream from UPSTREAM_QUOTA_<NAME>_PER_S / _PER_DAY, or its defaults"""
+    defaults = QUOTA_DEFAULTS.get(name, {})
+    prefix = 'UPSTREAM_QUOTA_%s_' % name.upper()
+    return QuotaBudget(float(os.environ.get(prefix + 'PER_S', defaults.get('per_second', 0))),
+                       float(os.environ.get(prefix + 'PER_DAY', defaults.get('per_day', 0))))
+
+
+_deadlines = threading.local()
+
+
+@contextmanager
+def call_deadline(deadline):
+    """Bound upstream calls made by this thread inside the block by a monotonic deadline
+
+    Nested deadlines can only shorten the one already in place.
+    """
+    previous = getattr(_deadlines, 'deadline', None)
+    _deadlines.deadline = deadline if previous is None else min(previous, deadline)
+    try:
+        yield
+    finally:
+        _deadlines.deadline = previous
+
+
+def call_with_deadline(deadline, fn, *args):
+    """fn(*args) inside call_deadline(deadline), for running on an executor thread"""
+    with call_deadline(deadline):
+        return fn(*args)
+
+
+def time_left():
+    """Seconds left before this thread's call deadline, None if there isn't one"""
+    deadline = getattr(_deadlines, 'deadline', None)
+    return None if deadline is None else deadline - t.monotonic()
+
+
+class UpstreamClient(object):
+    """Pooled keep-alive client for one upstream API"""
+
+    def __init__(self, name, connect_timeout=CONNECT_TIMEOUT_S, read_timeout=READ_TIMEOUT_S,
+                 max_retries=MAX_RETRIES, pool_size=POOL_SIZE, breaker=None, quota=None):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
+        self.quota = quota or make_quota(name)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+        self.over_quota = 0
+        self.past_deadline = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def request_json(self, url, params=None):
+        """GET url and decode the json response, retrying request errors, timeouts and 5xx/429
+
+        args: url, dict of query params
+        returns: tuple of (decoded json response, response body bytes, request url bytes)
+        raises: UpstreamError if all attempts fail, CircuitOpenError if the upstream is being skipped,
+                QuotaExceededError if its quota is used up, DeadlineExceededError if the call_deadline
+                passed first
+        """
+        time_left_s = time_left()
+        if time_left_s is not None and time_left_s <= 0:
+            self.past_deadline += 1
+            metrics.count_error('upstreams', self.name, "past_deadline")
+            raise DeadlineExceededError("%s: deadline passed, skipping call" % self.name)
+        if not self.breaker.allow():
+            self.rejected += 1
+            metrics.count_error('upstreams', self.name, "circuit_open")
+            raise CircuitOpenError("%s: circuit open, skipping call" % self.name)
+        if not self.quota.try_spend():
+            # Not the upstream's fault, let a half open circuit try again
+            self.breaker.release_trial()
+            self.over_quota += 1
+            metrics.count_error('upstreams', self.name, "over_quota")
+            raise QuotaExceededError("%s: over quota, skipping call" % self.name)
+
+        started = t.perf_counter()
+        last_error = None
+        attempts = 0
+        cut_short = False  # Failed because the deadline ran out, not because of the upstream
+        for attempt in range(self.max_retries + 1):
+            timeout = self.timeout
+            if attempt:
+                # Full jitter keeps retries from many workers from arriving together
+                backoff_s = random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt))
+                time_left_s = time_left()
+                if time_left_s is not None and time_left_s <= backoff_s:
+                    break  # No time left to retry, fail with the last error
+                if not self.quota.try_spend():
+                    break  # Fail with the last error rather than retry past the quota
+                self.retries += 1
+                t.sleep(backoff_s)
+
+            time_left_s = time_left()
+            if time_left_s is not None:
+                if time_left_s <= 0:
+                    cut_short = cut_short or not attempts  # e.g. used up waiting on the quota
+                    break
+                timeout = tuple(min(limit, time_left_s) for limit in self.timeout)
+
+            self.requests += 1
+            attempts += 1
+            cut_short = False
+            try:
+                response = self.session.get(url, params=params, timeout=timeout)
+                bytes_in = len(response.content)
+                bytes_out = len(response.request.url)
+                self.bytes_in += bytes_in
+                self.bytes_out += bytes_out
+                if response.status_code in RETRY_STATUSES:
+                    last_error = "HTTP %d" % response.status_code
+                    continue
+                data = response.json()
+            except (requests.RequestException, ValueError) as e:
+                last_error = e
+                cut_short = isinstance(e, requests.Timeout) and timeout != self.timeout
+                continue
+
+            self.breaker.record_success()
+            metrics.observe('upstreams', self.name, t.perf_counter() - started)
+            return data, bytes_in, bytes_out
+
+        if cut_short:
+            # Not enough time left says nothing about the upstream, don't count it against the circuit
+            self.breaker.release_trial()
+            self.past_deadline += 1
+            metrics.observe('upstreams', self.name, t.perf_counter() - started, "past_deadline")
+            raise DeadlineExceededError("%s: deadline passed after %d attempts: %s" % (self.name, attempts, last_error))
+
+        self.failures += 1
+        self.breaker.record_failure()
+        metrics.observe('upstreams', self.name, t.perf_counter() - started, "failed")
+        raise UpstreamError("%s: failed after %d attempts: %s" % (self.name, attempts, last_error))
+
+    def get_json(self, url, params=None):
+        """request_json, without the payload sizes"""
+        return self.request_json(url, params)[0]
+
+    def quota_low(self):
+        return self.quota.low()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'over_quota': self.over_quota,
+            'past_deadline': self.past_deadline,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'circuit': self.breaker.state,
+            'quota': self.quota.stats(),
+        }
+
+
+clients = {
+    'darksky': UpstreamClient('darksky'),
+    'gmaps_elevation': UpstreamClient('gmaps_elevation'),
+    'gmaps_distance': UpstreamClient('gmaps_distance'),
+}
+
+
+def quota_low(name):
+    """Whether an upstream's call quota is nearly used up"""
+    return clients[name].quota_low()
+
+
+def get_upstream_stats():
+    """Request, retry, failure and payload byte counters and circuit state for each upstream"""
+    return {name: client.stats() for name, client in clients.items()}
@@ -0,0 +1,17 @@
+"""
+Production entry point, run under gunicorn with gunicorn.conf.py:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+With preload_app the master process imports this module once, warming up the shared data
+before forking workers, so every worker starts with it already loaded.
+"""
+import gc
+
+from main import app, warm_up
+
+warm_up()
+
+# Keep objects loaded during warm up out of garbage collection, so collections in the
+# workers don't write to (and un-share) their copy-on-write pages
+gc.freeze()